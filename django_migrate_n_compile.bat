@@ -6,6 +6,7 @@ echo  -------------------------------------
 echo.
 call .\.venv\Scripts\activate
 call python manage.py migrate
+call python manage.py createcachetable
 echo.
 echo  -------------------------------------
 echo    Handle Translations
@@ -1,6 +1,7 @@
 from django.contrib import admin
+from django.utils.translation import gettext_lazy as _
 
-from psucontrol.models import WateringParams, PSU, PendingPSU, DataMeasurement, PSUImage, WateringTask, CommunicationLogEntry, WateringDecision
+from psucontrol.models import WateringParams, PSU, PendingPSU, DataMeasurement, PSUImage, WateringTask, CommunicationLogEntry, WateringDecision, WateringJob, PSUState
 
 
 # Register your models here.
@@ -8,7 +9,8 @@ from psucontrol.models import WateringParams, PSU, PendingPSU, DataMeasurement,
 class WateringParamsAdmin(admin.ModelAdmin):
     model = WateringParams
 
-    list_display = ['id', 'name', 'ground_humidity_goal', 'minimum_amount', 'maximum_amount', 'starting_amount']
+    list_display = ['id', 'name', 'algorithm', 'ground_humidity_goal', 'minimum_amount', 'maximum_amount', 'starting_amount']
+    list_filter = ['algorithm']
     search_fields = ['id', 'name']
 
 
@@ -19,6 +21,14 @@ class PSUAdmin(admin.ModelAdmin):
     list_display = ['id', 'name', 'owner', 'watering_params', 'unauthorized_watering', 'identity_key']
     list_filter = ['owner', 'watering_params', 'unauthorized_watering']
     search_fields = ['id', 'name', 'owner__email', 'owner__last_name', 'owner__first_name', 'watering_params__name', 'identity_key']
+    actions = ['revoke_session_tokens']
+
+    @admin.action(description=_('Revoke session tokens of selected PSUs'))
+    def revoke_session_tokens(self, request, queryset):
+        # save every PSU to trigger the signals of the PSU model
+        for psu in queryset:
+            psu.session_token_version += 1
+            psu.save()
 
 
 @admin.register(PendingPSU)
@@ -42,7 +52,7 @@ class DataMeasurementAdmin(admin.ModelAdmin):
 class PSUImageAdmin(admin.ModelAdmin):
     model = PSUImage
 
-    list_display = ['psu', 'timestamp', 'image']
+    list_display = ['psu', 'timestamp', 'image', 'reference']
     list_filter = ['psu']
     search_fields = ['psu__id', 'psu__name', 'psu__owner__email', 'psu__owner__last_name', 'psu__owner__first_name']
 
@@ -72,3 +82,19 @@ class WateringDecisionAdmin(admin.ModelAdmin):
     list_display = ['timestamp', 'psu', 'amount', 'watering_params']
     list_filter = ['psu', 'watering_params']
     search_fields = ['psu__id', 'psu__name', 'psu__owner__email', 'psu__owner__last_name', 'psu__owner__first_name', 'watering_params__name']
+
+
+@admin.register(WateringJob)
+class WateringJobAdmin(admin.ModelAdmin):
+    model = WateringJob
+
+    list_display = ['psu', 'requested', 'locked_until', 'attempts', 'last_error']
+    search_fields = ['psu__id', 'psu__name', 'last_error']
+
+
+@admin.register(PSUState)
+class PSUStateAdmin(admin.ModelAdmin):
+    model = PSUState
+
+    list_display = ['psu', 'latest_timestamp', 'current_ground_humidity', 'latest_task_timestamp', 'last_execution']
+    search_fields = ['psu__id', 'psu__name']
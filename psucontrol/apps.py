@@ -5,3 +5,8 @@ from django.utils.translation import gettext_lazy as _
 class PsucontrolConfig(AppConfig):
     name = 'psucontrol'
     verbose_name = _('PSU Control')
+
+    def ready(self):
+        # build the translated error responses of the PSU communication once
+        from psucontrol.views import build_all_error_responses
+        build_all_error_responses()
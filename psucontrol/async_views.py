@@ -0,0 +1,303 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from math import isfinite
+from time import monotonic
+
+from asgiref.sync import sync_to_async
+from cryptography.hazmat.primitives import serialization
+from django.conf import settings
+from django.http import HttpResponseNotAllowed
+
+import psucontrol.views as v
+from psucontrol.keycache import public_key_cache
+from psucontrol.longpoll import watering_task_waiters
+from psucontrol.models import CommunicationLogEntry
+
+
+# Async versions of the views in psucontrol.views for deployments with website.asgi
+# the database is still accessed synchronously (Django has no async ORM yet), but only for the short
+# queries themselves, while waiting for slow PSUs does not block a thread
+# the RSA operations run in their own executor to keep them away from the database thread
+
+rsa_executor = ThreadPoolExecutor(max_workers=settings.PSU_RSA_VERIFY_WORKERS, thread_name_prefix='psu-rsa')
+
+respond_n_log = sync_to_async(v.respond_n_log)
+identify_psu = sync_to_async(v.identify_psu)
+
+
+async def run_rsa(func, *args):
+    """
+    runs an RSA operation in the rsa_executor
+    returns: return value of func
+    """
+    return await asyncio.get_running_loop().run_in_executor(rsa_executor, func, *args)
+
+
+def async_post_view(view_func):
+    """
+    decorator replacing csrf_exempt and require_POST for async views
+    (the decorators of django turn async views into sync functions)
+    """
+    @wraps(view_func)
+    async def wrapped_view(request):
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        return await view_func(request)
+
+    wrapped_view.csrf_exempt = True
+    return wrapped_view
+
+
+async def authenticate_request(request, psu):
+    """
+    async version of psucontrol.views.authenticate_request
+    raises KeyError if neither session token nor signed challenge is given
+    returns: error code or None if access is granted
+    """
+    if 'session_token' in request.POST:
+        # no database needed
+        if not v.validate_session_token(psu, request.POST['session_token']):
+            return '0xA4'
+        return None
+
+    message = request.POST['signed_challenge']
+
+    if 'challenge' in request.POST:
+        # stateless challenge
+        challenge = request.POST['challenge']
+        nonce = v.unsign_stateless_challenge(psu, challenge)
+        valid = nonce is not None and await run_rsa(v.verify_signature, psu, challenge, message) \
+            and await sync_to_async(v.mark_challenge_used)(psu, nonce)
+    else:
+        # stored challenge
+        challenge = await sync_to_async(v.read_challenge)(psu)
+        valid = False
+        if challenge != '':
+            valid = await run_rsa(v.verify_signature, psu, challenge, message)
+            # remove challenge
+            valid = await sync_to_async(v.consume_challenge)(psu, challenge) and valid
+
+    return None if valid else '0xA2'
+
+
+async def run_authenticated(request, body):
+    """
+    identifies and authenticates the PSU of the request and runs body(request, psu) afterwards
+    body is one of the functions used by the sync views as well or a coroutine function
+    returns: response of body or error response
+    """
+    try:
+        # identification of the PSU
+        psu = await identify_psu(request.POST['identity_key'])
+
+        if psu is None:
+            # return identification error
+            return await respond_n_log(request, v.json_error_response('0xA1'), CommunicationLogEntry.Level.ERROR)
+
+        # authenticate PSU
+        error_code = await authenticate_request(request, psu)
+        if error_code is not None:
+            # return authentication error
+            return await respond_n_log(request, v.json_error_response(error_code), CommunicationLogEntry.Level.ERROR, psu=psu)
+
+    except KeyError:
+        # return bad request
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
+
+    if asyncio.iscoroutinefunction(body):
+        return await body(request, psu)
+    return await sync_to_async(body)(request, psu)
+
+
+@async_post_view
+async def register_new_psu(request):
+    """
+    async view to handle the first contact between psu and server
+    """
+    await sync_to_async(v.remove_old_pending_psus)()
+
+    if request.POST:
+        try:
+            # try to deserialize public key
+            public_rsa_key = request.POST['public_rsa_key']
+            public_key = await run_rsa(serialization.load_pem_public_key, bytes(public_rsa_key, 'utf-8'))
+
+            pending_psu = await sync_to_async(v.create_pending_psu)(public_rsa_key)
+
+            # keep deserialized key for the first authentication of the PSU
+            public_key_cache.add(None, public_rsa_key, public_key)
+
+        except KeyError:
+            # return bad request
+            return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
+
+        except ValueError:
+            # return 0xA3 as sign of wrong key format
+            return await respond_n_log(request, v.json_error_response('0xA3'), CommunicationLogEntry.Level.MAJOR_ERROR)
+
+        except Exception:
+            # return creation error
+            return await respond_n_log(request, v.json_error_response('0xD1'), CommunicationLogEntry.Level.ERROR)
+
+        # successful request -> return identity_key and pairing_key
+        return await respond_n_log(request, {'status': 'ok', 'identity_key': pending_psu.identity_key, 'pairing_key': pending_psu.pairing_key}, CommunicationLogEntry.Level.MAJOR_INFO)
+    else:
+        # return bad request error
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
+
+
+@async_post_view
+async def get_challenge(request):
+    """
+    async view to handle the request of a new challenge
+    """
+    if request.POST:
+        try:
+            # identification of the PSU
+            psu = await identify_psu(request.POST['identity_key'])
+
+            if psu is None:
+                # return identification error
+                return await respond_n_log(request, v.json_error_response('0xA1'), CommunicationLogEntry.Level.ERROR)
+
+            if 'stateless' in request.POST:
+                # generate signed challenge without touching the database
+                challenge = v.create_stateless_challenge(psu)
+                return await respond_n_log(request, {'status': 'ok', 'challenge': challenge, 'challenge_lifetime': settings.PSU_CHALLENGE_LIFETIME},
+                                           CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+
+            # generate new challenge and store it
+            challenge = await sync_to_async(v.create_challenge)(psu)
+
+            return await respond_n_log(request, {'status': 'ok', 'challenge': challenge}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+
+        except KeyError:
+            # return bad request
+            return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
+
+    else:
+        # return bad request type
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
+
+
+@async_post_view
+async def add_data_measurement(request):
+    """
+    async view to handle the process to add a new data entry
+    """
+    if request.POST:
+        return await run_authenticated(request, v.store_data_measurement)
+    else:
+        # return bad request type
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
+
+
+@async_post_view
+async def add_data_measurements(request):
+    """
+    async view to handle the process to add multiple data entries with one request
+    """
+    if request.POST:
+        return await run_authenticated(request, v.store_data_measurements)
+    else:
+        # return bad request type
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
+
+
+@async_post_view
+async def add_image(request):
+    """
+    async view to handle the process to add a new PSUImage
+    """
+    v.use_image_upload_handler(request)
+    # parse the body (writes the image to disk) outside of the event loop
+    await sync_to_async(lambda: request.FILES, thread_sensitive=False)()
+
+    if request.POST and request.FILES:
+        return await run_authenticated(request, v.store_image)
+    else:
+        # return bad request type
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
+
+
+# the upload handler has to be set before middlewares access request.POST
+add_image.prepare_request = v.use_image_upload_handler
+
+
+@async_post_view
+async def get_watering_task(request):
+    """
+    async view to handle to get the most recent watering task
+    ALL others will be set to canceled
+    """
+    if request.POST:
+        return await run_authenticated(request, v.transmit_watering_task)
+    else:
+        # return bad request type
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
+
+
+async def wait_n_transmit_watering_task(request, psu):
+    """
+    waits until a WateringTask of the psu reaches status 5 or the timeout is reached
+    tasks saved by this process wake up the request immediately (see psucontrol.longpoll), tasks saved by
+    other processes are found by checking the database every PSU_LONG_POLL_INTERVAL seconds
+    returns: response of psucontrol.views.transmit_watering_task
+    """
+    try:
+        timeout = float(request.POST.get('timeout', settings.PSU_LONG_POLL_TIMEOUT))
+        if not isfinite(timeout):
+            # nan passes the clamping and would hold the request open forever
+            raise ValueError('timeout has to be finite')
+        timeout = min(max(timeout, 0), settings.PSU_LONG_POLL_TIMEOUT)
+    except ValueError:
+        # return bad request
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR, psu=psu)
+
+    deadline = monotonic() + timeout
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    # register before the database is checked to miss no task created in between
+    watering_task_waiters.register(psu.id, loop, event)
+    try:
+        while not await sync_to_async(v.has_new_watering_task)(psu):
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            # tasks of this process set the event, tasks of other processes are found by the next check
+            try:
+                await asyncio.wait_for(event.wait(), min(settings.PSU_LONG_POLL_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+    finally:
+        watering_task_waiters.unregister(psu.id, loop, event)
+
+    return await sync_to_async(v.transmit_watering_task)(request, psu)
+
+
+@async_post_view
+async def wait_for_watering_task(request):
+    """
+    async long-poll version of get_watering_task
+    the request is held open until a WateringTask of the PSU reaches status 5 or
+    the timeout (seconds given by the PSU, at most PSU_LONG_POLL_TIMEOUT) is reached
+    """
+    if request.POST:
+        return await run_authenticated(request, wait_n_transmit_watering_task)
+    else:
+        # return bad request type
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
+
+
+@async_post_view
+async def mark_watering_task_executed(request):
+    """
+    async view to handle the information of a psu that the watering task was executed
+    """
+    if request.POST:
+        return await run_authenticated(request, v.mark_watering_task)
+    else:
+        # return bad request type
+        return await respond_n_log(request, v.json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
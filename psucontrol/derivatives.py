@@ -0,0 +1,136 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from django.conf import settings
+from PIL import Image
+
+from psucontrol import metrics
+
+
+# Derivatives (smaller versions) of the PSUImages
+# they are stored next to the originals in SECURE_MEDIA_STORAGE under
+# derivatives/<size>/<name of the original without extension>.<extension of the format>
+
+# extensions of the formats used for derivatives
+FORMAT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'WEBP': '.webp',
+}
+
+
+def derivative_name(name, size):
+    """
+    returns: name of the derivative of the image name in size (key of PSU_IMAGE_DERIVATIVES)
+    """
+    return 'derivatives/{}/{}{}'.format(size, os.path.splitext(name)[0], FORMAT_EXTENSIONS[settings.PSU_IMAGE_DERIVATIVES[size]['format']])
+
+
+def create_derivative(name, size):
+    """
+    creates the derivative of the image name in size (key of PSU_IMAGE_DERIVATIVES)
+    the file is written to a temporary file first, so concurrent calls never see an incomplete derivative
+    returns: name of the derivative
+    """
+    options = settings.PSU_IMAGE_DERIVATIVES[size]
+    target = settings.SECURE_MEDIA_STORAGE.path(derivative_name(name, size))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    with Image.open(settings.SECURE_MEDIA_STORAGE.path(name)) as img:
+        img.thumbnail((options['size'], options['size']))
+        if options['format'] == 'JPEG' and img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(f, options['format'], quality=options.get('quality', 80))
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, target)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    return derivative_name(name, size)
+
+
+def delete_derivatives(name):
+    """
+    deletes all derivatives of the image name
+    """
+    for size in settings.PSU_IMAGE_DERIVATIVES:
+        path = settings.SECURE_MEDIA_STORAGE.path(derivative_name(name, size))
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def create_derivatives(name):
+    """
+    creates all derivatives of the image name
+    failures are only printed, missing derivatives are created on request by website.securemedia.psufeed_handler
+    """
+    for size in settings.PSU_IMAGE_DERIVATIVES:
+        try:
+            create_derivative(name, size)
+        except Exception as e:
+            # original removed in the meantime or broken image -> try again on request
+            print('Failed to create derivative {} of {}: {}'.format(size, name, e))
+
+
+class DerivativesPool:
+    """
+    class creating the derivatives of new PSUImages in PSU_IMAGE_DERIVATIVES_WORKERS threads
+    instead of one thread per image, at most PSU_IMAGE_DERIVATIVES_QUEUE_SIZE images wait for a worker
+    and further images are dropped (their derivatives are created on request)
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # created on the first image to read the settings
+        self.executor = None
+        # names of the waiting and running images
+        self.pending = set()
+
+    def submit(self, name):
+        """
+        requests the derivatives of the image name
+        returns: bool whether the image was queued (False if the queue is full)
+        """
+        with self.lock:
+            if name in self.pending:
+                return True
+            queued = len(self.pending) < settings.PSU_IMAGE_DERIVATIVES_QUEUE_SIZE
+            if queued:
+                self.pending.add(name)
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=settings.PSU_IMAGE_DERIVATIVES_WORKERS, thread_name_prefix='derivatives')
+                self.executor.submit(self.run, name)
+            depth = len(self.pending)
+
+        if not queued:
+            metrics.inc('psucontrol_image_derivatives_dropped_total')
+        metrics.set_gauge('psucontrol_image_derivatives_queue_depth', depth)
+        return queued
+
+    def run(self, name):
+        """
+        creates the derivatives of an image in a worker thread
+        """
+        try:
+            self.create(name)
+        finally:
+            with self.lock:
+                self.pending.discard(name)
+                depth = len(self.pending)
+            metrics.set_gauge('psucontrol_image_derivatives_queue_depth', depth)
+
+    def create(self, name):
+        """
+        creates the derivatives of an image
+        """
+        create_derivatives(name)
+
+
+derivatives_pool = DerivativesPool()
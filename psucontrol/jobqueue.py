@@ -0,0 +1,85 @@
+from datetime import timedelta
+from secrets import token_hex
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from psucontrol.models import WateringJob
+
+
+# Durable queue of the watering calculations processed by the command wateringworker
+# every PSU has at most one WateringJob, so requests arriving while a job waits are coalesced
+# a worker claims a batch of jobs by setting locked_until and its lock_token:
+#   PostgreSQL: the candidates are selected with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent
+#               workers get different jobs without waiting for each other
+#   SQLite:     FOR UPDATE is not supported, the conditional UPDATE of locked_until and lock_token
+#               makes sure that a job is claimed by only one worker
+# jobs of crashed workers are visible again after PSU_WATERING_JOB_VISIBILITY_TIMEOUT seconds
+# every claim counts as attempt, so jobs crashing their workers are given up after PSU_WATERING_JOB_MAX_ATTEMPTS
+
+
+def enqueue_watering_job(psu):
+    """
+    function to request a watering calculation of a psu
+    """
+    # a new request resets the attempts of a failed job
+    if WateringJob.objects.filter(psu=psu).update(requested=timezone.now(), attempts=0) == 0:
+        # no job yet, a job created concurrently is fine as well
+        WateringJob.objects.bulk_create([WateringJob(psu=psu)], ignore_conflicts=True)
+
+
+def claimable_jobs(now):
+    """
+    returns: QuerySet of the jobs which are not locked and have attempts left
+    """
+    return WateringJob.objects.filter(Q(locked_until__isnull=True) | Q(locked_until__lte=now),
+                                      attempts__lt=settings.PSU_WATERING_JOB_MAX_ATTEMPTS)
+
+
+def claim_watering_jobs(batch_size):
+    """
+    function to claim up to batch_size jobs for the current worker
+    returns: list of claimed WateringJobs with their PSUs
+    """
+    now = timezone.now()
+    token = token_hex(16)
+    with transaction.atomic():
+        ids = list(claimable_jobs(now).select_for_update(skip_locked=True).order_by('requested')
+                   .values_list('id', flat=True)[:batch_size])
+        if len(ids) == 0:
+            return []
+        # conditional update in case another worker claimed a job in the meantime (no row locks on SQLite)
+        claimable_jobs(now).filter(id__in=ids).update(
+            locked_until=now + timedelta(seconds=settings.PSU_WATERING_JOB_VISIBILITY_TIMEOUT), lock_token=token,
+            attempts=F('attempts') + 1)
+
+    return list(WateringJob.objects.filter(lock_token=token).select_related('psu', 'psu__watering_params'))
+
+
+def complete_watering_job(job):
+    """
+    function to delete a job after a successful calculation
+    a job requested again during the calculation is released to run once more
+    """
+    if WateringJob.objects.filter(id=job.id, lock_token=job.lock_token, requested__lte=job.requested).delete()[0] == 0:
+        release_watering_job(job)
+
+
+def release_watering_job(job):
+    """
+    function to make a claimed job available again immediately (e.g. when a worker stops)
+    """
+    WateringJob.objects.filter(id=job.id, lock_token=job.lock_token).update(locked_until=None, lock_token='')
+
+
+def fail_watering_job(job, error):
+    """
+    function to store the error of a failed calculation and to delay the next attempt
+    the delay grows with every attempt, jobs without attempts left stay for inspection in the admin
+    """
+    WateringJob.objects.filter(id=job.id, lock_token=job.lock_token).update(
+        last_error=str(error),
+        locked_until=timezone.now() + timedelta(seconds=settings.PSU_WATERING_JOB_RETRY_DELAY * job.attempts),
+        lock_token='')
@@ -0,0 +1,118 @@
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+from django.conf import settings
+from cryptography.hazmat.primitives import serialization
+
+
+def pem_digest(pem):
+    """
+    returns: SHA-256 hex digest of a PEM string
+    """
+    return sha256(bytes(pem, 'utf-8')).hexdigest()
+
+
+class PublicKeyCache:
+    """
+    process wide LRU cache holding the deserialized public keys of the PSUs
+    entries are identified by the id of the PSU and the hash of the PEM, so an outdated entry is never
+    used after a key change even if the invalidation signal was handled by another process
+    keys loaded during the registration are stored without id and handed over on first use
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # (psu id, pem digest) -> public key object
+        self.entries = OrderedDict()
+        # psu id -> pem digest to find the entries of a psu
+        self.digests = dict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, psu_id, digest, public_key):
+        """
+        stores an entry and removes the least recently used ones if the cache is full
+        the lock has to be held by the caller
+        """
+        if psu_id is not None:
+            old_digest = self.digests.get(psu_id)
+            if old_digest is not None and old_digest != digest:
+                self.entries.pop((psu_id, old_digest), None)
+            self.digests[psu_id] = digest
+
+        self.entries[(psu_id, digest)] = public_key
+        self.entries.move_to_end((psu_id, digest))
+
+        while len(self.entries) > self.max_size:
+            (old_id, old_digest), _ = self.entries.popitem(last=False)
+            if old_id is not None and self.digests.get(old_id) == old_digest:
+                del self.digests[old_id]
+
+    def add(self, psu_id, pem, public_key):
+        """
+        adds an already deserialized public key to the cache
+        psu_id might be None if the key does not belong to a PSU yet
+        """
+        with self.lock:
+            self._store(psu_id, pem_digest(pem), public_key)
+
+    def load(self, psu_id, pem):
+        """
+        returns: deserialized public key for the given PSU id and PEM
+        raises ValueError if the PEM can not be deserialized
+        """
+        digest = pem_digest(pem)
+
+        with self.lock:
+            public_key = self.entries.get((psu_id, digest))
+            if public_key is None:
+                # key might have been loaded during the registration of the PSU
+                public_key = self.entries.pop((None, digest), None)
+                if public_key is not None:
+                    self._store(psu_id, digest, public_key)
+            else:
+                self.entries.move_to_end((psu_id, digest))
+
+            if public_key is not None:
+                self.hits += 1
+                return public_key
+            self.misses += 1
+
+        # deserialize outside the lock
+        public_key = serialization.load_pem_public_key(bytes(pem, 'utf-8'))
+        self.add(psu_id, pem, public_key)
+        return public_key
+
+    def invalidate(self, psu_id, pem=None):
+        """
+        removes the cached key of a PSU
+        if pem is given the entry is only removed if it does not belong to this PEM
+        """
+        with self.lock:
+            digest = self.digests.get(psu_id)
+            if digest is None or (pem is not None and digest == pem_digest(pem)):
+                return
+            del self.digests[psu_id]
+            self.entries.pop((psu_id, digest), None)
+
+    def clear(self):
+        """
+        removes all entries and resets the counters
+        """
+        with self.lock:
+            self.entries.clear()
+            self.digests.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        returns: dict with the hit and miss counters and the current size of the cache
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'max_size': self.max_size}
+
+
+public_key_cache = PublicKeyCache(settings.PSU_PUBLIC_KEY_CACHE_SIZE)
@@ -0,0 +1,147 @@
+import atexit
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from psucontrol.models import CommunicationLogEntry
+
+
+class CommunicationLogWriter(Thread):
+    """
+    class to write CommunicationLogEntries in the background with bulk inserts
+    the thread is started with the first entry and flushes the remaining entries when the process exits
+    if the queue is full entries below PSU_LOG_DROP_BELOW_LEVEL are dropped, all others wait for
+    PSU_LOG_BLOCK_TIMEOUT seconds and are written synchronously if there is still no space
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.name = "Communication Log Writer"
+        self.queue = Queue(maxsize=settings.PSU_LOG_QUEUE_SIZE)
+        self.lock = Lock()
+        self.started = False
+        self.stopping = False
+        # counters for monitoring purposes
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def add(self, entry):
+        """
+        function to hand over a new (unsaved) CommunicationLogEntry
+        """
+        with self.lock:
+            if not self.started and not self.stopping:
+                self.started = True
+                self.start()
+                atexit.register(self.stop)
+            direct = self.stopping or not self.is_alive()
+
+        if direct:
+            # process is shutting down -> write directly
+            entry.save()
+            return
+
+        try:
+            self.queue.put_nowait(entry)
+            return
+        except Full:
+            pass
+
+        if entry.level < settings.PSU_LOG_DROP_BELOW_LEVEL:
+            # unimportant entry -> drop it instead of slowing down the request
+            with self.lock:
+                self.dropped += 1
+            return
+
+        try:
+            self.queue.put(entry, timeout=settings.PSU_LOG_BLOCK_TIMEOUT)
+        except Full:
+            # do not lose important entries
+            entry.save()
+
+    def flush(self, entries):
+        """
+        function to write the given entries to the database
+        """
+        written = 0
+        try:
+            with transaction.atomic():
+                CommunicationLogEntry.objects.bulk_create(entries)
+            written = len(entries)
+        except Exception:
+            # e.g. PSU deleted in the meantime -> save entries one by one and skip broken ones
+            for e in entries:
+                try:
+                    e.save()
+                    written += 1
+                except Exception:
+                    pass
+
+        with self.lock:
+            self.written += written
+            self.dropped += len(entries) - written
+            self.flushes += 1
+
+    def run(self):
+        """
+        this method is called when starting the thread
+        collects entries until PSU_LOG_FLUSH_SIZE or PSU_LOG_FLUSH_INTERVAL is reached
+        """
+        running = True
+        while running:
+            entries = []
+            deadline = monotonic() + settings.PSU_LOG_FLUSH_INTERVAL
+            while len(entries) < settings.PSU_LOG_FLUSH_SIZE:
+                try:
+                    entry = self.queue.get(timeout=max(deadline - monotonic(), 0))
+                except Empty:
+                    break
+                if entry is None:
+                    # stop signal
+                    running = False
+                    break
+                entries.append(entry)
+
+            if len(entries) != 0:
+                self.flush(entries)
+
+        connection.close()
+
+    def stop(self):
+        """
+        function to flush all remaining entries and stop the thread
+        """
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+        # entries added while stopping
+        entries = []
+        while True:
+            try:
+                entry = self.queue.get_nowait()
+            except Empty:
+                break
+            if entry is not None:
+                entries.append(entry)
+        if len(entries) != 0:
+            self.flush(entries)
+
+    def stats(self):
+        """
+        returns: dict with the counters and the current queue size
+        """
+        with self.lock:
+            return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped, 'flushes': self.flushes}
+
+
+communication_log_writer = CommunicationLogWriter()
@@ -0,0 +1,50 @@
+from threading import Lock
+
+
+class WateringTaskWaiters:
+    """
+    process wide registry of the requests waiting for a WateringTask (see psucontrol.async_views.wait_for_watering_task)
+    every waiting request registers an asyncio.Event which is set from any thread of the process
+    when a WateringTask of its PSU reaches status 5, tasks saved by other processes are only
+    found by the periodic check of the waiting requests (PSU_LONG_POLL_INTERVAL)
+    """
+
+    def __init__(self):
+        # psu id -> set of (event loop, event)
+        self.waiters = dict()
+        self.lock = Lock()
+
+    def register(self, psu_id, loop, event):
+        """
+        registers the event of a request waiting in loop for a task of the psu
+        """
+        with self.lock:
+            self.waiters.setdefault(psu_id, set()).add((loop, event))
+
+    def unregister(self, psu_id, loop, event):
+        """
+        removes a registered event
+        """
+        with self.lock:
+            waiters = self.waiters.get(psu_id)
+            if waiters is not None:
+                waiters.discard((loop, event))
+                if not waiters:
+                    del self.waiters[psu_id]
+
+    def notify(self, psu_id):
+        """
+        wakes up all requests of this process waiting for a task of the psu
+        """
+        with self.lock:
+            waiters = list(self.waiters.get(psu_id, ()))
+        for loop, event in waiters:
+            try:
+                # events are not thread-safe, so they are set in their own loop
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # loop already closed
+                pass
+
+
+watering_task_waiters = WateringTaskWaiters()
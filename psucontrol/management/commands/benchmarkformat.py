@@ -0,0 +1,82 @@
+from django.core.management.base import BaseCommand
+from django.http import QueryDict
+from django.utils import timezone
+
+import json
+from datetime import timedelta
+from random import random
+from time import perf_counter
+from urllib.parse import urlencode
+
+from psucontrol.measurementformat import CHANNELS, encode_measurements, decode_measurements
+from psucontrol.views import none_or_float, parse_timestamp
+
+
+class Command(BaseCommand):
+    """
+    command to compare the form encoded and the compact binary format of DataMeasurements
+    """
+    help = 'Compare parse throughput and size of the measurement formats'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=1000,
+                            help='Number of measurements per request. Defaults to 1000.')
+        parser.add_argument('-r', '--repeat', type=int, default=20,
+                            help='Number of times every format is parsed. Defaults to 20.')
+
+    def run(self, name, size, parse, options):
+        """
+        parses the data of a format options['repeat'] times and prints the results
+        """
+        start = perf_counter()
+        for i in range(options['repeat']):
+            parse()
+        duration = perf_counter() - start
+
+        count = options['number'] * options['repeat']
+        self.stdout.write('{:<8} {:>10} bytes {:>10.1f} bytes/measurement {:>12.0f} measurements/s'.format(
+            name, size, size / options['number'], count / duration))
+
+    def handle(self, *args, **options):
+
+        # create random measurements with some missing values
+        now = timezone.now().replace(microsecond=0)
+        measurements = []
+        for i in range(options['number']):
+            m = {'timestamp': now - timedelta(minutes=15 * i)}
+            for c in CHANNELS:
+                m[c] = None if random() < 0.1 else round(random() * 100, 2)
+            measurements.append(m)
+
+        # form encoding of single requests to add_data_measurement
+        forms = []
+        for m in measurements:
+            fields = {c: '' if m[c] is None else str(m[c]) for c in CHANNELS}
+            fields['timestamp'] = timezone.localtime(m['timestamp']).strftime('%Y-%m-%d_%H-%M-%S')
+            forms.append(urlencode(fields))
+
+        def parse_forms():
+            for f in forms:
+                q = QueryDict(f)
+                parse_timestamp(q['timestamp'])
+                for c in CHANNELS:
+                    none_or_float(q[c])
+
+        # JSON list of a request to add_data_measurements
+        batch = urlencode({'measurements': json.dumps([
+            dict({c: m[c] for c in CHANNELS}, timestamp=timezone.localtime(m['timestamp']).strftime('%Y-%m-%d_%H-%M-%S'))
+            for m in measurements])})
+
+        def parse_json():
+            for m in json.loads(QueryDict(batch)['measurements']):
+                parse_timestamp(m['timestamp'])
+                for c in CHANNELS:
+                    none_or_float(m.get(c))
+
+        # compact binary format
+        binary = encode_measurements(measurements)
+
+        self.stdout.write('Parsing {} measurements {} times'.format(options['number'], options['repeat']))
+        self.run('form', sum(len(f) for f in forms), parse_forms, options)
+        self.run('json', len(batch), parse_json, options)
+        self.run('binary', len(binary), lambda: decode_measurements(binary), options)
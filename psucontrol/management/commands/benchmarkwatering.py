@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from datetime import timedelta
+from secrets import token_urlsafe
+from time import perf_counter
+
+from psucontrol.models import PSU, DataMeasurement, PSUState, WateringParams, WateringTask
+from psucontrol.watering import CalculateWatering
+from website.utils import get_test_user
+
+
+class Command(BaseCommand):
+    """
+    command to measure the cost of a watering calculation for growing histories of DataMeasurements
+    all data is created in a transaction which is rolled back at the end
+    """
+    help = 'Measure the duration and the queries of a watering calculation for growing histories'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 70000],
+                            help='Numbers of DataMeasurements in the history. Defaults to 1000 10000 70000 (two years of 15 minute data).')
+        parser.add_argument('-r', '--repeat', type=int, default=50,
+                            help='Number of calculations per history size. Defaults to 50.')
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+
+        params = WateringParams.objects.create(name='BENCHMARK', kp=1, ki=0, kd=0, dt=1)
+        psu = PSU.objects.create(name='BENCHMARK', identity_key=token_urlsafe(96), public_rsa_key=token_urlsafe(96),
+                                 owner=get_test_user(), watering_params=params)
+
+        # last watering 12 hours ago, the ground humidity rose afterwards
+        now = timezone.now()
+        execution = now - timedelta(hours=12)
+        WateringTask.objects.create(psu=psu, amount=50, status=20, timestamp_execution=execution)
+
+        self.stdout.write('{:>10} {:>12} {:>10}'.format('history', 'ms/calc', 'queries'))
+        created = 0
+        for size in sorted(options['sizes']):
+            # add older measurements until the history has size entries
+            DataMeasurement.objects.bulk_create([
+                DataMeasurement(psu=psu, timestamp=now - timedelta(minutes=15 * i), brightness=50,
+                                ground_humidity=60 if now - timedelta(minutes=15 * i) > execution else 50)
+                for i in range(created, size)], batch_size=1000)
+            created = size
+            # bulk_create does not update the state
+            PSUState.rebuild(psu)
+
+            with CaptureQueriesContext(connection) as queries:
+                start = perf_counter()
+                for i in range(options['repeat']):
+                    CalculateWatering(psu).crunch_data_dry()
+                duration = perf_counter() - start
+
+            self.stdout.write('{:>10} {:>12.3f} {:>10.1f}'.format(size, duration / options['repeat'] * 1000, len(queries) / options['repeat']))
+
+        # remove the benchmark data
+        transaction.set_rollback(True)
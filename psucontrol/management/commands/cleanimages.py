@@ -0,0 +1,76 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from psucontrol.derivatives import delete_derivatives
+from psucontrol.models import PSUImage
+from psucontrol.timelapse import delete_segments
+from psucontrol.utils import get_timedelta
+
+
+class Command(BaseCommand):
+    """
+    command to delete PSUImages older than a given lease time
+    the images are deleted in chunks of bounded size without loading all images at once
+    """
+    help = 'Delete PSUImages older than a given lease time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('lease', type=str,
+                            help='Lease time in format [num days]d[num hours]h[num minutes]m[num seconds]s.')
+        parser.add_argument('-p', '--PSU', type=int, help='ID of the PSU whose images should be deleted. Defaults to all PSUs.')
+        parser.add_argument('-c', '--chunk', type=int, default=500, help='Number of images deleted at once. Defaults to 500.')
+
+    def delete_chunk(self, ids):
+        """
+        deletes the PSUImages with the given ids
+        the rows are deleted with one query without the signals of every image, so the files and
+        derivatives which are not used by other PSUImages are removed here afterwards
+        returns: number of deleted files
+        """
+        with transaction.atomic():
+            names = set(PSUImage.objects.filter(id__in=ids).values_list('image', flat=True))
+            # _raw_delete does not run the collector, so references to deleted images are set to NULL here (models.SET_NULL)
+            PSUImage.objects.filter(reference__in=ids).exclude(id__in=ids).update(reference=None)
+            PSUImage.objects.filter(id__in=ids)._raw_delete(PSUImage.objects.db)
+            # files still used by other PSUImages (see PSUImage.reference) are kept
+            names -= set(PSUImage.objects.filter(image__in=names).values_list('image', flat=True))
+
+        # remove the files of the chunk after the rows are gone
+        for name in names:
+            try:
+                os.remove(settings.SECURE_MEDIA_STORAGE.path(name))
+            except FileNotFoundError:
+                pass
+            delete_derivatives(name)
+        return len(names)
+
+    def handle(self, *args, **options):
+
+        lease = get_timedelta(options['lease'])
+        if lease is None:
+            raise CommandError('Invalid lease time {}.'.format(options['lease']))
+
+        images = PSUImage.objects.filter(timestamp__lt=timezone.now() - lease)
+        if options['PSU']:
+            images = images.filter(psu_id=options['PSU'])
+
+        self.stdout.write('Lease time of images: {}'.format(str(lease)))
+
+        rm = 0
+        files = 0
+        while True:
+            ids = list(images.order_by('id').values_list('id', flat=True)[:options['chunk']])
+            if len(ids) == 0:
+                break
+            files += self.delete_chunk(ids)
+            rm += len(ids)
+
+        self.stdout.write('Removed {} images and {} files.'.format(str(rm), str(files)))
+
+        # cached time-lapse segments of the days without images
+        segments = delete_segments(timezone.localtime(timezone.now() - lease).date(), options['PSU'])
+        self.stdout.write('Removed {} time-lapse segments.'.format(segments))
@@ -5,7 +5,7 @@ from django.utils import timezone
 from datetime import timedelta
 import re
 
-from psucontrol.models import CommunicationLogEntry
+from psucontrol.models import CommunicationLogEntry, UsedChallenge
 
 def get_timedelta(string):
     """
@@ -61,3 +61,7 @@ class Command(BaseCommand):
                 rm += 1
         
         self.stdout.write('Removed {} log entries.'.format(str(rm)))
+
+        # used stateless challenges are only needed until they expire
+        rm = UsedChallenge.objects.filter(expiry__lt=timezone.now()).delete()[0]
+        self.stdout.write('Removed {} expired challenges.'.format(str(rm)))
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+import os
+
+from psucontrol.models import PSU, PSUImage
+
+
+def format_size(size):
+    """
+    returns: size in bytes as human readable string
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TiB'.format(size)
+
+
+class Command(BaseCommand):
+    """
+    command to report the storage used by PSUImages and the storage saved by the deduplication
+    """
+    help = 'Report the storage used and saved by the deduplication of PSUImages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--PSU', type=int, help='ID of the PSU to report. Defaults to all PSUs.')
+
+    def handle(self, *args, **options):
+
+        psus = PSU.objects.all()
+        if options['PSU']:
+            psus = psus.filter(id=options['PSU'])
+
+        total_used = 0
+        total_saved = 0
+        for psu in psus:
+            images = 0
+            files = 0
+            used = 0
+            saved = 0
+            # every file is stored once, but might be used by several PSUImages
+            for f in PSUImage.objects.filter(psu=psu).order_by().values('image').annotate(count=Count('id')):
+                path = settings.SECURE_MEDIA_STORAGE.path(f['image'])
+                size = os.path.getsize(path) if os.path.isfile(path) else 0
+                images += f['count']
+                files += 1
+                used += size
+                saved += size * (f['count'] - 1)
+
+            self.stdout.write('{} - {} images, {} files, {} used, {} saved (dedup distance {})'.format(
+                str(psu), images, files, format_size(used), format_size(saved),
+                'disabled' if psu.image_dedup_distance is None else psu.image_dedup_distance))
+            total_used += used
+            total_saved += saved
+
+        self.stdout.write(self.style.SUCCESS('Total: {} used, {} saved.'.format(format_size(total_used), format_size(total_saved))))
@@ -0,0 +1,307 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.utils import timezone
+
+import base64
+import json
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO
+from random import random, randint
+from threading import Lock
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from PIL import Image
+
+from psucontrol.models import PSU, PendingPSU, WateringParams
+from website.utils import get_test_user
+
+
+# name of the PSUs created by this command (the number of the simulated PSU is inserted)
+PSU_NAME = 'LOADTEST {}'
+
+
+class LocalTransport:
+    """
+    class sending the requests to the views of this process with the test client of django
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.client = Client()
+
+    def post(self, endpoint, data, files=None):
+        """
+        returns: tuple of the HTTP status and the decoded JSON response
+        """
+        response = self.client.post(self.prefix + endpoint, dict(data, **(files or {})))
+        return response.status_code, json.loads(response.content)
+
+
+class HTTPTransport:
+    """
+    class sending the requests to a running server
+    """
+
+    def __init__(self, url, prefix):
+        self.url = url.rstrip('/') + prefix
+
+    def post(self, endpoint, data, files=None):
+        """
+        returns: tuple of the HTTP status and the decoded JSON response
+        """
+        if files:
+            # multipart/form-data for uploads
+            boundary = uuid.uuid4().hex
+            body = BytesIO()
+            for name, value in data.items():
+                body.write('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value).encode())
+            for name, file in files.items():
+                body.write('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\nContent-Type: application/octet-stream\r\n\r\n'.format(
+                    boundary, name, file.name).encode())
+                body.write(file.getvalue())
+                body.write(b'\r\n')
+            body.write('--{}--\r\n'.format(boundary).encode())
+            request = Request(self.url + endpoint, body.getvalue(), {'Content-Type': 'multipart/form-data; boundary=' + boundary})
+        else:
+            request = Request(self.url + endpoint, urlencode(data).encode(), {'Content-Type': 'application/x-www-form-urlencoded'})
+
+        try:
+            with urlopen(request, timeout=120) as response:
+                return response.status, json.loads(response.read())
+        except HTTPError as e:
+            # e.g. 429 of psucontrol.ratelimit
+            try:
+                return e.code, json.loads(e.read())
+            except ValueError:
+                return e.code, {}
+
+
+class Statistics:
+    """
+    class collecting the latencies and results of the requests of all simulated PSUs
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # endpoint: list of latencies in seconds
+        self.latencies = defaultdict(list)
+        # (endpoint, result): count, result is ok, the error code or the HTTP status
+        self.results = Counter()
+
+    def add(self, endpoint, latency, result):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.results[(endpoint, result)] += 1
+
+
+def percentile(values, p):
+    """
+    returns: p-th percentile (nearest rank) of the sorted list values
+    """
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+class SimulatedPSU:
+    """
+    class speaking the protocol of a PSU
+    """
+
+    def __init__(self, number, transport, stats, options):
+        self.number = number
+        self.transport = transport
+        self.stats = stats
+        self.options = options
+        self.identity_key = None
+        # id of the PSU in the database
+        self.psu_id = None
+
+    def post(self, endpoint, data, files=None):
+        """
+        sends a request and records its latency and result
+        returns: decoded JSON response or None if the request failed
+        """
+        start = perf_counter()
+        try:
+            status, res = self.transport.post(endpoint, data, files)
+        except Exception as e:
+            self.stats.add(endpoint, perf_counter() - start, type(e).__name__)
+            return None
+        latency = perf_counter() - start
+
+        if res.get('status') == 'ok':
+            result = 'ok'
+        else:
+            result = res.get('error_code', 'HTTP {}'.format(status))
+        self.stats.add(endpoint, latency, result)
+        return res
+
+    def sign(self, challenge):
+        signed = self.private_key.sign(bytes(challenge, 'utf-8'),
+                                       padding.PSS(
+                                           mgf=padding.MGF1(hashes.SHA256()),
+                                           salt_length=padding.PSS.MAX_LENGTH),
+                                       hashes.SHA256())
+        return str(base64.urlsafe_b64encode(signed), 'utf-8')
+
+    def authenticated_post(self, endpoint, data, files=None):
+        """
+        requests a challenge and sends the request with the signed challenge
+        returns: decoded JSON response or None if the request failed
+        """
+        res = self.post('get_challenge', {'identity_key': self.identity_key})
+        if res is None or res.get('status') != 'ok':
+            return None
+        data = dict(data, identity_key=self.identity_key, signed_challenge=self.sign(res['challenge']))
+        return self.post(endpoint, data, files)
+
+    def register(self):
+        """
+        registers the PSU and pairs it in the database like psufrontend.views.register_psu_view
+        returns: bool whether the PSU is paired
+        """
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=self.options['key_size'])
+        public_key = self.private_key.public_key().public_bytes(encoding=serialization.Encoding.PEM,
+                                                                format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        res = self.post('register_new_psu', {'public_rsa_key': str(public_key, 'utf-8')})
+        if res is None or res.get('status') != 'ok':
+            return False
+
+        pending_psu = PendingPSU.objects.get(pairing_key=res['pairing_key'])
+        self.psu_id = PSU.objects.create(name=PSU_NAME.format(self.number), identity_key=pending_psu.identity_key,
+                                         public_rsa_key=pending_psu.public_rsa_key, owner=get_test_user(),
+                                         watering_params=WateringParams.objects.first(), unauthorized_watering=True).id
+        pending_psu.delete()
+        self.identity_key = res['identity_key']
+        return True
+
+    def image(self, cycle):
+        """
+        returns: JPEG file which differs in every cycle (identical images are rejected)
+        """
+        img = Image.new('RGB', (self.options['image_width'], self.options['image_height']), (randint(0, 255), randint(0, 255), randint(0, 255)))
+        img.putpixel((cycle % img.width, 0), (255, 255, 255))
+        f = BytesIO()
+        img.save(f, 'JPEG', quality=85)
+        f.name = 'image.jpg'
+        f.seek(0)
+        return f
+
+    def run(self):
+        """
+        registers the PSU and runs the cycles
+        """
+        if not self.register():
+            return
+
+        # timestamps of the cycles in the past, one every 15 minutes
+        start = timezone.localtime() - timedelta(minutes=15 * self.options['cycles'])
+        for cycle in range(self.options['cycles']):
+            timestamp = (start + timedelta(minutes=15 * cycle)).strftime('%Y-%m-%d_%H-%M-%S')
+
+            self.authenticated_post('add_data_measurement', {
+                'timestamp': timestamp,
+                'temperature': round(15 + random() * 10, 1),
+                'air_humidity': round(40 + random() * 40, 1),
+                'ground_humidity': round(random() * 100, 1),
+                'brightness': round(random() * 100, 1),
+                'fill_level': round(random() * 100, 1),
+            })
+
+            if self.options['image_every'] and cycle % self.options['image_every'] == 0:
+                self.authenticated_post('add_image', {'timestamp': timestamp}, {'image': self.image(cycle)})
+
+            res = self.authenticated_post('get_watering_task', {})
+            if res is not None and res.get('status') == 'ok':
+                self.authenticated_post('mark_watering_task_executed', {'watering_task_id': res['watering_task_id']})
+
+
+class Command(BaseCommand):
+    """
+    command to simulate a fleet of PSUs to measure the performance of the views of psucontrol
+    the PSUs are paired in the database of the settings, so for a live URL the command has to run with the
+    settings (database) of that server
+    """
+    help = 'Simulate PSUs concurrently and report throughput, latencies and error codes per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--number', type=int, default=10, help='Number of simulated PSUs. Defaults to 10.')
+        parser.add_argument('-c', '--cycles', type=int, default=10,
+                            help='Number of measurement cycles of every PSU. Defaults to 10.')
+        parser.add_argument('-w', '--workers', type=int, default=20,
+                            help='Number of PSUs running concurrently. Defaults to 20.')
+        parser.add_argument('-u', '--url', help='Base URL of a running server, e.g. https://example.com. '
+                                                'Defaults to sending the requests to this process.')
+        parser.add_argument('-i', '--image-every', type=int, default=0,
+                            help='Send an image every this number of cycles. Defaults to 0 (no images).')
+        parser.add_argument('--image-width', type=int, default=640, help='Width of the images. Defaults to 640.')
+        parser.add_argument('--image-height', type=int, default=480, help='Height of the images. Defaults to 480.')
+        parser.add_argument('--key-size', type=int, default=2048, help='Size of the RSA keys. Defaults to 2048.')
+        parser.add_argument('--async', action='store_true', dest='use_async', help='Use the async views (psucontrol/async/...).')
+        parser.add_argument('--no-rate-limits', action='store_true',
+                            help='Disable PSU_RATE_LIMITS for requests to this process (all requests come from one address).')
+        parser.add_argument('--keep', action='store_true', help='Keep the simulated PSUs and their data.')
+
+    def handle(self, *args, **options):
+
+        prefix = '/psucontrol/async/' if options['use_async'] else '/psucontrol/'
+        stats = Statistics()
+
+        def transport():
+            if options['url']:
+                return HTTPTransport(options['url'], prefix)
+            return LocalTransport(prefix)
+
+        # every simulated PSU gets its own transport (the test client is not thread-safe)
+        psus = [SimulatedPSU(i, transport(), stats, options) for i in range(options['number'])]
+
+        local_settings = dict()
+        if not options['url']:
+            # host name of the test client
+            local_settings['ALLOWED_HOSTS'] = list(settings.ALLOWED_HOSTS) + ['testserver']
+            if options['no_rate_limits']:
+                local_settings['PSU_RATE_LIMITS'] = {}
+
+        start = perf_counter()
+        try:
+            with override_settings(**local_settings), ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                for f in [executor.submit(p.run) for p in psus]:
+                    f.result()
+            duration = perf_counter() - start
+        finally:
+            if not options['keep']:
+                PSU.objects.filter(id__in=[p.psu_id for p in psus]).delete()
+
+        self.report(stats, duration)
+
+    def report(self, stats, duration):
+        """
+        prints throughput, latency percentiles and results of every endpoint
+        """
+        total = sum(len(l) for l in stats.latencies.values())
+        self.stdout.write('{} requests in {:.1f} s ({:.1f} requests/s)'.format(total, duration, total / duration))
+        self.stdout.write('{:<28} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for endpoint, latencies in sorted(stats.latencies.items()):
+            latencies.sort()
+            self.stdout.write('{:<28} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                endpoint, len(latencies), len(latencies) / duration,
+                percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000))
+
+        self.stdout.write('results:')
+        for (endpoint, result), count in sorted(stats.results.items()):
+            self.stdout.write('{:<28} {:<12} {:>8}'.format(endpoint, result, count))
+
+        # no watering task available (0xW1) is a normal answer
+        errors = sum(c for (e, r), c in stats.results.items() if r not in ('ok', '0xW1'))
+        if errors == 0:
+            self.stdout.write(self.style.SUCCESS('No errors.'))
+        else:
+            self.stdout.write(self.style.WARNING('{} requests failed.'.format(errors)))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from psucontrol.models import PSU, PSUState
+
+
+class Command(BaseCommand):
+    """
+    command to rebuild the PSUStates from the DataMeasurements and WateringTasks
+    needed after changing or deleting measurements or tasks without the views (e.g. in the admin or with raw queries)
+    """
+    help = 'Rebuild the states used by the watering calculation from the stored data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--PSU', type=int, help='ID of the PSU whose state should be rebuilt. Defaults to all PSUs.')
+        parser.add_argument('-c', '--check', action='store_true', help='Only report inconsistent states without saving them.')
+
+    def handle(self, *args, **options):
+
+        psus = PSU.objects.all()
+        if options['PSU'] is not None:
+            psus = psus.filter(id=options['PSU'])
+
+        checked = 0
+        repaired = 0
+        for psu in psus.iterator():
+            with transaction.atomic():
+                # locked to not lose measurements added during the rebuild (PostgreSQL)
+                stored = PSUState.objects.select_for_update().filter(psu=psu).first()
+                state = PSUState.rebuild(psu, save=False)
+                checked += 1
+
+                differences = [f for f in PSUState.STATE_FIELDS if stored is None or getattr(stored, f) != getattr(state, f)]
+                if len(differences) == 0:
+                    continue
+
+                repaired += 1
+                self.stdout.write('{}: {}'.format(psu, 'missing' if stored is None else ', '.join(differences)))
+                if not options['check']:
+                    if stored is not None:
+                        # keep the memory of the PID controller
+                        for f in PSUState.PID_FIELDS:
+                            setattr(state, f, getattr(stored, f))
+                    state.save()
+
+        if options['check']:
+            self.stdout.write('Checked {} states, {} inconsistent.'.format(checked, repaired))
+        else:
+            self.stdout.write(self.style.SUCCESS('Checked {} states, repaired {}.'.format(checked, repaired)))
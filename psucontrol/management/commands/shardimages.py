@@ -0,0 +1,59 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import os
+
+from psucontrol.derivatives import derivative_name
+from psucontrol.models import PSUImage, upload_image_path
+
+
+def move_file(old, new):
+    """
+    moves the file old to new (both names in SECURE_MEDIA_STORAGE) if it exists
+    """
+    old_path = settings.SECURE_MEDIA_STORAGE.path(old)
+    if os.path.isfile(old_path):
+        new_path = settings.SECURE_MEDIA_STORAGE.path(new)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        os.rename(old_path, new_path)
+
+
+class Command(BaseCommand):
+    """
+    command to move PSUImages stored in the flat layout psufeed/<psu>/ to psufeed/<psu>/YYYY/MM/DD/
+    """
+    help = 'Move PSUImages to the date-sharded storage layout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--dry-run', action='store_true', help='Only print the number of images to move.')
+
+    def handle(self, *args, **options):
+
+        moved = 0
+        # the file of an image might be used by several PSUImages (see PSUImage.reference)
+        for image in PSUImage.objects.filter(reference=None).select_related('psu').iterator():
+            old = image.image.name
+            new = upload_image_path(image, old)
+            if old == new:
+                continue
+
+            if options['dry_run']:
+                moved += 1
+                continue
+
+            with transaction.atomic():
+                if PSUImage.objects.filter(image=old).update(image=new) == 0:
+                    # already moved together with another PSUImage using the same file
+                    continue
+                move_file(old, new)
+            moved += 1
+
+            # derivatives are moved as well, missing ones are created on request
+            for size in settings.PSU_IMAGE_DERIVATIVES:
+                move_file(derivative_name(old, size), derivative_name(new, size))
+
+        if options['dry_run']:
+            self.stdout.write('{} images would be moved.'.format(moved))
+        else:
+            self.stdout.write(self.style.SUCCESS('Moved {} images.'.format(moved)))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from datetime import date
+
+from psucontrol.models import PSU, PSUImage
+from psucontrol.timelapse import FORMATS, build_timelapse
+
+
+class Command(BaseCommand):
+    """
+    command to build a time-lapse of the images of a PSU
+    """
+    help = 'Build a time-lapse of the PSUImages of a PSU'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--PSU', type=int, required=True, help='ID of the PSU for which the time-lapse should be built.')
+        parser.add_argument('-s', '--start', type=date.fromisoformat,
+                            help='First day (YYYY-MM-DD) of the time-lapse. Defaults to the day of the first image.')
+        parser.add_argument('-e', '--end', type=date.fromisoformat, help='Last day (YYYY-MM-DD) of the time-lapse. Defaults to today.')
+        parser.add_argument('-f', '--format', choices=list(FORMATS), default='webp', help='Format of the time-lapse. Defaults to webp.')
+        parser.add_argument('-o', '--output', type=str, help='File to write the time-lapse to. Defaults to timelapse_<PSU><extension>.')
+
+    def handle(self, *args, **options):
+
+        # try to get the PSU specified through -p / --PSU
+        try:
+            psu = PSU.objects.get(id=options['PSU'])
+        except PSU.DoesNotExist:
+            self.stdout.write(
+                self.style.ERROR('Error: There is no PSU with the ID %s in the current database.' % options['PSU']))
+            return
+
+        start = options['start']
+        if start is None:
+            first = PSUImage.objects.filter(psu=psu).last()
+            start = timezone.localtime(first.timestamp).date() if first is not None else timezone.localdate()
+        end = options['end'] or timezone.localdate()
+
+        data = build_timelapse(psu, start, end, options['format'])
+        if data is None:
+            self.stdout.write(self.style.ERROR('Error: There are no images of the PSU between {} and {}.'.format(start, end)))
+            return
+
+        output = options['output'] or 'timelapse_{}{}'.format(psu.id, FORMATS[options['format']]['file_extension'])
+        with open(output, 'wb') as f:
+            f.write(data)
+        self.stdout.write(self.style.SUCCESS('Wrote time-lapse from {} to {} to {}.'.format(start, end, output)))
@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+import signal
+from time import sleep
+
+from psucontrol.jobqueue import claim_watering_jobs, complete_watering_job, fail_watering_job, release_watering_job
+from psucontrol.watering import CalculateWatering
+
+
+class Command(BaseCommand):
+    """
+    command to process the WateringJobs stored with PSU_WATERING_JOB_QUEUE
+    several workers can run at the same time to increase the throughput
+    """
+    help = 'Process the queued watering calculations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch', type=int, default=settings.PSU_WATERING_JOB_BATCH_SIZE,
+                            help='Number of jobs claimed at once. Defaults to PSU_WATERING_JOB_BATCH_SIZE.')
+        parser.add_argument('-o', '--once', action='store_true', help='Exit when there are no claimable jobs left.')
+
+    def stop(self, signum, frame):
+        """
+        finishes the current job and releases the other claimed jobs before exiting
+        """
+        self.stopping = True
+
+    def handle(self, *args, **options):
+
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        processed = 0
+        failed = 0
+        while not self.stopping:
+            close_old_connections()
+            jobs = claim_watering_jobs(options['batch'])
+            if len(jobs) == 0:
+                if options['once']:
+                    break
+                sleep(settings.PSU_WATERING_JOB_POLL_INTERVAL)
+                continue
+
+            for job in jobs:
+                if self.stopping:
+                    release_watering_job(job)
+                    continue
+
+                try:
+                    CalculateWatering(job.psu).run()
+                except Exception as e:
+                    fail_watering_job(job, e)
+                    failed += 1
+                    self.stdout.write(self.style.ERROR('Failed to calculate watering for {}: {}'.format(job.psu, e)))
+                else:
+                    complete_watering_job(job)
+                    processed += 1
+
+        self.stdout.write(self.style.SUCCESS('Processed {} jobs, {} failed.'.format(processed, failed)))
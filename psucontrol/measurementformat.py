@@ -0,0 +1,74 @@
+import struct
+from datetime import datetime, timezone
+
+
+# Compact binary format for DataMeasurements sent by the PSUs
+# (alternative to the form encoded fields of add_data_measurement and add_data_measurements)
+#
+# version 1:
+#   header  uint8    version of the format
+#   records uint32   timestamp (seconds since epoch, UTC)
+#           uint8    null bitmap (bit i set -> CHANNELS[i] has no value)
+#           float32  one value for every channel in the order of CHANNELS
+# all numbers are little endian, the number of records follows from the length
+
+FORMAT_VERSION = 1
+
+CHANNELS = ['temperature', 'air_humidity', 'ground_humidity', 'brightness', 'fill_level']
+
+HEADER = struct.Struct('<B')
+RECORD = struct.Struct('<IB' + 'f' * len(CHANNELS))
+
+
+class MeasurementFormatError(ValueError):
+    """
+    raised if data is not in a known version of the compact binary format
+    """
+    pass
+
+
+def encoded_size(count):
+    """
+    returns: number of bytes needed for count measurements
+    """
+    return HEADER.size + count * RECORD.size
+
+
+def encode_measurements(measurements):
+    """
+    encodes measurements in the compact binary format (used by the PSUs and for testing)
+    measurements: list of dicts with an aware datetime as timestamp and the CHANNELS (missing or None if there is no value)
+    returns: bytes
+    """
+    data = bytearray(HEADER.pack(FORMAT_VERSION))
+    for m in measurements:
+        nulls = 0
+        values = []
+        for i, c in enumerate(CHANNELS):
+            if m.get(c) is None:
+                nulls |= 1 << i
+                values.append(0.0)
+            else:
+                values.append(m[c])
+        data += RECORD.pack(int(m['timestamp'].timestamp()), nulls, *values)
+    return bytes(data)
+
+
+def decode_measurements(data):
+    """
+    decodes measurements in the compact binary format
+    raises MeasurementFormatError if data is not in a known version of the format
+    returns: list of dicts with timestamp and CHANNELS (can be used as kwargs of DataMeasurement)
+    """
+    if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != FORMAT_VERSION:
+        raise MeasurementFormatError('unknown version of the measurement format')
+    if (len(data) - HEADER.size) % RECORD.size != 0:
+        raise MeasurementFormatError('incomplete measurement record')
+
+    measurements = []
+    for timestamp, nulls, *values in RECORD.iter_unpack(memoryview(data)[HEADER.size:]):
+        m = {'timestamp': datetime.fromtimestamp(timestamp, timezone.utc)}
+        for i, c in enumerate(CHANNELS):
+            m[c] = None if nulls & (1 << i) else values[i]
+        measurements.append(m)
+    return measurements
@@ -0,0 +1,396 @@
+import atexit
+import json
+import logging
+import os
+import socket
+import tempfile
+from contextlib import contextmanager
+from secrets import token_hex
+from threading import Lock
+from time import monotonic, perf_counter, time
+
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from django.utils.crypto import constant_time_compare
+from django.utils.deprecation import MiddlewareMixin
+
+
+# Metrics of the device API in the text exposition format of Prometheus
+# every process counts in memory and writes its values to its own file in PSU_METRICS_DIR
+# at most every PSU_METRICS_FLUSH_INTERVAL seconds, the view metrics adds up the files of all processes
+# (like the multiprocess mode of prometheus_client, PSU_METRICS_DIR should be emptied when deploying)
+# the files are named <host>-<pid>-<token>.json, files of dead processes of the own host are merged into
+# ARCHIVE_FILE by the view metrics: their counters and histograms are kept, their gauges are dropped
+
+logger = logging.getLogger(__name__)
+
+# file holding the counters and histograms of dead processes
+ARCHIVE_FILE = 'archive.json'
+# seconds after which the lock of a crashed merge of ARCHIVE_FILE is removed
+ARCHIVE_LOCK_TIMEOUT = 60
+
+# name: (type, help)
+METRICS = {
+    'psucontrol_requests_total': ('counter', 'Requests to the views of psucontrol by endpoint and HTTP status.'),
+    'psucontrol_errors_total': ('counter', 'Error codes returned by the views of psucontrol.'),
+    'psucontrol_request_duration_seconds': ('histogram', 'Duration of the requests to the views of psucontrol.'),
+    'psucontrol_rsa_verify_duration_seconds': ('histogram', 'Duration of the RSA signature verifications.'),
+    'psucontrol_db_write_duration_seconds': ('histogram', 'Duration of the database writes of the views of psucontrol.'),
+    'psucontrol_log_write_duration_seconds': ('histogram', 'Duration of adding communication log entries (respond_n_log).'),
+    'psucontrol_watering_calculation_duration_seconds': ('histogram', 'Duration of the watering calculations.'),
+    'psucontrol_watering_queue_depth': ('gauge', 'PSUs waiting for a watering calculation.'),
+    'psucontrol_watering_coalesced_total': ('counter', 'Watering calculations merged into a waiting one of the same PSU.'),
+}
+
+
+class MetricsRegistry:
+    """
+    class holding the counters and histograms of the current process
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        removes all values and chooses a new file (e.g. in a forked process)
+        """
+        self.pid = os.getpid()
+        self.file_name = '{}-{}-{}.json'.format(socket.gethostname(), self.pid, token_hex(4))
+        # (name, labels): value
+        self.counters = dict()
+        self.gauges = dict()
+        # (name, labels): [count of every bucket and +Inf, sum]
+        self.histograms = dict()
+        self.last_flush = monotonic()
+        # values changed since the last write, processes without values (e.g. management commands) write no file
+        self.changed = False
+
+    def inc(self, name, value=1, **labels):
+        """
+        increments the counter name with the labels
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.check_pid()
+            self.counters[key] = self.counters.get(key, 0) + value
+            self.changed = True
+        self.flush_if_due()
+
+    def set(self, name, value, **labels):
+        """
+        sets the gauge name with the labels to value
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.check_pid()
+            self.gauges[key] = value
+            self.changed = True
+        self.flush_if_due()
+
+    def observe(self, name, value, **labels):
+        """
+        adds value to the histogram name with the labels
+        """
+        key = (name, tuple(sorted(labels.items())))
+        buckets = settings.PSU_METRICS_BUCKETS
+        with self.lock:
+            self.check_pid()
+            histogram = self.histograms.setdefault(key, [0] * (len(buckets) + 2))
+            # index of the first bucket holding value (len(buckets) is +Inf)
+            index = next((i for i, b in enumerate(buckets) if value <= b), len(buckets))
+            histogram[index] += 1
+            histogram[-1] += value
+            self.changed = True
+        self.flush_if_due()
+
+    def check_pid(self):
+        """
+        drops the values inherited from the parent process (has to be called with lock)
+        """
+        if os.getpid() != self.pid:
+            self.reset()
+
+    def flush_if_due(self):
+        """
+        writes the file of this process if the last write is older than PSU_METRICS_FLUSH_INTERVAL
+        """
+        if monotonic() - self.last_flush >= settings.PSU_METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        writes the values of this process to its file in PSU_METRICS_DIR if they changed since the last write
+        """
+        with self.lock:
+            self.check_pid()
+            self.last_flush = monotonic()
+            if not self.changed:
+                return
+            self.changed = False
+            data = {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, labels, values] for (name, labels), values in self.histograms.items()],
+            }
+
+        try:
+            os.makedirs(settings.PSU_METRICS_DIR, exist_ok=True)
+            write_file(self.file_name, data)
+        except OSError as e:
+            logger.warning('Failed to write metrics: %s', e)
+
+
+registry = MetricsRegistry()
+# write the last values of exiting processes (nothing is written if no values were recorded)
+atexit.register(registry.flush)
+
+
+def inc(name, value=1, **labels):
+    """
+    increments the counter name of the registry
+    """
+    registry.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    """
+    sets the gauge name of the registry
+    """
+    registry.set(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    """
+    adds value to the histogram name of the registry
+    """
+    registry.observe(name, value, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    context manager adding its duration to the histogram name
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start, **labels)
+
+
+def endpoint_label(request):
+    """
+    returns: name of the url pattern of the request or its path if it was not resolved
+    """
+    match = getattr(request, 'resolver_match', None)
+    return request.path if match is None else match.url_name
+
+
+def process_alive(pid):
+    """
+    returns: bool whether a process with pid exists on this host
+    """
+    if os.name == 'nt':
+        # os.kill would terminate the process
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # process of another user
+        return True
+    return True
+
+
+def dead_process_file(file_name):
+    """
+    returns: bool whether file_name was written by a process of this host which does not exist anymore
+    """
+    parts = file_name[:-len('.json')].rsplit('-', 2)
+    # the pids of other hosts (e.g. containers sharing PSU_METRICS_DIR) cannot be checked
+    return len(parts) == 3 and parts[0] == socket.gethostname() and parts[1].isdigit() and not process_alive(int(parts[1]))
+
+
+def add_values(data, counters, gauges, histograms):
+    """
+    adds the values of the file content data to the dicts like in MetricsRegistry
+    """
+    for name, labels, value in data['counters']:
+        key = (name, tuple(tuple(l) for l in labels))
+        counters[key] = counters.get(key, 0) + value
+    # gauges of the running processes are added up as well (e.g. queue depths)
+    for name, labels, value in data.get('gauges', []):
+        key = (name, tuple(tuple(l) for l in labels))
+        gauges[key] = gauges.get(key, 0) + value
+    for name, labels, values in data['histograms']:
+        key = (name, tuple(tuple(l) for l in labels))
+        histogram = histograms.setdefault(key, [0] * len(values))
+        for i, v in enumerate(values[:len(histogram)]):
+            histogram[i] += v
+
+
+def write_file(file_name, data):
+    """
+    writes data as JSON to file_name in PSU_METRICS_DIR
+    the data is written to a temporary file first, so readers never see an incomplete file
+    """
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=settings.PSU_METRICS_DIR)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        # mkstemp creates the file only readable by the owner, but the view may run as another user
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, os.path.join(settings.PSU_METRICS_DIR, file_name))
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def read_file(file_name):
+    """
+    returns: content of a file in PSU_METRICS_DIR or None if it was removed in the meantime
+    """
+    try:
+        with open(os.path.join(settings.PSU_METRICS_DIR, file_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def archive_dead_files(dead):
+    """
+    merges the counters and histograms of the files of dead processes (dict file name: content) into ARCHIVE_FILE
+    and deletes the files, skipped while another process merges
+    """
+    lock = os.path.join(settings.PSU_METRICS_DIR, ARCHIVE_FILE + '.lock')
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        try:
+            if time() - os.path.getmtime(lock) > ARCHIVE_LOCK_TIMEOUT:
+                os.remove(lock)
+        except OSError:
+            pass
+        return
+    except OSError as e:
+        logger.warning('Failed to archive metrics: %s', e)
+        return
+
+    try:
+        counters = dict()
+        histograms = dict()
+        for data in [read_file(ARCHIVE_FILE) or {'counters': [], 'histograms': []}] + list(dead.values()):
+            add_values(dict(data, gauges=[]), counters, dict(), histograms)
+
+        write_file(ARCHIVE_FILE, {
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'histograms': [[name, labels, values] for (name, labels), values in histograms.items()],
+        })
+        for file_name in dead:
+            os.remove(os.path.join(settings.PSU_METRICS_DIR, file_name))
+    except OSError as e:
+        logger.warning('Failed to archive metrics: %s', e)
+    finally:
+        os.remove(lock)
+
+
+def collect():
+    """
+    adds up the files of all processes in PSU_METRICS_DIR, the gauges of dead processes are skipped
+    returns: tuple of the dicts counters, gauges and histograms like in MetricsRegistry
+    """
+    counters = dict()
+    gauges = dict()
+    histograms = dict()
+    # file name: content of the files of dead processes
+    dead = dict()
+    for file_name in os.listdir(settings.PSU_METRICS_DIR):
+        if not file_name.endswith('.json'):
+            continue
+        data = read_file(file_name)
+        if data is None:
+            # removed in the meantime
+            continue
+
+        if file_name != ARCHIVE_FILE and dead_process_file(file_name):
+            dead[file_name] = data
+            data = dict(data, gauges=[])
+        add_values(data, counters, gauges, histograms)
+
+    if len(dead) > 0:
+        archive_dead_files(dead)
+    return counters, gauges, histograms
+
+
+def format_labels(labels, **extra):
+    """
+    returns: labels in the text exposition format, e.g. {endpoint="add_image"}
+    """
+    labels = list(labels) + list(extra.items())
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels) + '}'
+
+
+def exposition(counters, gauges, histograms):
+    """
+    returns: counters, gauges and histograms in the text exposition format of Prometheus
+    """
+    buckets = settings.PSU_METRICS_BUCKETS
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+
+        if metric_type in ('counter', 'gauge'):
+            for (n, labels), value in sorted((counters if metric_type == 'counter' else gauges).items()):
+                if n == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+            continue
+
+        for (n, labels), values in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for b, count in zip(list(buckets) + ['+Inf'], values[:-1]):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=b), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), values[-1]))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_handler(request):
+    """
+    view to expose the metrics of all processes
+    access is granted to staff users and to requests with the header Authorization: Bearer <PSU_METRICS_TOKEN>
+    """
+    token = settings.PSU_METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not (request.user.is_authenticated and request.user.is_staff) and \
+            not (token and constant_time_compare(authorization, 'Bearer ' + token)):
+        # hide the endpoint
+        raise Http404()
+
+    # include the latest values of this process
+    registry.flush()
+    return HttpResponse(exposition(*collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    middleware recording the number and the duration of the requests to the views of psucontrol
+    """
+
+    def process_request(self, request):
+        request.metrics_start = perf_counter()
+
+    def process_response(self, request, response):
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.app_name == 'psucontrol' and hasattr(request, 'metrics_start'):
+            observe('psucontrol_request_duration_seconds', perf_counter() - request.metrics_start, endpoint=match.url_name)
+            inc('psucontrol_requests_total', endpoint=match.url_name, status=str(response.status_code))
+        return response
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0036_auto_20210508_1851'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='psu',
+            name='session_token_lifetime',
+            field=models.PositiveIntegerField(default=3600, help_text='Lifetime of session tokens in seconds. 0 disables the session mode.', verbose_name='session token lifetime'),
+        ),
+        migrations.AddField(
+            model_name='psu',
+            name='session_token_version',
+            field=models.PositiveIntegerField(default=0, verbose_name='session token version'),
+        ),
+    ]
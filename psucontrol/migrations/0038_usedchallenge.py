@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0037_psu_session_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UsedChallenge',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nonce', models.CharField(max_length=64, unique=True, verbose_name='nonce')),
+                ('expiry', models.DateTimeField(db_index=True, verbose_name='expiry')),
+                ('psu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='psucontrol.psu', verbose_name='Plant Supply Unit')),
+            ],
+            options={
+                'verbose_name': 'Used Challenge',
+                'verbose_name_plural': 'Used Challenges',
+                'ordering': ['-expiry'],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0038_usedchallenge'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='communicationlogentry',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='timestamp'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0039_communicationlogentry_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='psuimage',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64, verbose_name='SHA-256'),
+        ),
+    ]
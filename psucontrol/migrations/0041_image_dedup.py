@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0040_psuimage_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='psu',
+            name='image_dedup_distance',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='Maximum number of differing bits (0-64) of the perceptual hashes of two images to store only one of them. Empty disables the deduplication.', null=True, verbose_name='image deduplication distance'),
+        ),
+        migrations.AddField(
+            model_name='psuimage',
+            name='phash',
+            field=models.CharField(blank=True, max_length=16, verbose_name='perceptual hash'),
+        ),
+        migrations.AddField(
+            model_name='psuimage',
+            name='reference',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='psucontrol.psuimage', verbose_name='reference'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:32
+
+from django.db import migrations, models
+import psucontrol.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0041_image_dedup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='psuimage',
+            name='image',
+            field=models.ImageField(db_index=True, upload_to=psucontrol.models.upload_image_path, verbose_name='image'),
+        ),
+    ]
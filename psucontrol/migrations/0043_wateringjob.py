@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0042_psuimage_image_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WateringJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('requested', models.DateTimeField(default=django.utils.timezone.now, verbose_name='requested')),
+                ('locked_until', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='locked until')),
+                ('lock_token', models.CharField(blank=True, max_length=32, verbose_name='lock token')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('psu', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='psucontrol.psu', verbose_name='Plant Supply Unit')),
+            ],
+            options={
+                'verbose_name': 'Watering Job',
+                'verbose_name_plural': 'Watering Jobs',
+                'ordering': ['requested'],
+            },
+        ),
+    ]
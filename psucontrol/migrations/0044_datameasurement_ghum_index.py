@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0043_wateringjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='datameasurement',
+            index=models.Index(condition=models.Q(('ground_humidity__isnull', False)), fields=['psu', '-timestamp'], name='psucontrol_dm_ghum_idx'),
+        ),
+    ]
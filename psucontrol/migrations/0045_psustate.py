@@ -0,0 +1,35 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0044_datameasurement_ghum_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PSUState',
+            fields=[
+                ('psu', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='psucontrol.psu', verbose_name='Plant Supply Unit')),
+                ('latest_timestamp', models.DateTimeField(blank=True, null=True, verbose_name='newest measurement')),
+                ('current_timestamp', models.DateTimeField(blank=True, null=True, verbose_name='current timestamp')),
+                ('current_ground_humidity', models.FloatField(blank=True, null=True, verbose_name='current ground humidity')),
+                ('current_brightness', models.FloatField(blank=True, null=True, verbose_name='current brightness')),
+                ('latest_task_timestamp', models.DateTimeField(blank=True, null=True, verbose_name='newest task')),
+                ('last_execution', models.DateTimeField(blank=True, null=True, verbose_name='last execution')),
+                ('prev_timestamp', models.DateTimeField(blank=True, null=True, verbose_name='timestamp before execution')),
+                ('prev_ground_humidity', models.FloatField(blank=True, null=True, verbose_name='ground humidity before execution')),
+                ('after_timestamp', models.DateTimeField(blank=True, null=True, verbose_name='timestamp after execution')),
+                ('after_ground_humidity', models.FloatField(blank=True, null=True, verbose_name='ground humidity after execution')),
+                ('last_task', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='psucontrol.wateringtask', verbose_name='last executed task')),
+            ],
+            options={
+                'verbose_name': 'PSU State',
+                'verbose_name_plural': 'PSU States',
+            },
+        ),
+    ]
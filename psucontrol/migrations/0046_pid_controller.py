@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psucontrol', '0045_psustate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='psustate',
+            name='pid_integral',
+            field=models.FloatField(default=0, verbose_name='PID integral'),
+        ),
+        migrations.AddField(
+            model_name='psustate',
+            name='pid_previous_error',
+            field=models.FloatField(blank=True, null=True, verbose_name='PID previous error'),
+        ),
+        migrations.AddField(
+            model_name='psustate',
+            name='pid_timestamp',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='PID timestamp'),
+        ),
+        migrations.AddField(
+            model_name='wateringparams',
+            name='algorithm',
+            field=models.IntegerField(choices=[(0, 'proportional (last watering)'), (1, 'PID controller')], default=0, verbose_name='algorithm'),
+        ),
+    ]
@@ -1,11 +1,17 @@
 import os, re
+from hashlib import sha256
 
-from django.db import models
+from django.db import connections, models, router, transaction
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
 from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
 from authentication.models import User
+from psucontrol.derivatives import create_derivatives, delete_derivatives, derivatives_pool
+from psucontrol.keycache import public_key_cache
+from psucontrol.longpoll import watering_task_waiters
 
 
 # Create your models here.
@@ -15,12 +21,21 @@ class WateringParams(models.Model):
     model holding the parameters for the watering alogrithm
     enables the capability to provide different params for different PSUs due to other plants, etc. 
     """
+    class Algorithm(models.IntegerChoices):
+        # ratio of the ground humidity rise after the last watering (see CalculateWatering.crunch_data)
+        PROPORTIONAL = 0, _('proportional (last watering)')
+        # PID controller with kp, ki, kd and dt (see CalculateWatering.crunch_pid)
+        PID = 1, _('PID controller')
+
     # id of the watering params
     id = models.BigAutoField(primary_key=True)
 
     # name describing the watering params
     name = models.CharField(_('name'), max_length=128)
 
+    # alogrithm used for the calculation of the amount
+    algorithm = models.IntegerField(_('algorithm'), choices=Algorithm.choices, default=Algorithm.PROPORTIONAL)
+
     # parameters for the alogrithm
     ground_humidity_goal = models.FloatField(_('ground humidity goal'), default=80)
     light_level_limit = models.FloatField(_('light level limit'), help_text=_("Light limit to prevent watering in the mid of the night."), default=10)
@@ -71,6 +86,12 @@ class PSU(models.Model):
     public_rsa_key = models.TextField(_('public rsa key'), unique=True)
     current_challenge = models.CharField(_('current challenge token'), max_length=128, blank=True)
 
+    # session mode of the PSU (see psucontrol.views.get_session_token)
+    session_token_lifetime = models.PositiveIntegerField(_('session token lifetime'), default=3600,
+                                                         help_text=_("Lifetime of session tokens in seconds. 0 disables the session mode."))
+    # incrementing the version revokes all session tokens issued so far
+    session_token_version = models.PositiveIntegerField(_('session token version'), default=0)
+
     # ownership of the PSU
     owner = models.ForeignKey(User, models.PROTECT, verbose_name=_('owner'), related_name='owner')
     permitted_users = models.ManyToManyField(User, verbose_name=_('permitted users'), related_name='permitted_user',
@@ -80,6 +101,11 @@ class PSU(models.Model):
     watering_params = models.ForeignKey(WateringParams, models.PROTECT, verbose_name=_('watering parameters'), null=True, blank=True)
     unauthorized_watering = models.BooleanField(_('unauthorized watering'), default=False)
 
+    # images closer to the previously stored image than this Hamming distance of their perceptual hashes
+    # only reference the file of the previous image (see psucontrol.views.store_image)
+    image_dedup_distance = models.PositiveSmallIntegerField(_('image deduplication distance'), null=True, blank=True,
+                                                            help_text=_("Maximum number of differing bits (0-64) of the perceptual hashes of two images to store only one of them. Empty disables the deduplication."))
+
     def pretty_name(self):
         return _('{} of {} {} (#{})').format(self.name, self.owner.first_name, self.owner.last_name, self.id)
 
@@ -92,6 +118,74 @@ class PSU(models.Model):
         ordering = ['id']
 
 
+def psu_cache_key(identity_key):
+    """
+    returns: key of the cached PSU snapshot for an identity key (see psucontrol.views.identify_psu)
+    """
+    return 'psucontrol.psu.' + sha256(bytes(identity_key, 'utf-8')).hexdigest()
+
+
+def invalidate_cached_psu(identity_key):
+    """
+    function to remove the cached snapshot of an identity key from the default cache (of this process with the
+    LocMemCache, of all processes with a shared CACHE_BACKEND)
+    removed again after the commit, so a concurrent request cannot cache the old state in between
+    """
+    key = psu_cache_key(identity_key)
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+@receiver(models.signals.pre_save, sender=PSU)
+def invalidate_cached_psu_on_key_change(sender, instance, **kwargs):
+    """
+    Removes the cached snapshot of the old identity key of a `PSU`
+    when the identity key is changed.
+    """
+    if instance.pk is None:
+        return
+    old_identity_key = PSU.objects.filter(pk=instance.pk).values_list('identity_key', flat=True).first()
+    if old_identity_key is not None and old_identity_key != instance.identity_key:
+        invalidate_cached_psu(old_identity_key)
+
+
+@receiver(models.signals.post_save, sender=PSU)
+def invalidate_cached_psu_on_save(sender, instance, **kwargs):
+    """
+    Removes the cached snapshot of a `PSU`
+    when the corresponding object is saved.
+    """
+    # also removes a cached unknown identity key of a newly paired PSU
+    invalidate_cached_psu(instance.identity_key)
+
+
+@receiver(models.signals.post_delete, sender=PSU)
+def invalidate_cached_psu_on_delete(sender, instance, **kwargs):
+    """
+    Removes the cached snapshot of a `PSU`
+    when the corresponding object is deleted.
+    """
+    invalidate_cached_psu(instance.identity_key)
+
+
+@receiver(models.signals.post_save, sender=PSU)
+def invalidate_public_key_on_save(sender, instance, **kwargs):
+    """
+    Removes the cached public key of a `PSU`
+    when its public_rsa_key was changed.
+    """
+    public_key_cache.invalidate(instance.id, instance.public_rsa_key)
+
+
+@receiver(models.signals.post_delete, sender=PSU)
+def invalidate_public_key_on_delete(sender, instance, **kwargs):
+    """
+    Removes the cached public key of a `PSU`
+    when the corresponding object is deleted.
+    """
+    public_key_cache.invalidate(instance.id)
+
+
 def to_psu(value):
     """
     accepts string value from PSU.__str__ and converts to PSU
@@ -125,6 +219,26 @@ class PendingPSU(models.Model):
         ordering = ['-creation_time']
 
 
+class UsedChallenge(models.Model):
+    """
+    model to remember stateless challenges which were already used by a PSU
+    prevents replays until the challenge expires (see psucontrol.views.authenticate_stateless)
+    """
+    # random part of the challenge
+    nonce = models.CharField(_('nonce'), max_length=64, unique=True)
+
+    # field for storing the concerning PSU
+    psu = models.ForeignKey(PSU, models.CASCADE, verbose_name=_('Plant Supply Unit'))
+
+    # entries can be removed after the challenge expired (done by command cleanlog)
+    expiry = models.DateTimeField(_('expiry'), db_index=True)
+
+    class Meta:
+        verbose_name = _('Used Challenge')
+        verbose_name_plural = _('Used Challenges')
+        ordering = ['-expiry']
+
+
 class DataMeasurement(models.Model):
     """
     model to store the measurement data of the PSUs
@@ -151,10 +265,42 @@ class DataMeasurement(models.Model):
         verbose_name_plural = _('Data Measurements')
         ordering = ['-timestamp', 'psu']
         unique_together = ['psu', 'timestamp']
+        indexes = [
+            # newest measurements with ground humidity of a PSU (see psucontrol.watering.CalculateWatering)
+            models.Index(fields=['psu', '-timestamp'], condition=models.Q(ground_humidity__isnull=False), name='psucontrol_dm_ghum_idx'),
+        ]
+
+
+def insert_data_measurements(dms):
+    """
+    function to insert DataMeasurements while skipping the ones whose psu and timestamp already exist
+    the stored timestamps are looked up first, the remaining measurements are inserted with bulk_create
+    ignoring conflicts, so a measurement stored concurrently in between neither raises an IntegrityError
+    nor rolls back the transaction
+    the PSUStates of the PSUs are updated with the new measurements in the same transaction
+    returns: list of the new DataMeasurements (the first one of measurements sent twice)
+    """
+    if len(dms) == 0:
+        return []
+
+    with transaction.atomic(savepoint=False):
+        stored = set(DataMeasurement.objects.filter(psu_id__in={dm.psu_id for dm in dms}, timestamp__in={dm.timestamp for dm in dms})
+                     .values_list('psu_id', 'timestamp'))
+        new_dms = []
+        for dm in dms:
+            if (dm.psu_id, dm.timestamp) not in stored:
+                stored.add((dm.psu_id, dm.timestamp))
+                new_dms.append(dm)
+
+        if len(new_dms) > 0:
+            DataMeasurement.objects.bulk_create(new_dms, batch_size=settings.PSU_MEASUREMENT_BATCH_SIZE, ignore_conflicts=True)
+            update_psu_states(new_dms)
+    return new_dms
 
 
 def upload_image_path(instance, filename):
-    return 'psufeed/{}/{}{}'.format(instance.psu.id, instance.timestamp.strftime('%Y-%m-%d_%H-%M-%S'), os.path.splitext(filename)[1])
+    # one directory per day to keep directories small (see management command shardimages for old images)
+    return 'psufeed/{}/{}/{}{}'.format(instance.psu.id, instance.timestamp.strftime('%Y/%m/%d'), instance.timestamp.strftime('%Y-%m-%d_%H-%M-%S'), os.path.splitext(filename)[1])
 
 
 class PSUImage(models.Model):
@@ -168,7 +314,16 @@ class PSUImage(models.Model):
     timestamp = models.DateTimeField(_('timestamp'))
 
     # field for storing the image
-    image = models.ImageField(upload_to=upload_image_path, storage=settings.SECURE_MEDIA_STORAGE,verbose_name=_('image'))
+    image = models.ImageField(upload_to=upload_image_path, storage=settings.SECURE_MEDIA_STORAGE,verbose_name=_('image'), db_index=True)
+
+    # field storing the SHA-256 of the image to detect uploads of the same file
+    sha256 = models.CharField(_('SHA-256'), max_length=64, blank=True, db_index=True)
+
+    # field storing the perceptual hash (see psucontrol.perceptualhash)
+    phash = models.CharField(_('perceptual hash'), max_length=16, blank=True)
+
+    # image whose file is used instead of an own copy because both are nearly identical
+    reference = models.ForeignKey('self', models.SET_NULL, verbose_name=_('reference'), related_name='duplicates', null=True, blank=True)
 
     def __str__(self):
         return 'IMG {} - {}'.format(self.psu, self.timestamp.strftime('%d.%m.%Y %H:%M:%S'))
@@ -180,14 +335,26 @@ class PSUImage(models.Model):
         unique_together = ['psu', 'timestamp']
 
 
+def image_file_in_use(name, exclude_pk=None):
+    """
+    returns: bool whether a PSUImage (except the one with exclude_pk) uses the file name
+    """
+    return PSUImage.objects.filter(image=name).exclude(pk=exclude_pk).exists()
+
+
 @receiver(models.signals.post_delete, sender=PSUImage)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
     """
     Deletes file from filesystem
-    when corresponding `PSUImage` object is deleted.
+    when corresponding `PSUImage` object is deleted
+    and no other `PSUImage` references the file.
     """
-    if instance.image and os.path.isfile(instance.image.path):
+    if not instance.image or image_file_in_use(instance.image.name):
+        return
+
+    if os.path.isfile(instance.image.path):
         os.remove(instance.image.path)
+    delete_derivatives(instance.image.name)
 
 @receiver(models.signals.pre_save, sender=PSUImage)
 def auto_delete_file_on_change(sender, instance, **kwargs):
@@ -205,8 +372,30 @@ def auto_delete_file_on_change(sender, instance, **kwargs):
         return False
 
     new_file = instance.image
-    if not old_file == new_file and os.path.isfile(old_file.path):
+    if old_file == new_file or not old_file or image_file_in_use(old_file.name, instance.pk):
+        return False
+
+    if os.path.isfile(old_file.path):
         os.remove(old_file.path)
+    delete_derivatives(old_file.name)
+
+
+@receiver(models.signals.post_save, sender=PSUImage)
+def create_derivatives_on_save(sender, instance, **kwargs):
+    """
+    Creates the derivatives (see PSU_IMAGE_DERIVATIVES)
+    when the corresponding `PSUImage` object is saved.
+    """
+    if not instance.image or instance.reference_id is not None:
+        # derivatives of references are the ones of the referenced image
+        return
+
+    name = instance.image.name
+    if settings.PSU_IMAGE_DERIVATIVES_ASYNC:
+        # queue after the image is visible for other connections
+        transaction.on_commit(lambda: derivatives_pool.submit(name))
+    else:
+        create_derivatives(name)
 
 
 WATERING_STATUS_CHOICES = [
@@ -251,6 +440,197 @@ class WateringTask(models.Model):
         ordering = ['-timestamp', 'status']
 
 
+@receiver(models.signals.post_save, sender=WateringTask)
+def notify_waiting_psu_on_save(sender, instance, **kwargs):
+    """
+    Wakes up the requests of this process waiting for a task of the `PSU` of a `WateringTask`
+    when the task is saved with status 5.
+    """
+    if instance.status == 5:
+        # wake up after the task is visible for other connections
+        psu_id = instance.psu_id
+        transaction.on_commit(lambda: watering_task_waiters.notify(psu_id))
+
+
+def latest_ground_humidity_measurement(psu):
+    """
+    returns: newest DataMeasurement of the psu with ground_humidity or None
+    """
+    # one lookup in the index psucontrol_dm_ghum_idx instead of reading all DataMeasurements
+    return DataMeasurement.objects.filter(psu=psu, ground_humidity__isnull=False).order_by('-timestamp').first()
+
+
+def ground_humidity_measurements_around(psu, timestamp):
+    """
+    returns: tuple of the newest DataMeasurement of the psu with ground_humidity at or before timestamp
+    and the oldest one after timestamp (None if there is no such DataMeasurement)
+    """
+    dms = DataMeasurement.objects.filter(psu=psu, ground_humidity__isnull=False)
+    prev_dm = dms.filter(timestamp__lte=timestamp).order_by('-timestamp').first()
+    after_dm = dms.filter(timestamp__gt=timestamp).order_by('timestamp').first()
+    return prev_dm, after_dm
+
+
+class PSUState(models.Model):
+    """
+    model holding everything a watering calculation needs to know about a PSU (see psucontrol.watering.CalculateWatering)
+    the state is kept up to date by insert_data_measurements and the signals of WateringTask,
+    the command repairpsustate rebuilds it from the DataMeasurements and WateringTasks
+    """
+    psu = models.OneToOneField(PSU, models.CASCADE, primary_key=True, verbose_name=_('Plant Supply Unit'))
+
+    # timestamp of the newest DataMeasurement (with or without ground humidity)
+    latest_timestamp = models.DateTimeField(_('newest measurement'), null=True, blank=True)
+
+    # newest DataMeasurement with ground humidity
+    current_timestamp = models.DateTimeField(_('current timestamp'), null=True, blank=True)
+    current_ground_humidity = models.FloatField(_('current ground humidity'), null=True, blank=True)
+    current_brightness = models.FloatField(_('current brightness'), null=True, blank=True)
+
+    # timestamp of the creation of the newest WateringTask
+    latest_task_timestamp = models.DateTimeField(_('newest task'), null=True, blank=True)
+
+    # newest executed WateringTask and its execution
+    last_task = models.ForeignKey(WateringTask, models.SET_NULL, verbose_name=_('last executed task'), null=True, blank=True, related_name='+')
+    last_execution = models.DateTimeField(_('last execution'), null=True, blank=True)
+
+    # DataMeasurements with ground humidity right before and after the last execution
+    prev_timestamp = models.DateTimeField(_('timestamp before execution'), null=True, blank=True)
+    prev_ground_humidity = models.FloatField(_('ground humidity before execution'), null=True, blank=True)
+    after_timestamp = models.DateTimeField(_('timestamp after execution'), null=True, blank=True)
+    after_ground_humidity = models.FloatField(_('ground humidity after execution'), null=True, blank=True)
+
+    # memory of the PID controller (WateringParams.Algorithm.PID) and the timestamp of the measurement of its last step
+    pid_integral = models.FloatField(_('PID integral'), default=0)
+    pid_previous_error = models.FloatField(_('PID previous error'), null=True, blank=True)
+    pid_timestamp = models.DateTimeField(_('PID timestamp'), null=True, blank=True)
+
+    # fields compared by the command repairpsustate
+    STATE_FIELDS = ['latest_timestamp', 'current_timestamp', 'current_ground_humidity', 'current_brightness',
+                    'latest_task_timestamp', 'last_task_id', 'last_execution',
+                    'prev_timestamp', 'prev_ground_humidity', 'after_timestamp', 'after_ground_humidity']
+    # fields which cannot be rebuilt from the stored data
+    PID_FIELDS = ['pid_integral', 'pid_previous_error', 'pid_timestamp']
+
+    def __str__(self):
+        return 'State {}'.format(self.psu)
+
+    def add_measurements(self, dms):
+        """
+        updates the state with new DataMeasurements of the psu (not saved)
+        """
+        for dm in dms:
+            if self.latest_timestamp is None or dm.timestamp > self.latest_timestamp:
+                self.latest_timestamp = dm.timestamp
+
+            if dm.ground_humidity is None:
+                continue
+
+            if self.current_timestamp is None or dm.timestamp >= self.current_timestamp:
+                self.current_timestamp = dm.timestamp
+                self.current_ground_humidity = dm.ground_humidity
+                self.current_brightness = dm.brightness
+
+            if self.last_execution is None:
+                continue
+            if dm.timestamp <= self.last_execution:
+                if self.prev_timestamp is None or dm.timestamp >= self.prev_timestamp:
+                    self.prev_timestamp = dm.timestamp
+                    self.prev_ground_humidity = dm.ground_humidity
+            elif self.after_timestamp is None or dm.timestamp <= self.after_timestamp:
+                self.after_timestamp = dm.timestamp
+                self.after_ground_humidity = dm.ground_humidity
+
+    def set_last_task(self, task):
+        """
+        sets the executed task and looks up the measurements around its execution (not saved)
+        """
+        self.last_task = task
+        self.last_execution = task.timestamp_execution
+        prev_dm, after_dm = ground_humidity_measurements_around(self.psu_id, task.timestamp_execution)
+        self.prev_timestamp = prev_dm.timestamp if prev_dm else None
+        self.prev_ground_humidity = prev_dm.ground_humidity if prev_dm else None
+        self.after_timestamp = after_dm.timestamp if after_dm else None
+        self.after_ground_humidity = after_dm.ground_humidity if after_dm else None
+
+    @classmethod
+    def rebuild(cls, psu, save=True):
+        """
+        builds the state of the psu from its DataMeasurements and WateringTasks
+        returns: PSUState (replaces the stored one if save)
+        """
+        state = cls(psu=psu)
+        latest_dm = DataMeasurement.objects.filter(psu=psu).order_by('-timestamp').first()
+        state.latest_timestamp = latest_dm.timestamp if latest_dm else None
+
+        current_dm = latest_ground_humidity_measurement(psu)
+        if current_dm is not None:
+            state.current_timestamp = current_dm.timestamp
+            state.current_ground_humidity = current_dm.ground_humidity
+            state.current_brightness = current_dm.brightness
+
+        latest_task = WateringTask.objects.filter(psu=psu).order_by('-timestamp').first()
+        state.latest_task_timestamp = latest_task.timestamp if latest_task else None
+
+        last_task = WateringTask.objects.filter(psu=psu, status=20).order_by('-timestamp').first()
+        if last_task is not None:
+            state.set_last_task(last_task)
+
+        if save:
+            state.save()
+        return state
+
+    class Meta:
+        verbose_name = _('PSU State')
+        verbose_name_plural = _('PSU States')
+
+
+def update_psu_states(dms):
+    """
+    function to add new DataMeasurements to the states of their PSUs
+    states which do not exist yet are built on the next watering calculation
+    """
+    by_psu = dict()
+    for dm in dms:
+        by_psu.setdefault(dm.psu_id, []).append(dm)
+
+    with transaction.atomic():
+        # locked to not lose the measurements of concurrent requests (PostgreSQL)
+        for state in PSUState.objects.select_for_update().filter(psu_id__in=by_psu.keys()):
+            state.add_measurements(by_psu[state.psu_id])
+            state.save()
+
+
+@receiver(models.signals.post_save, sender=DataMeasurement)
+def update_psu_state_on_measurement_save(sender, instance, created, **kwargs):
+    """
+    Adds a `DataMeasurement` created with save (e.g. by the command dummymeasurements)
+    to the `PSUState` of its `PSU`, the views use insert_data_measurements.
+    """
+    if created:
+        update_psu_states([instance])
+
+
+@receiver(models.signals.post_save, sender=WateringTask)
+def update_psu_state_on_task_save(sender, instance, created, **kwargs):
+    """
+    Updates the `PSUState` of the `PSU` of a `WateringTask`
+    when the task is created or executed.
+    """
+    if created:
+        PSUState.objects.filter(models.Q(latest_task_timestamp__isnull=True) | models.Q(latest_task_timestamp__lt=instance.timestamp),
+                                psu_id=instance.psu_id).update(latest_task_timestamp=instance.timestamp)
+
+    if instance.status == 20 and instance.timestamp_execution is not None:
+        with transaction.atomic():
+            state = PSUState.objects.select_for_update().select_related('last_task').filter(psu_id=instance.psu_id).first()
+            # older tasks marked late do not replace the newest executed task
+            if state is not None and (state.last_task is None or state.last_task.id == instance.id or
+                                      state.last_task.timestamp <= instance.timestamp):
+                state.set_last_task(instance)
+                state.save()
+
+
 class CommunicationLogEntry(models.Model):
     """
     model to log the communication between the server and the PSUs
@@ -280,8 +660,8 @@ class CommunicationLogEntry(models.Model):
     # field to keep the identity key even if the psu is deleted
     psu_identity_key = models.CharField(_('psu identity key'), max_length=128)
 
-    # timestamp of the action
-    timestamp = models.DateTimeField(_('timestamp'), auto_now_add=True)
+    # timestamp of the action (no auto_now_add to keep the time of the request if the entry is written later)
+    timestamp = models.DateTimeField(_('timestamp'), default=timezone.now)
 
     # field for storing the URL
     request_uri = models.CharField(_('request uri'), max_length=200)
@@ -329,3 +709,31 @@ class WateringDecision(models.Model):
         verbose_name = _('Watering Decision')
         verbose_name_plural = _('Watering Decisions')
         ordering = ['-timestamp']
+
+
+class WateringJob(models.Model):
+    """
+    model for storing a pending watering calculation of a PSU (see psucontrol.jobqueue)
+    the job is processed by the command wateringworker and deleted afterwards
+    """
+    # only one job per PSU, further requests only update requested
+    psu = models.OneToOneField(PSU, models.CASCADE, verbose_name=_('Plant Supply Unit'))
+
+    # time of the latest request, a job requested again while running is run once more
+    requested = models.DateTimeField(_('requested'), default=timezone.now)
+
+    # a claimed job is hidden from other workers until locked_until (visibility timeout or delay of a retry)
+    locked_until = models.DateTimeField(_('locked until'), null=True, blank=True, db_index=True)
+    lock_token = models.CharField(_('lock token'), max_length=32, blank=True)
+
+    # number of claims since the latest request
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    last_error = models.TextField(_('last error'), blank=True)
+
+    def __str__(self):
+        return 'WJ {} - {}'.format(self.psu, self.requested.strftime('%d.%m.%Y %H:%M:%S'))
+
+    class Meta:
+        verbose_name = _('Watering Job')
+        verbose_name_plural = _('Watering Jobs')
+        ordering = ['requested']
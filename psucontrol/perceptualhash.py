@@ -0,0 +1,35 @@
+from PIL import Image
+
+
+# Perceptual hash (dHash) of the PSUImages
+# the image is reduced to a 9x8 grayscale image and every bit tells whether a pixel is brighter
+# than its right neighbour, so frames without visible changes get the same or a similar hash
+
+HASH_WIDTH = 8
+HASH_HEIGHT = 8
+
+
+def dhash(file):
+    """
+    computes the dHash of an image file (path or file object)
+    returns: hash as 16 char hex string
+    """
+    with Image.open(file) as img:
+        # let the decoder downscale (e.g. JPEG) before the image is converted and resized
+        img.draft('L', (HASH_WIDTH * 8, HASH_HEIGHT * 8))
+        pixels = img.convert('L').resize((HASH_WIDTH + 1, HASH_HEIGHT), Image.BILINEAR).tobytes()
+
+    # compare every pixel with its right neighbour row by row
+    left = bytes(p for i, p in enumerate(pixels) if i % (HASH_WIDTH + 1) != HASH_WIDTH)
+    right = bytes(p for i, p in enumerate(pixels) if i % (HASH_WIDTH + 1) != 0)
+    value = 0
+    for l, r in zip(left, right):
+        value = (value << 1) | (l > r)
+    return '{:016x}'.format(value)
+
+
+def hamming_distance(a, b):
+    """
+    returns: number of differing bits of two hashes computed by dhash
+    """
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
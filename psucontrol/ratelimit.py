@@ -0,0 +1,125 @@
+from math import ceil
+from time import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import JsonResponse
+from django.utils import translation
+from django.utils.deprecation import MiddlewareMixin
+
+from psucontrol import metrics
+from psucontrol.views import build_error_response, identify_psu
+
+
+# Limits of the requests of every PSU and every client IP to the views of psucontrol
+# the limits are kept in the cache ratelimit of CACHES (shared by all processes), so they apply across processes
+# every limit (rate, burst) allows burst requests per sliding window of burst / rate seconds: the requests are counted
+# per fixed window and the count of the previous window is weighted by its share of the sliding window, so there
+# are no 2 * burst requests at the border of two windows
+# (a real token bucket would need compare-and-set, the cache only offers atomic add and incr with
+# memcached and website.cache.DatabaseCache)
+# rejected requests are not counted and not logged to keep looping PSUs away from the database
+
+
+def take_token(key, rate, burst, now=None):
+    """
+    takes one of the burst tokens of the sliding window of burst / rate seconds ending now (default: current time)
+    returns: 0 if a token was taken or seconds until the next token is available
+    """
+    cache = caches['ratelimit']
+    now = time() if now is None else now
+    window = burst / rate
+    number = int(now // window)
+    # share of the current window which has already passed
+    elapsed = now / window - number
+    current_key = '{}.{}'.format(key, number)
+    # counters are needed for the current and the next window
+    timeout = ceil(2 * window) + 1
+
+    # only creates the counter of a new window
+    cache.add(current_key, 0, timeout)
+    try:
+        current = cache.incr(current_key)
+    except ValueError:
+        # expired in the meantime
+        current = 1 if cache.add(current_key, 1, timeout) else cache.incr(current_key)
+    previous = cache.get('{}.{}'.format(key, number - 1), 0)
+
+    if previous * (1 - elapsed) + current <= burst:
+        return 0
+
+    # rejected requests do not use up the tokens
+    current = cache.decr(current_key)
+    if previous > 0 and current < burst:
+        # wait until the weight of the previous window leaves room for one request
+        wait = 1 - (burst - current - 1) / previous - elapsed
+    else:
+        # wait until the current window is the previous one and its weight leaves room for one request
+        wait = 1 - elapsed + max(0, 1 - (burst - 1) / current)
+    return max(wait * window, 0.001)
+
+
+def endpoint_name(url_name):
+    """
+    returns: name of the endpoint of the url pattern url_name (sync and async views share their limits and buckets)
+    """
+    if url_name.startswith('async_'):
+        return url_name[len('async_'):]
+    return url_name
+
+
+def rate_limited_response(request, retry_after):
+    """
+    returns: JsonResponse with error 0xR1, the seconds to wait in retry_after and HTTP status 429
+    """
+    language = translation.get_language_from_request(request) if 'HTTP_ACCEPT_LANGUAGE' in request.META else None
+    context = dict(build_error_response('0xR1', language))
+    context['retry_after'] = ceil(retry_after)
+
+    metrics.inc('psucontrol_errors_total', endpoint=metrics.endpoint_label(request), error_code='0xR1')
+    response = JsonResponse(context, status=429)
+    response['Retry-After'] = str(context['retry_after'])
+    return response
+
+
+class RateLimitMiddleware(MiddlewareMixin):
+    """
+    middleware applying the limits of PSU_RATE_LIMITS to all views of psucontrol.urls
+    the client IP is checked before the body of the request is parsed
+    views which need special upload handlers provide them by the function prepare_request
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if match is None or match.app_name != 'psucontrol':
+            return None
+
+        endpoint = endpoint_name(match.url_name)
+        limits = settings.PSU_RATE_LIMITS.get(endpoint, settings.PSU_RATE_LIMITS.get('default'))
+        if limits is None:
+            return None
+
+        if limits.get('ip') is not None:
+            ip = request.META.get(settings.PSU_RATE_LIMIT_IP_HEADER, '')
+            # the last address of a list (X-Forwarded-For) is the one added by the own reverse proxy,
+            # the addresses before it are sent by the client and can be chosen freely
+            ip = ip.split(',')[-1].strip()
+            retry_after = take_token('psucontrol.ratelimit.ip.{}.{}'.format(endpoint, ip), *limits['ip'])
+            if retry_after:
+                return rate_limited_response(request, retry_after)
+
+        if limits.get('psu') is not None and request.method == 'POST':
+            prepare_request = getattr(view_func, 'prepare_request', None)
+            if prepare_request is not None:
+                prepare_request(request)
+
+            identity_key = request.POST.get('identity_key')
+            # unknown identity keys get no counters (they are rejected by the view and limited by the client ip),
+            # so random keys cannot fill the cache
+            psu = identify_psu(identity_key) if identity_key else None
+            if psu is not None:
+                retry_after = take_token('psucontrol.ratelimit.psu.{}.{}'.format(endpoint, psu.id), *limits['psu'])
+                if retry_after:
+                    return rate_limited_response(request, retry_after)
+
+        return None
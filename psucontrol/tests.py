@@ -1,25 +1,62 @@
-from django.test import TestCase, Client, TransactionTestCase
+from django.test import TestCase, Client, TransactionTestCase, override_settings
+from django.conf import settings
+from django.core.management import call_command
 from django.db import transaction
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone
+from django.utils.timezone import utc
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives import serialization, hashes
+from PIL import Image
 import base64
-from time import sleep
-
+import json
+from io import BytesIO, StringIO
+import os
+import shutil
+import socket
+import subprocess
+import sys
+from hashlib import sha256
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Timer
+from time import sleep, monotonic, time
+
+from authentication.models import User
+from website.securemedia import psuimage_url, sign_media_path
 from website.utils import get_test_user
-from psucontrol.models import PSU, PendingPSU, DataMeasurement, PSUImage, WateringTask, CommunicationLogEntry
+from psucontrol import metrics
+from psucontrol.derivatives import derivative_name, DerivativesPool
+from psucontrol.jobqueue import claim_watering_jobs, complete_watering_job, enqueue_watering_job, fail_watering_job
+from psucontrol.keycache import PublicKeyCache, public_key_cache
+from psucontrol.logwriter import CommunicationLogWriter
+from psucontrol.perceptualhash import hamming_distance
+from psucontrol.measurementformat import encode_measurements, decode_measurements, MeasurementFormatError
+from psucontrol.models import PSU, PendingPSU, DataMeasurement, PSUImage, PSUState, WateringParams, WateringTask, CommunicationLogEntry, WateringJob
+from psucontrol.models import ground_humidity_measurements_around, insert_data_measurements, latest_ground_humidity_measurement
+from psucontrol.ratelimit import take_token
+from psucontrol.timelapse import build_timelapse
+from psucontrol.views import identify_psu
+from psucontrol.watering import CalculateWatering, WateringCalculationPool
 
 # Create your tests here.
 
 
+@override_settings(PSU_LOG_ASYNC=False, PSU_IMAGE_DERIVATIVES_ASYNC=False, PSU_RATE_LIMITS={})
 class PSUCommunicationTestCase(TransactionTestCase):
     """
     TestCase to test the whole communication between a psu and django
+    log entries and image derivatives are written synchronously to check them after every request
     """
 
     def setUp(self):
         """
         setup of the testing environment
         """
+        # remove PSUs of other tests from the cache
+        cache.clear()
+
         # create new private rsa key
         self.rsa_pk = rsa.generate_private_key(public_exponent=65537, key_size=2048)
         pub_rsa_str = str(self.rsa_pk.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo), 'utf-8')
@@ -31,14 +68,13 @@ class PSUCommunicationTestCase(TransactionTestCase):
         self.wt2 = WateringTask.objects.create(psu=self.psu, amount=200, status=5)
     
 
-    def get_signed_msg(self,* ,client=None):
+    def get_signed_msg(self,* ,client=None, uri='/psucontrol/get_challenge'):
         """
         function to request a chellenge and sign it with the key of self.psu
         """
         if client is None:
             client = Client()
 
-        uri = '/psucontrol/get_challenge'
         data = {'identity_key': self.psu.identity_key}
         res = self.check_status(uri, True, data=data, client=client)
         # test returned challenge
@@ -99,6 +135,10 @@ class PSUCommunicationTestCase(TransactionTestCase):
             del data['image']
         except KeyError:
             pass
+        try:
+            del data['binary']
+        except KeyError:
+            pass
         
         # check log entry
         entry = CommunicationLogEntry.objects.first()
@@ -175,6 +215,57 @@ class PSUCommunicationTestCase(TransactionTestCase):
         self.check_error_code(uri, '0xD1', data=data, client=c)
 
 
+    def test_error_language(self):
+        """
+        test error responses in all languages and in the language asked for by Accept-Language
+        """
+        uri = '/psucontrol/get_challenge'
+
+        c = Client()
+
+        # all languages without Accept-Language header
+        res = self.check_status(uri, False, client=c)
+        self.check_dict_value(uri, None, res, 'error_message_en', 'Bad request')
+        self.failUnless('error_message_de' in res, self.gen_fmsg(uri, None, res, 'error_message_de'))
+
+        # only one language with Accept-Language header
+        res = c.post(uri, HTTP_ACCEPT_LANGUAGE='en').json()
+        self.failUnlessEqual(res, {'status': 'failed', 'error_code': '0xB1', 'error_message': 'Bad request', 'error_message_en': 'Bad request'})
+        self.failUnlessEqual(CommunicationLogEntry.objects.first().response, str(res), 'last log entry should hold the narrowed response')
+
+
+    def test_identify_psu(self):
+        """
+        test caching of PSUs and unknown identity keys
+        """
+        # second lookup is served by the cache
+        identify_psu(self.psu.identity_key)
+        with self.assertNumQueries(0):
+            self.failUnlessEqual(identify_psu(self.psu.identity_key), self.psu, 'cached psu should be returned')
+
+        # unknown keys are cached as well
+        self.failUnlessEqual(identify_psu('new-key'), None, 'unknown key should not be identified')
+        with self.assertNumQueries(0):
+            self.failUnlessEqual(identify_psu('new-key'), None, 'unknown key should not be identified')
+
+        # saving removes the cached entries
+        self.psu.name = 'CHANGED'
+        self.psu.save()
+        self.failUnlessEqual(identify_psu(self.psu.identity_key).name, 'CHANGED', 'cached psu should be updated after saving')
+        new_psu = PSU.objects.create(name='NEW-PSU', identity_key='new-key', public_rsa_key='new-rsa-key', owner=get_test_user())
+        self.failUnlessEqual(identify_psu('new-key'), new_psu, 'new psu should be identified')
+
+        # changing the identity key removes the entry of the old key
+        new_psu.identity_key = 'changed-key'
+        new_psu.save()
+        self.failUnlessEqual(identify_psu('new-key'), None, 'old identity key should not be identified')
+        self.failUnlessEqual(identify_psu('changed-key'), new_psu, 'changed identity key should be identified')
+
+        # deleting removes the cached entries
+        new_psu.delete()
+        self.failUnlessEqual(identify_psu('changed-key'), None, 'deleted psu should not be identified')
+
+
     def test_get_challenge(self):
         """
         test process of getting a challenge from the server
@@ -205,6 +296,123 @@ class PSUCommunicationTestCase(TransactionTestCase):
         self.failUnlessEqual(self.psu.current_challenge, res['challenge'], 'psu holds current challenge {} but {} was responeded'.format(self.psu.current_challenge, res['challenge']))
 
 
+    def get_stateless_signed_msg(self, *, client=None):
+        """
+        function to request a stateless challenge and sign it with the key of self.psu
+        returns: tuple of challenge and signed challenge
+        """
+        if client is None:
+            client = Client()
+
+        uri = '/psucontrol/get_challenge'
+        data = {'identity_key': self.psu.identity_key, 'stateless': '1'}
+        res = self.check_status(uri, True, data=data, client=client)
+
+        signed = self.rsa_pk.sign(bytes(res['challenge'], 'utf-8'),
+                                  padding.PSS(
+                                      mgf=padding.MGF1(hashes.SHA256()),
+                                      salt_length=padding.PSS.MAX_LENGTH),
+                                  hashes.SHA256())
+        return res['challenge'], str(base64.urlsafe_b64encode(signed), 'utf-8')
+
+
+    def test_stateless_challenge(self):
+        """
+        test process of using multiple stateless challenges at once
+        """
+        uri = '/psucontrol/get_watering_task'
+
+        c = Client()
+
+        # request two challenges before using one of them
+        challenge1, signed1 = self.get_stateless_signed_msg(client=c)
+        challenge2, signed2 = self.get_stateless_signed_msg(client=c)
+
+        # challenges are not stored in the PSU
+        self.psu.refresh_from_db()
+        self.failUnlessEqual(self.psu.current_challenge, '', 'psu holds current challenge {} but should hold none'.format(self.psu.current_challenge))
+
+        # Test error 0xA2 if the signature does not fit the challenge
+        data = {'identity_key': self.psu.identity_key, 'challenge': challenge1, 'signed_challenge': signed2}
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+
+        # Test error 0xA2 if the challenge was manipulated
+        data = {'identity_key': self.psu.identity_key, 'challenge': challenge1 + 'x', 'signed_challenge': signed1}
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+
+        # Test using the challenges in reverse order
+        data = {'identity_key': self.psu.identity_key, 'challenge': challenge2, 'signed_challenge': signed2}
+        self.check_status(uri, True, data=data, client=c)
+        data = {'identity_key': self.psu.identity_key, 'challenge': challenge1, 'signed_challenge': signed1}
+        self.check_status(uri, True, data=data, client=c)
+
+        # Test error 0xA2 if a challenge is replayed
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+
+        # Test error 0xA2 if the challenge belongs to another PSU
+        other_psu = PSU.objects.create(name='OTHER-PSU', identity_key='other-key', public_rsa_key=self.psu.public_rsa_key + ' ', owner=get_test_user())
+        challenge, signed = self.get_stateless_signed_msg(client=c)
+        data = {'identity_key': other_psu.identity_key, 'challenge': challenge, 'signed_challenge': signed}
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+
+
+    def test_session_token(self):
+        """
+        test process of getting a session token and using it instead of a signed challenge
+        """
+        uri = '/psucontrol/get_session_token'
+
+        c = Client()
+
+        # Test error 0xB1 if no post data is given
+        self.check_error_code(uri, '0xB1', client=c)
+
+        # Test error 0xA1 if wrong identity_key is given
+        self.check_error_code(uri, '0xA1', data={'identity_key':'somekey'}, client=c)
+
+        # Test error 0xA2 if wrong signed challenge is given
+        data = {'identity_key':self.psu.identity_key, 'signed_challenge': 'some weird challenge'}
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+
+        # Test to really get a session token
+        data['signed_challenge'] = self.get_signed_msg()
+        res = c.post(uri, data=data).json()
+        self.check_dict_value(uri, data, res, 'status', 'ok')
+        self.check_dict_value(uri, data, res, 'session_token_lifetime', 3600)
+        token = res['session_token']
+
+        # check whether the token was kept out of the log
+        entry = CommunicationLogEntry.objects.first()
+        self.failIf(token in entry.response, 'last log entry holds the session token {}'.format(token))
+
+        # Test using the session token multiple times
+        uri = '/psucontrol/get_watering_task'
+        data = {'identity_key':self.psu.identity_key, 'session_token': token}
+        for i in range(2):
+            res = c.post(uri, data=data).json()
+            self.check_dict_value(uri, data, res, 'status', 'ok')
+            self.check_dict_value(uri, data, res, "watering_task_id", self.wt2.id)
+
+        # Test error 0xA4 when using a manipulated token
+        data['session_token'] = token + 'x'
+        res = c.post(uri, data=data).json()
+        self.check_dict_value(uri, data, res, 'error_code', '0xA4')
+
+        # Test error 0xA4 when using a token of a revoked session
+        self.psu.session_token_version += 1
+        self.psu.save()
+        data['session_token'] = token
+        res = c.post(uri, data=data).json()
+        self.check_dict_value(uri, data, res, 'error_code', '0xA4')
+
+        # Test error 0xA5 when session mode is disabled
+        self.psu.session_token_lifetime = 0
+        self.psu.save()
+        uri = '/psucontrol/get_session_token'
+        data = {'identity_key':self.psu.identity_key, 'signed_challenge': self.get_signed_msg()}
+        self.check_error_code(uri, '0xA5', data=data, client=c)
+
+
     def test_add_data_measurement(self):
         """
         test process of adding a data measurement
@@ -278,11 +486,117 @@ class PSUCommunicationTestCase(TransactionTestCase):
         data['signed_challenge'] = str(base64.urlsafe_b64encode(signed), 'utf-8')
         self.check_error_code(uri, '0xA2', data=data, client=c)
 
-        # Test 0xD4 if measurement already exists
+        # Test idempotent success if measurement already exists
         data['signed_challenge'] = self.get_signed_msg()
-        self.check_error_code(uri, '0xD4', data=data, client=c)
+        res = self.check_status(uri, True, data=data, client=c)
+        self.check_dict_value(uri, data, res, 'duplicate', True)
+        self.failUnlessEqual(DataMeasurement.objects.filter(psu=self.psu).count(), 1, 'resent DataMeasurement was stored twice')
+        self.failUnlessEqual(CommunicationLogEntry.objects.first().level, CommunicationLogEntry.Level.MINOR_INFO, 'resent DataMeasurement was logged as error')
+
+        # Test creating a DataMeasurement in the compact binary format
+        ts = datetime(2021, 3, 28, 2, 30, 25, tzinfo=utc)
+        data = {'identity_key':self.psu.identity_key, 'signed_challenge': self.get_signed_msg(),
+                'binary': SimpleUploadedFile('measurement', encode_measurements([{'timestamp': ts, 'temperature': 20.5}]))}
+        self.check_status(uri, True, data=data, client=c)
+        dm = DataMeasurement.objects.first()
+        self.failUnlessEqual((dm.timestamp, dm.temperature, dm.air_humidity), (ts, 20.5, None), 'DataMeasurement of the binary request holds wrong values')
+
+        # Test error 0xB1 if more than one measurement is sent in the binary format
+        data = {'identity_key':self.psu.identity_key, 'signed_challenge': self.get_signed_msg(),
+                'binary': SimpleUploadedFile('measurement', encode_measurements([{'timestamp': ts}, {'timestamp': ts + timedelta(hours=1)}]))}
+        self.check_error_code(uri, '0xB1', data=data, client=c)
+
+
+    def test_add_data_measurements(self):
+        """
+        test process of adding multiple data measurements with one request
+        """
+        uri = '/psucontrol/add_data_measurements'
+
+        c = Client()
+
+        # Test error 0xB1 if no post data is given
+        self.check_error_code(uri, '0xB1', client=c)
+
+        # Test error 0xA1 if wrong identity_key is given
+        self.check_error_code(uri, '0xA1', data={'identity_key':'somekey'}, client=c)
+
+        # Test error 0xA2 if wrong signed challenge is given
+        data = {'identity_key':self.psu.identity_key, 'signed_challenge': 'some weird challenge'}
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+
+        # Test error 0xB1 if measurements are no JSON list
+        data['signed_challenge'] = self.get_signed_msg()
+        data['measurements'] = '{"timestamp": "2021-03-28_03-30-25"}'
+        self.check_error_code(uri, '0xB1', data=data, client=c)
+
+        # Test result codes of every single measurement
+        data['signed_challenge'] = self.get_signed_msg()
+        data['measurements'] = json.dumps([
+            {'timestamp': '2021-03-28_03-30-25', 'temperature': '20.0', 'ground_humidity': '45.65'},
+            {'timestamp': '2021-03-28_03-45-25', 'temperature': 21.5, 'ground_humidity': None},
+            {'timestamp': '2021-03-28_03-30-25', 'temperature': '20.0'},
+            {'timestamp': '2021-03-28_02-30-25'},
+            {'temperature': '20.0'},
+        ])
+        res = self.check_status(uri, True, data=data, client=c)
+        self.check_dict_value(uri, data, res, 'results', ['ok', 'ok', 'duplicate', '0xD3', '0xB1'])
+        self.check_dict_value(uri, data, res, 'duplicates', 1)
+
+        # check whether the DataMeasurements were created
+        self.failUnlessEqual(DataMeasurement.objects.filter(psu=self.psu).count(), 2, 'There should be 2 DataMeasurements after the first batch.')
+        dm = DataMeasurement.objects.first()
+        self.failUnlessEqual(dm.temperature, 21.5, 'DataMeasurement holds temperature {} but {} was requested'.format(str(dm.temperature), str(21.5)))
+        self.failUnlessEqual(dm.ground_humidity, None, 'DataMeasurement holds ground_humidity {} but {} was requested'.format(str(dm.ground_humidity), str(None)))
+
+        # Test resend of an already stored measurement
+        data['signed_challenge'] = self.get_signed_msg()
+        data['measurements'] = json.dumps([
+            {'timestamp': '2021-03-28_03-45-25', 'temperature': 21.5},
+            {'timestamp': '2021-03-28_04-00-25', 'temperature': 22.0},
+        ])
+        res = self.check_status(uri, True, data=data, client=c)
+        self.check_dict_value(uri, data, res, 'results', ['duplicate', 'ok'])
+        self.check_dict_value(uri, data, res, 'duplicates', 1)
+        self.failUnlessEqual(DataMeasurement.objects.filter(psu=self.psu).count(), 3, 'There should be 3 DataMeasurements after the second batch.')
+
+        # Test measurements in the compact binary format
+        ts = datetime(2021, 3, 28, 4, 15, 25, tzinfo=utc)
+        del data['measurements']
+        data['signed_challenge'] = self.get_signed_msg()
+        data['binary'] = SimpleUploadedFile('measurements', encode_measurements([
+            {'timestamp': ts, 'temperature': 22.5, 'fill_level': 0.25},
+            {'timestamp': ts + timedelta(minutes=15), 'air_humidity': 60.0},
+            {'timestamp': ts},
+        ]))
+        res = self.check_status(uri, True, data=data, client=c)
+        self.check_dict_value(uri, data, res, 'results', ['ok', 'ok', 'duplicate'])
+        self.check_dict_value(uri, data, res, 'duplicates', 1)
+        dm = DataMeasurement.objects.get(psu=self.psu, timestamp=ts)
+        self.failUnlessEqual((dm.temperature, dm.air_humidity, dm.fill_level), (22.5, None, 0.25), 'DataMeasurement of the binary batch holds wrong values')
+
+        # Test error 0xB1 if the binary data is broken
+        data['signed_challenge'] = self.get_signed_msg()
+        data['binary'] = SimpleUploadedFile('measurements', encode_measurements([{'timestamp': ts}])[:-1])
+        self.check_error_code(uri, '0xB1', data=data, client=c)
+
+
+    def test_measurement_format(self):
+        """
+        test encoding and decoding of the compact binary format
+        """
+        ts = datetime(2021, 4, 20, 12, 0, 0, tzinfo=utc)
+        measurements = [{'timestamp': ts, 'temperature': -3.5, 'air_humidity': None, 'ground_humidity': 45.0, 'brightness': 1000.0, 'fill_level': None}]
+        data = encode_measurements(measurements)
+        self.failUnlessEqual(len(data), 1 + 25, 'one measurement should need 26 bytes')
+        self.failUnlessEqual(decode_measurements(data), measurements, 'decoded measurements differ from the encoded ones')
+
+        # unknown versions and incomplete records are rejected
+        for broken in [b'', bytes([2]) + data[1:], data + b'0']:
+            with self.assertRaises(MeasurementFormatError):
+                decode_measurements(broken)
+
 
-    
     def test_add_image(self):
         """
         test process of uploading an image for a psu
@@ -367,11 +681,228 @@ class PSUCommunicationTestCase(TransactionTestCase):
         data['image'] = open(png_file, 'rb')
         self.check_error_code(uri, '0xA2', data=data, client=c)
 
-        # Test 0xD4 if image already exists
+        # Test ok with duplicate if the same image is uploaded again (retry)
         data['signed_challenge'] = self.get_signed_msg()
         data['image'] = open(png_file, 'rb')
+        res = self.check_status(uri, True, data=data, client=c)
+        self.check_dict_value(uri, data, res, 'duplicate', True)
+        self.failUnlessEqual(PSUImage.objects.filter(psu=self.psu).count(), 1, 'The retried image was stored twice.')
+
+        # Test 0xD4 if another image is uploaded with the same timestamp
+        other = BytesIO()
+        Image.new('L', (8, 8)).save(other, 'PNG')
+        data['signed_challenge'] = self.get_signed_msg()
+        data['image'] = SimpleUploadedFile('other.png', other.getvalue())
         self.check_error_code(uri, '0xD4', data=data, client=c)
 
+        # Test that the same image with another timestamp only references the stored file
+        data['signed_challenge'] = self.get_signed_msg()
+        data['image'] = open(png_file, 'rb')
+        data['timestamp'] = '2021-03-28_05-45-25'
+        res = self.check_status(uri, True, data=data, client=c)
+        self.check_dict_value(uri, data, res, 'duplicate', False)
+        copy = PSUImage.objects.get(psu=self.psu, reference=pi)
+        self.failUnlessEqual(copy.image.name, pi.image.name, 'The same image was stored twice.')
+        copy.delete()
+        self.failUnless(os.path.isfile(pi.image.path), 'image was deleted with its reference')
+
+        # check the stored hash and that the upload was moved to its final location
+        with open(png_file, 'rb') as f:
+            self.failUnlessEqual(pi.sha256, sha256(f.read()).hexdigest(), 'PSUImage holds wrong SHA-256')
+        self.failUnless(os.path.isfile(pi.image.path), 'image was not stored at {}'.format(pi.image.path))
+        self.failUnlessEqual(os.listdir(settings.PSU_IMAGE_UPLOAD_DIR), [], 'uploads were not removed from PSU_IMAGE_UPLOAD_DIR')
+
+        # check the derivatives and their delivery through securemedia
+        viewer = User.objects.create(email='viewer@test.de', first_name='Test', last_name='Viewer')
+        self.psu.permitted_users.add(viewer)
+        c.force_login(viewer)
+        uri = '/securemedia/' + pi.image.name
+        for size in settings.PSU_IMAGE_DERIVATIVES:
+            path = settings.SECURE_MEDIA_STORAGE.path(derivative_name(pi.image.name, size))
+            self.failUnless(os.path.isfile(path), 'derivative {} was not created'.format(size))
+            # missing derivatives are created on request
+            os.remove(path)
+            res = c.get(uri, {'size': size})
+            self.failUnlessEqual(res['X-Accel-Redirect'], '/protectedmedia/' + derivative_name(pi.image.name, size), 'wrong derivative delivered for size {}'.format(size))
+            self.failUnless(os.path.isfile(path), 'derivative {} was not created on request'.format(size))
+        self.failUnlessEqual(c.get(uri, {'size': 'huge'}).status_code, 404, 'unknown size did not return 404')
+
+        # derivatives are deleted with the original
+        pi.delete()
+        for size in settings.PSU_IMAGE_DERIVATIVES:
+            self.failIf(os.path.isfile(settings.SECURE_MEDIA_STORAGE.path(derivative_name(pi.image.name, size))), 'derivative {} was not deleted'.format(size))
+
+
+    def upload_test_image(self, img, timestamp, *, client=None):
+        """
+        function to upload a PIL image as png for self.psu
+        returns: JSON of the response
+        """
+        f = BytesIO()
+        img.save(f, 'PNG')
+        data = {'identity_key': self.psu.identity_key, 'signed_challenge': self.get_signed_msg(client=client), 'timestamp': timestamp,
+                'image': SimpleUploadedFile('image.png', f.getvalue())}
+        return self.check_status('/psucontrol/add_image', True, data=data, client=client)
+
+
+    def test_image_dedup(self):
+        """
+        test the deduplication of nearly identical images with perceptual hashes
+        """
+        c = Client()
+        self.psu.image_dedup_distance = 4
+        self.psu.save()
+
+        # gradient, the same gradient with one changed pixel and the reversed gradient
+        img = Image.new('L', (64, 64))
+        img.putdata([x * 4 for y in range(64) for x in range(64)])
+        similar = img.copy()
+        similar.putpixel((10, 10), 0)
+        different = img.transpose(Image.FLIP_LEFT_RIGHT)
+
+        self.upload_test_image(img, '2021-04-20_12-00-00', client=c)
+        self.upload_test_image(similar, '2021-04-20_12-15-00', client=c)
+        self.upload_test_image(different, '2021-04-20_12-30-00', client=c)
+
+        first, second, third = PSUImage.objects.filter(psu=self.psu).order_by('timestamp')
+        self.failUnlessEqual(hamming_distance(first.phash, second.phash), 0, 'similar images got different perceptual hashes')
+        self.failUnlessEqual((second.reference, second.image.name), (first, first.image.name), 'similar image was stored again')
+        self.failUnlessEqual(third.reference, None, 'different image was not stored')
+        self.failIfEqual(third.image.name, first.image.name, 'different image was not stored')
+
+        # check the report of the saved storage
+        out = StringIO()
+        call_command('imagestorage', PSU=self.psu.id, stdout=out)
+        self.failUnless('3 images, 2 files' in out.getvalue(), 'wrong storage report: {}'.format(out.getvalue()))
+
+        # the file is kept as long as it is referenced
+        first.delete()
+        second.refresh_from_db()
+        self.failUnless(os.path.isfile(second.image.path), 'referenced file was deleted')
+        second.delete()
+        self.failIf(os.path.isfile(second.image.path), 'file was not deleted with its last image')
+        third.delete()
+
+
+    def test_timelapse(self):
+        """
+        test building time-lapses from cached segments per day
+        """
+        c = Client()
+        img = Image.new('RGB', (800, 600), (0, 128, 0))
+        self.upload_test_image(img, '2021-04-20_12-00-00', client=c)
+        self.upload_test_image(img.rotate(90), '2021-04-21_12-00-00', client=c)
+        self.upload_test_image(img.rotate(45), '2021-04-21_13-00-00', client=c)
+        start, end = date(2021, 4, 20), date(2021, 4, 21)
+
+        # check the frames of both formats
+        webp = Image.open(BytesIO(build_timelapse(self.psu, start, end, 'webp')))
+        self.failUnlessEqual((webp.n_frames, webp.size), (3, settings.PSU_TIMELAPSE_SIZE), 'wrong frames in animated WebP')
+        webp.seek(2)
+        webp.load()
+        mjpeg = build_timelapse(self.psu, start, end, 'mjpeg')
+        self.failUnlessEqual(mjpeg.count(b'\xff\xd8\xff'), 3, 'wrong number of frames in MJPEG')
+        self.failUnlessEqual(build_timelapse(self.psu, date(2021, 4, 1), date(2021, 4, 2), 'webp'), None, 'time-lapse without images')
+
+        # only the segment of the day with a new image is encoded again
+        directory = settings.SECURE_MEDIA_STORAGE.path('timelapse/{}/webp'.format(self.psu.id))
+        segments = sorted(os.listdir(directory))
+        self.upload_test_image(img.rotate(30), '2021-04-21_14-00-00', client=c)
+        webp = Image.open(BytesIO(build_timelapse(self.psu, start, end, 'webp')))
+        self.failUnlessEqual(webp.n_frames, 4, 'new image is missing in time-lapse')
+        new_segments = sorted(os.listdir(directory))
+        self.failUnlessEqual((len(new_segments), new_segments[0]), (2, segments[0]), 'segments were not cached per day')
+        self.failIfEqual(new_segments[1], segments[1], 'segment of the day with the new image was not encoded again')
+
+        # check the frontend view
+        viewer = User.objects.create(email='viewer@test.de', first_name='Test', last_name='Viewer')
+        self.psu.permitted_users.add(viewer)
+        c.force_login(viewer)
+        uri = '/en/psufrontend/timelapse/psu/{}/7d'.format(self.psu.id)
+        self.failUnlessEqual(c.get(uri).status_code, 404, 'time-lapse without images in the last week')
+        self.failUnlessEqual(c.get(uri, {'format': 'gif'}).status_code, 404, 'time-lapse in unknown format')
+        self.upload_test_image(img.rotate(60), timezone.localtime().strftime('%Y-%m-%d_%H-%M-%S'))
+        res = c.get(uri, {'format': 'mjpeg'})
+        self.failUnlessEqual((res.status_code, res['Content-Type']), (200, 'video/x-motion-jpeg'), 'time-lapse of the last week was not delivered')
+        # ranges are limited to PSU_TIMELAPSE_MAX_DAYS
+        with self.settings(PSU_TIMELAPSE_MAX_DAYS=1):
+            self.failUnlessEqual(c.get('/en/psufrontend/timelapse/psu/{}/10000d'.format(self.psu.id), {'format': 'mjpeg'}).status_code, 200,
+                                 'time-lapse of a long range was not delivered')
+
+        # segments of the days before the lease time are removed by cleanimages (two days in both formats)
+        out = StringIO()
+        call_command('cleanimages', '1d', stdout=out)
+        self.failUnless('Removed 4 time-lapse segments.' in out.getvalue(), 'wrong output of cleanimages: {}'.format(out.getvalue()))
+        self.failUnlessEqual(len(os.listdir(settings.SECURE_MEDIA_STORAGE.path('timelapse/{}/mjpeg'.format(self.psu.id)))), 1,
+                             'segment of today was deleted')
+
+        for image in PSUImage.objects.filter(psu=self.psu):
+            image.delete()
+        shutil.rmtree(settings.SECURE_MEDIA_STORAGE.path('timelapse/{}'.format(self.psu.id)))
+
+
+    def test_signed_media_url(self):
+        """
+        test signed and expiring urls of PSUImages
+        """
+        c = Client()
+        self.upload_test_image(Image.new('RGB', (800, 600), (0, 128, 0)), '2021-04-20_12-00-00', client=c)
+        pi = PSUImage.objects.get(psu=self.psu)
+
+        # valid urls are handed over to the web server without login
+        for size in [None, 'thumbnail']:
+            url = psuimage_url(pi, size)
+            res = Client().get(url)
+            path = pi.image.name if size is None else derivative_name(pi.image.name, size)
+            self.failUnlessEqual(res['X-Accel-Redirect'], '/protectedmedia/' + path, 'signed url {} was not accepted'.format(url))
+
+        # the url of the original is signed instead of a missing derivative (which is not created while rendering)
+        os.remove(settings.SECURE_MEDIA_STORAGE.path(derivative_name(pi.image.name, 'medium')))
+        res = Client().get(psuimage_url(pi, 'medium'))
+        self.failUnlessEqual(res['X-Accel-Redirect'], '/protectedmedia/' + pi.image.name, 'missing derivative was not replaced by the original')
+        self.failIf(settings.SECURE_MEDIA_STORAGE.exists(derivative_name(pi.image.name, 'medium')), 'derivative was created for the url')
+
+        # manipulated urls are rejected
+        self.failUnlessEqual(Client().get(url.replace('thumbnail', 'medium')).status_code, 403, 'manipulated signed url was accepted')
+        self.failUnlessEqual(Client().get(url.split('?')[0]).status_code, 403, 'url without signature was accepted')
+
+        # expired urls are rejected
+        expires = int(time()) - 1
+        url = '{}{}?md5={}&expires={}'.format(settings.SIGNED_MEDIA_URL, pi.image.name, sign_media_path(pi.image.name, expires), expires)
+        self.failUnlessEqual(Client().get(url).status_code, 410, 'expired signed url was accepted')
+
+        pi.delete()
+
+
+    def test_image_storage_commands(self):
+        """
+        test the date-sharded layout and the commands shardimages and cleanimages
+        """
+        c = Client()
+        img = Image.new('RGB', (64, 48), (0, 128, 0))
+        self.upload_test_image(img, '2021-04-20_12-00-00', client=c)
+        self.upload_test_image(img.rotate(90), '2021-04-21_12-00-00', client=c)
+        first, second = PSUImage.objects.filter(psu=self.psu).order_by('timestamp')
+        self.failUnless(first.image.name.startswith('psufeed/{}/2021/04/20/'.format(self.psu.id)), 'image {} not stored date-sharded'.format(first.image.name))
+
+        # move the first image back to the flat layout and let shardimages move it again
+        flat = 'psufeed/{}/2021-04-20_12-00-00.png'.format(self.psu.id)
+        os.rename(first.image.path, settings.SECURE_MEDIA_STORAGE.path(flat))
+        PSUImage.objects.filter(id=first.id).update(image=flat)
+        call_command('shardimages', stdout=StringIO())
+        first.refresh_from_db()
+        self.failUnless(first.image.name.startswith('psufeed/{}/2021/04/20/'.format(self.psu.id)) and os.path.isfile(first.image.path),
+                        'image {} was not moved to the date-sharded layout'.format(first.image.name))
+
+        # delete all images with chunks of one image
+        paths = [first.image.path, second.image.path, settings.SECURE_MEDIA_STORAGE.path(derivative_name(first.image.name, 'thumbnail'))]
+        out = StringIO()
+        call_command('cleanimages', '1d', chunk=1, stdout=out)
+        self.failUnless('Removed 2 images and 2 files.' in out.getvalue(), 'wrong output of cleanimages: {}'.format(out.getvalue()))
+        self.failUnlessEqual(PSUImage.objects.filter(psu=self.psu).count(), 0, 'images were not deleted')
+        for path in paths:
+            self.failIf(os.path.isfile(path), 'file {} was not deleted'.format(path))
+
 
     def test_watering_task(self):
         """
@@ -466,3 +997,523 @@ class PSUCommunicationTestCase(TransactionTestCase):
         # Try getting another watering task which does not exist
         data['signed_challenge'] = self.get_signed_msg()
         self.check_error_code(uri, '0xW1', data=data, client=c)
+
+
+    def test_async_views(self):
+        """
+        test the async versions of the views (psucontrol/async/...)
+        """
+        c = Client()
+
+        # Test registration process
+        uri = '/psucontrol/async/register_new_psu'
+        self.check_error_code(uri, '0xB1', client=c)
+        self.check_error_code(uri, '0xA3', data={'public_rsa_key': 'TESTING KEY'}, client=c)
+        pub_rsa_str = str(rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo), 'utf-8')
+        self.check_status(uri, True, data={'public_rsa_key': pub_rsa_str}, client=c)
+
+        # Test that only POST requests are allowed
+        self.failUnlessEqual(c.get(uri).status_code, 405, 'async view accepted GET request')
+
+        # Test adding a data measurement with a stored challenge
+        uri = '/psucontrol/async/add_data_measurement'
+        data = {'identity_key':self.psu.identity_key, 'signed_challenge': 'some weird challenge'}
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+        data = {'identity_key':self.psu.identity_key, 'timestamp': '2021-04-20_12-00-00', 'temperature': '21.5', 'air_humidity': '',
+                'ground_humidity': '', 'brightness': '', 'fill_level': '',
+                'signed_challenge': self.get_signed_msg(client=c, uri='/psucontrol/async/get_challenge')}
+        self.check_status(uri, True, data=data, client=c)
+        self.failUnlessEqual(DataMeasurement.objects.filter(psu=self.psu).count(), 1, 'async view did not store the data measurement')
+
+        # Test that the challenge can only be used once
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+
+        # Test getting the watering task with a stateless challenge
+        uri = '/psucontrol/async/get_watering_task'
+        challenge, signed = self.get_stateless_signed_msg(client=c)
+        data = {'identity_key':self.psu.identity_key, 'challenge': challenge, 'signed_challenge': signed}
+        res = self.check_status(uri, True, data=data, client=c)
+        self.check_dict_value(uri, data, res, "watering_task_id", self.wt2.id)
+        self.check_error_code(uri, '0xA2', data=data, client=c)
+
+        # Test marking the watering task as done
+        uri = '/psucontrol/async/mark_watering_task_executed'
+        data = {'identity_key':self.psu.identity_key, 'watering_task_id': str(self.wt2.id),
+                'signed_challenge': self.get_signed_msg(client=c, uri='/psucontrol/async/get_challenge')}
+        self.check_status(uri, True, data=data, client=c)
+        self.wt2.refresh_from_db()
+        self.failUnlessEqual(self.wt2.status, 20, 'The last WateringTask has status {} but should have 20.'.format(self.wt2.status))
+
+
+    def test_rate_limit(self):
+        """
+        test the limits of psucontrol.ratelimit.RateLimitMiddleware
+        """
+        uri = '/psucontrol/get_challenge'
+        caches['ratelimit'].clear()
+        c = Client()
+        data = {'identity_key': self.psu.identity_key}
+
+        with self.settings(PSU_RATE_LIMITS={'get_challenge': {'psu': (0.01, 3), 'ip': None}, 'add_image': {'psu': None, 'ip': (0.01, 1)}}):
+            # burst of 3 requests, the fourth one has to wait until the window of 300 seconds slides on
+            for i in range(3):
+                self.check_status(uri, True, data=data, client=c)
+            logged = CommunicationLogEntry.objects.count()
+            res = c.post(uri, data)
+            self.failUnlessEqual(res.status_code, 429, 'request after the burst was not rejected')
+            self.failUnlessEqual((res.json()['error_code'], res['Retry-After']), ('0xR1', str(res.json()['retry_after'])), 'wrong retry-after hint')
+            self.failUnless(0 < res.json()['retry_after'] <= 600, 'wrong retry-after {}'.format(res.json()['retry_after']))
+            self.failUnlessEqual(CommunicationLogEntry.objects.count(), logged, 'rejected request was logged')
+
+            # async view shares the counter
+            self.failUnlessEqual(c.post('/psucontrol/async/get_challenge', data).status_code, 429, 'async request after the burst was not rejected')
+
+            # unknown identity keys get no counters
+            for i in range(5):
+                self.check_error_code(uri, '0xA1', data={'identity_key': 'somekey'}, client=c)
+
+            # not limited endpoints
+            self.check_status('/psucontrol/get_watering_task', False, data=data, client=c)
+
+            # limit by client ip, the last address of X-Forwarded-For is used
+            with self.settings(PSU_RATE_LIMIT_IP_HEADER='HTTP_X_FORWARDED_FOR'):
+                res = c.post('/psucontrol/add_image', data, HTTP_X_FORWARDED_FOR='10.0.0.1, 192.0.2.1')
+                self.failUnlessEqual(res.json()['error_code'], '0xB1', 'first request of the client ip was rejected')
+                res = c.post('/psucontrol/add_image', data, HTTP_X_FORWARDED_FOR='10.0.0.2, 192.0.2.1')
+                self.failUnlessEqual(res.status_code, 429, 'second request of the client ip was not rejected')
+
+        # sliding window of 10 seconds with 10 requests: no second burst right after the border of two windows
+        key = 'psucontrol.test.ratelimit'
+        self.failUnlessEqual([take_token(key, 1, 10, now=1000.0) for i in range(11)].count(0), 10, 'wrong number of requests in the first window')
+        self.failUnless(take_token(key, 1, 10, now=1010.5) > 0, 'request right after the border was not rejected')
+        self.failUnlessEqual([take_token(key, 1, 10, now=1015.0) for i in range(6)].count(0), 5, 'wrong number of requests in the middle of the next window')
+
+        # counters of the cache of the rate limits (website.cache.DatabaseCache) keep their expiry
+        counters = caches['ratelimit']
+        counters.add('psucontrol.test.counter', 0, 10)
+        self.failUnlessEqual([counters.incr('psucontrol.test.counter') for i in range(3)], [1, 2, 3], 'wrong values of the counter')
+        self.assertRaises(ValueError, counters.incr, 'psucontrol.test.missing')
+
+
+    def test_metrics(self):
+        """
+        test the metrics of the device API exposed at /metrics
+        """
+        metrics_dir = os.path.join(settings.SECURE_MEDIA_ROOT, 'test_metrics')
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        os.makedirs(metrics_dir)
+        # values of another process
+        with open(os.path.join(metrics_dir, '1-0000.json'), 'w') as f:
+            json.dump({'counters': [['psucontrol_requests_total', [['endpoint', 'get_challenge'], ['status', '200']], 5]], 'histograms': []}, f)
+        # values of a dead process of this host
+        dead = subprocess.Popen([sys.executable, '-c', ''])
+        dead.wait()
+        dead_file = os.path.join(metrics_dir, '{}-{}-0000.json'.format(socket.gethostname(), dead.pid))
+        with open(dead_file, 'w') as f:
+            json.dump({'counters': [['psucontrol_watering_coalesced_total', [], 3]],
+                       'gauges': [['psucontrol_watering_queue_depth', [], 7]], 'histograms': []}, f)
+
+        c = Client()
+        metrics.registry.reset()
+        with self.settings(PSU_METRICS_DIR=metrics_dir, PSU_METRICS_TOKEN='metricstoken'):
+            # processes without values write no file
+            metrics.registry.flush()
+            self.failIf(os.path.isfile(os.path.join(metrics_dir, metrics.registry.file_name)), 'file was written without values')
+
+            data = {'identity_key': self.psu.identity_key, 'signed_challenge': self.get_signed_msg(client=c)}
+            self.check_error_code('/psucontrol/add_data_measurement', '0xB1', data=data, client=c)
+            self.check_error_code('/psucontrol/get_challenge', '0xA1', data={'identity_key': 'somekey'}, client=c)
+
+            # hidden without staff user or token
+            self.failUnlessEqual(c.get('/metrics').status_code, 404, '/metrics is accessible without authorization')
+            self.failUnlessEqual(c.get('/metrics', HTTP_AUTHORIZATION='Bearer wrongtoken').status_code, 404, '/metrics is accessible with a wrong token')
+
+            res = c.get('/metrics', HTTP_AUTHORIZATION='Bearer metricstoken')
+            self.failUnlessEqual(res.status_code, 200, '/metrics is not accessible with the token')
+            text = res.content.decode()
+            for line in ['psucontrol_requests_total{endpoint="get_challenge",status="200"} 7',
+                         'psucontrol_errors_total{endpoint="get_challenge",error_code="0xA1"} 1',
+                         'psucontrol_errors_total{endpoint="add_data_measurement",error_code="0xB1"} 1',
+                         'psucontrol_request_duration_seconds_count{endpoint="get_challenge"} 2',
+                         'psucontrol_rsa_verify_duration_seconds_count 1',
+                         'psucontrol_log_write_duration_seconds_bucket{le="+Inf"}',
+                         '# TYPE psucontrol_watering_calculation_duration_seconds histogram']:
+                self.failUnless(line in text, '/metrics does not contain {}'.format(line))
+
+            # the counters of the dead process are archived, its gauges are dropped
+            self.failIf(os.path.isfile(dead_file), 'file of the dead process was not removed')
+            self.failUnless(os.path.isfile(os.path.join(metrics_dir, metrics.ARCHIVE_FILE)), 'values of the dead process were not archived')
+            text = c.get('/metrics', HTTP_AUTHORIZATION='Bearer metricstoken').content.decode()
+            self.failUnless('psucontrol_watering_coalesced_total 3' in text, 'archived counter is missing')
+            self.failIf('psucontrol_watering_queue_depth 7' in text, 'gauge of the dead process was reported')
+
+            # the files are readable by other users
+            for file_name in [metrics.registry.file_name, metrics.ARCHIVE_FILE]:
+                self.failUnlessEqual(os.stat(os.path.join(metrics_dir, file_name)).st_mode & 0o777, 0o644, 'wrong mode of {}'.format(file_name))
+
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+    def test_watering_lookups(self):
+        """
+        test the indexed lookups of the measurements used by CalculateWatering
+        """
+        now = timezone.now().replace(microsecond=0)
+        execution = now - timedelta(hours=1)
+        # measurements every 15 minutes, the newest and the ones around the execution without ground humidity
+        for i in range(12):
+            DataMeasurement.objects.create(psu=self.psu, timestamp=now - timedelta(minutes=15 * i), temperature=20.0,
+                                           ground_humidity=None if i in (0, 3, 4) else float(i))
+        current = latest_ground_humidity_measurement(self.psu)
+        self.failUnlessEqual(current.timestamp, now - timedelta(minutes=15), 'wrong latest measurement with ground humidity')
+        prev_dm, after_dm = ground_humidity_measurements_around(self.psu, execution)
+        self.failUnlessEqual((prev_dm.ground_humidity, after_dm.ground_humidity), (5.0, 2.0), 'wrong measurements around the execution')
+        prev_dm, after_dm = ground_humidity_measurements_around(self.psu, now + timedelta(hours=1))
+        self.failUnlessEqual((prev_dm, after_dm), (current, None), 'wrong measurements after the newest one')
+
+        out = StringIO()
+        call_command('benchmarkwatering', sizes=[100, 200], repeat=1, stdout=out)
+        self.failUnless('200' in out.getvalue(), 'wrong output of benchmarkwatering: {}'.format(out.getvalue()))
+        self.failUnlessEqual(PSU.objects.filter(name='BENCHMARK').count(), 0, 'benchmark data was not removed')
+
+
+    def test_psu_state(self):
+        """
+        test the incremental updates of PSUState and the command repairpsustate
+        """
+        self.psu.watering_params = WateringParams.objects.create(name='STATE', kp=1, ki=0, kd=0, dt=1, ground_humidity_goal=80, light_level_limit=10,
+                                                                 temperature_limit=40, minimum_amount=10, maximum_amount=500, starting_amount=50)
+        self.psu.save()
+        now = timezone.now().replace(microsecond=0)
+        calc = CalculateWatering(self.psu)
+        # the state is built by the first calculation
+        self.failUnlessEqual(calc.crunch_data(), 0, 'no measurements should not water the plant')
+        state = PSUState.objects.get(psu=self.psu)
+        self.failUnlessEqual(state.current_timestamp, None, 'state without measurements should be empty')
+
+        # measurements before the execution
+        insert_data_measurements([DataMeasurement(psu=self.psu, timestamp=now - timedelta(hours=2), ground_humidity=40.0, brightness=50.0),
+                                  DataMeasurement(psu=self.psu, timestamp=now - timedelta(hours=3), ground_humidity=30.0, brightness=50.0)])
+        task = WateringTask.objects.create(psu=self.psu, amount=100, status=10)
+        state.refresh_from_db()
+        self.failUnlessEqual((state.current_ground_humidity, state.latest_task_timestamp), (40.0, task.timestamp), 'measurements or task missing in the state')
+
+        task.status = 20
+        task.timestamp_execution = now - timedelta(hours=1)
+        task.save()
+        # measurement without ground humidity and the one after the execution
+        insert_data_measurements([DataMeasurement(psu=self.psu, timestamp=now, temperature=20.0),
+                                  DataMeasurement(psu=self.psu, timestamp=now - timedelta(minutes=30), ground_humidity=60.0, brightness=50.0)])
+        state.refresh_from_db()
+        self.failUnlessEqual((state.last_task_id, state.prev_ground_humidity, state.after_ground_humidity, state.latest_timestamp),
+                             (task.id, 40.0, 60.0, now), 'wrong state after the execution')
+        for f in PSUState.STATE_FIELDS:
+            self.failUnlessEqual(getattr(state, f), getattr(PSUState.rebuild(self.psu, save=False), f), 'state differs from the stored data in {}'.format(f))
+
+        # (80 - 60) / (60 - 40) * 100 ml
+        self.failUnlessEqual(CalculateWatering(self.psu).crunch_data_dry(), 100, 'wrong amount calculated from the state')
+        with self.assertNumQueries(1):
+            CalculateWatering(self.psu).crunch_data_dry()
+
+        # measurements deleted without the views are fixed by the command repairpsustate
+        DataMeasurement.objects.filter(psu=self.psu, timestamp=now - timedelta(minutes=30)).delete()
+        out = StringIO()
+        call_command('repairpsustate', check=True, stdout=out)
+        self.failUnless('1 inconsistent' in out.getvalue(), 'inconsistent state not found: {}'.format(out.getvalue()))
+        call_command('repairpsustate', stdout=out)
+        state.refresh_from_db()
+        self.failUnlessEqual((state.after_timestamp, state.current_ground_humidity), (None, 40.0), 'state was not repaired')
+        out = StringIO()
+        call_command('repairpsustate', stdout=out)
+        self.failUnless('repaired 0' in out.getvalue(), 'repaired state should be consistent: {}'.format(out.getvalue()))
+
+
+    def test_pid_controller(self):
+        """
+        test the PID controller of WateringParams.Algorithm.PID
+        """
+        self.psu.watering_params = WateringParams.objects.create(name='PID', algorithm=WateringParams.Algorithm.PID, kp=2, ki=0.5, kd=1, dt=1,
+                                                                 ground_humidity_goal=80, light_level_limit=10, temperature_limit=40,
+                                                                 minimum_amount=10, maximum_amount=100, starting_amount=50)
+        self.psu.save()
+        now = timezone.now().replace(microsecond=0)
+
+        def step(minutes, ground_humidity, brightness=50.0, dry=False):
+            insert_data_measurements([DataMeasurement(psu=self.psu, timestamp=now + timedelta(minutes=minutes),
+                                                      ground_humidity=ground_humidity, brightness=brightness)])
+            calc = CalculateWatering(self.psu)
+            return calc.crunch_data_dry() if dry else calc.crunch_data()
+
+        # error 20: 2 * 20 + 0.5 * 20, the dry calculation does not store the step
+        self.failUnlessEqual(step(0, 60.0, dry=True), 50, 'wrong first dry step')
+        self.failUnlessEqual(CalculateWatering(self.psu).crunch_data(), 50, 'wrong first step')
+        self.failUnlessEqual(CalculateWatering(self.psu).crunch_data(), 0, 'a measurement should be used only once')
+        # error 10: 2 * 10 + 0.5 * 30 + (10 - 20)
+        self.failUnlessEqual(step(15, 70.0), 25, 'wrong second step')
+        # too dark: no step
+        self.failUnlessEqual(step(30, 0.0, brightness=5.0), 0, 'no watering in the dark')
+        # error 80: clamped to the maximum amount without growing the integral
+        self.failUnlessEqual(step(45, 0.0), 100, 'output should be clamped to the maximum amount')
+        state = PSUState.objects.get(psu=self.psu)
+        self.failUnlessEqual((state.pid_integral, state.pid_previous_error), (30.0, 80.0), 'integral should not wind up')
+        # error -20: below the minimum amount, the integral does not shrink further
+        self.failUnlessEqual(step(60, 100.0), 0, 'too wet should not water the plant')
+
+        # the memory of the controller is kept by the command repairpsustate
+        PSUState.objects.filter(psu=self.psu).update(current_timestamp=None)
+        call_command('repairpsustate', stdout=StringIO())
+        state.refresh_from_db()
+        self.failUnlessEqual((state.pid_integral, state.current_timestamp), (30.0, now + timedelta(minutes=60)), 'wrong repaired state')
+
+
+    def test_watering_calculation_pool(self):
+        """
+        test the coalescing of watering calculations per PSU in WateringCalculationPool
+        """
+        pool = WateringCalculationPool()
+        calculated = []
+        pool.calculate = lambda psu: calculated.append(psu.id)
+        other = PSU.objects.create(name='Other PSU', identity_key='other-key', public_rsa_key='other-public-key', owner=self.psu.owner)
+
+        # block the only worker until all calculations are submitted
+        blocker = Event()
+        pool.executor = ThreadPoolExecutor(max_workers=1)
+        pool.executor.submit(blocker.wait)
+        metrics.registry.reset()
+
+        results = [pool.submit(self.psu) for i in range(10)] + [pool.submit(other)]
+        self.failUnlessEqual(results, [True] + [False] * 9 + [True], 'calculations of the same PSU were not coalesced')
+        self.failUnlessEqual(metrics.registry.gauges[('psucontrol_watering_queue_depth', ())], 2, 'wrong queue depth')
+        self.failUnlessEqual(metrics.registry.counters[('psucontrol_watering_coalesced_total', ())], 9, 'wrong number of coalesced calculations')
+
+        blocker.set()
+        pool.executor.shutdown(wait=True)
+        self.failUnlessEqual(sorted(calculated), sorted([self.psu.id, other.id]), 'every PSU should be calculated once')
+        self.failUnlessEqual(metrics.registry.gauges[('psucontrol_watering_queue_depth', ())], 0, 'queue should be empty')
+
+
+    @override_settings(PSU_IMAGE_DERIVATIVES_QUEUE_SIZE=2)
+    def test_derivatives_pool(self):
+        """
+        test the bounded queue of DerivativesPool
+        """
+        pool = DerivativesPool()
+        created = []
+        pool.create = created.append
+
+        # block the only worker until all images are submitted
+        blocker = Event()
+        pool.executor = ThreadPoolExecutor(max_workers=1)
+        pool.executor.submit(blocker.wait)
+        metrics.registry.reset()
+
+        results = [pool.submit(name) for name in ['a.png', 'a.png', 'b.png', 'c.png']]
+        self.failUnlessEqual(results, [True, True, True, False], 'images beyond the queue size were not dropped')
+        self.failUnlessEqual(metrics.registry.counters[('psucontrol_image_derivatives_dropped_total', ())], 1, 'wrong number of dropped images')
+
+        blocker.set()
+        pool.executor.shutdown(wait=True)
+        self.failUnlessEqual(created, ['a.png', 'b.png'], 'every queued image should be processed once')
+        self.failUnlessEqual(metrics.registry.gauges[('psucontrol_image_derivatives_queue_depth', ())], 0, 'queue should be empty')
+
+
+    def test_watering_job_queue(self):
+        """
+        test the durable queue of watering calculations and the command wateringworker
+        """
+        uri = '/psucontrol/add_data_measurement'
+        c = Client()
+
+        # measurements create one job per PSU
+        with self.settings(PSU_WATERING_JOB_QUEUE=True):
+            for ts in ['2021-04-20_12-00-00', '2021-04-20_12-15-00']:
+                data = {'identity_key': self.psu.identity_key, 'signed_challenge': self.get_signed_msg(client=c), 'timestamp': ts,
+                        'temperature': '20.0', 'air_humidity': '', 'ground_humidity': '45.0', 'brightness': '', 'fill_level': ''}
+                self.check_status(uri, True, data=data, client=c)
+        self.failUnlessEqual(WateringJob.objects.filter(psu=self.psu).count(), 1, 'there should be one job for the PSU')
+
+        # a claimed job is hidden from other workers
+        job, = claim_watering_jobs(10)
+        self.failUnlessEqual((job.psu, job.attempts), (self.psu, 1), 'wrong job claimed')
+        self.failUnlessEqual(claim_watering_jobs(10), [], 'claimed job was claimed twice')
+
+        # a job requested again during the calculation runs once more
+        enqueue_watering_job(self.psu)
+        complete_watering_job(job)
+        job, = claim_watering_jobs(10)
+        complete_watering_job(job)
+        self.failUnlessEqual(WateringJob.objects.count(), 0, 'completed job was not deleted')
+
+        # failed jobs are delayed and given up after PSU_WATERING_JOB_MAX_ATTEMPTS
+        enqueue_watering_job(self.psu)
+        job, = claim_watering_jobs(10)
+        fail_watering_job(job, 'test error')
+        self.failUnlessEqual(claim_watering_jobs(10), [], 'failed job was not delayed')
+        WateringJob.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        job, = claim_watering_jobs(10)
+        self.failUnlessEqual((job.attempts, job.last_error), (2, 'test error'), 'failed job was not counted')
+        WateringJob.objects.update(locked_until=None, attempts=settings.PSU_WATERING_JOB_MAX_ATTEMPTS)
+        self.failUnlessEqual(claim_watering_jobs(10), [], 'job without attempts left was claimed')
+
+        # a new request gives the job new attempts and the worker processes it
+        enqueue_watering_job(self.psu)
+        out = StringIO()
+        call_command('wateringworker', once=True, stdout=out)
+        self.failUnless('Processed 1 jobs, 0 failed.' in out.getvalue(), 'wrong output of wateringworker: {}'.format(out.getvalue()))
+        self.failUnlessEqual(WateringJob.objects.count(), 0, 'processed job was not deleted')
+
+
+    def test_loadtest(self):
+        """
+        test the command loadtest with a small fleet
+        """
+        out = StringIO()
+        # one worker, the in-memory SQLite database of the tests locks whole tables
+        call_command('loadtest', number=2, cycles=2, workers=1, image_every=2, key_size=1024, stdout=out)
+        text = out.getvalue()
+        for line in ['add_data_measurement         ok                  4', 'add_image                    ok                  2',
+                     'register_new_psu             ok                  2', 'No errors.']:
+            self.failUnless(line in text, 'output of loadtest does not contain {}:\n{}'.format(line, text))
+        self.failUnlessEqual(PSU.objects.filter(name__startswith='LOADTEST').count(), 0, 'simulated PSUs were not deleted')
+
+
+    @override_settings(PSU_LONG_POLL_INTERVAL=30)
+    def test_wait_for_watering_task(self):
+        """
+        test the long-poll version of get_watering_task
+        """
+        uri = '/psucontrol/async/wait_for_watering_task'
+
+        c = Client()
+
+        # Test error 0xB1 if no post data is given
+        self.check_error_code(uri, '0xB1', client=c)
+
+        # Test error 0xB1 if the timeout is no number
+        data = {'identity_key':self.psu.identity_key, 'timeout': 'soon', 'signed_challenge': self.get_signed_msg(client=c)}
+        self.check_error_code(uri, '0xB1', data=data, client=c)
+
+        # Test error 0xB1 if the timeout is not finite
+        for timeout in ['nan', 'inf']:
+            data = {'identity_key':self.psu.identity_key, 'timeout': timeout, 'signed_challenge': self.get_signed_msg(client=c)}
+            self.check_error_code(uri, '0xB1', data=data, client=c)
+
+        # Test that an existing task is returned immediately
+        data = {'identity_key':self.psu.identity_key, 'timeout': '30', 'signed_challenge': self.get_signed_msg(client=c)}
+        start = monotonic()
+        res = self.check_status(uri, True, data=data, client=c)
+        self.check_dict_value(uri, data, res, "watering_task_id", self.wt2.id)
+        self.failUnless(monotonic() - start < 5, 'request with an existing watering task was held open')
+
+        # Test error 0xW1 after the timeout
+        self.wt2.status = 20
+        self.wt2.save()
+        data = {'identity_key':self.psu.identity_key, 'timeout': '0.3', 'signed_challenge': self.get_signed_msg(client=c)}
+        self.check_error_code(uri, '0xW1', data=data, client=c)
+
+        # Test that a task created while waiting is returned (woken up by the signal long before the next check)
+        timer = Timer(0.5, lambda: WateringTask.objects.create(psu=self.psu, amount=300, status=5))
+        data = {'identity_key':self.psu.identity_key, 'timeout': '30', 'signed_challenge': self.get_signed_msg(client=c)}
+        start = monotonic()
+        timer.start()
+        res = self.check_status(uri, True, data=data, client=c)
+        timer.join()
+        self.check_dict_value(uri, data, res, "watering_task_amount", 300)
+        self.failUnless(monotonic() - start < 5, 'new watering task was not returned while waiting')
+
+
+class PublicKeyCacheTestCase(TestCase):
+    """
+    TestCase to test the cache of deserialized public keys
+    """
+
+    def setUp(self):
+        """
+        setup of the testing environment
+        """
+        public_key_cache.clear()
+        self.pub_rsa_strs = []
+        for i in range(3):
+            pk = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            self.pub_rsa_strs.append(str(pk.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo), 'utf-8'))
+
+
+    def test_hits_and_invalidation(self):
+        """
+        test counting of hits/misses and invalidation through the PSU signals
+        """
+        psu = PSU.objects.create(name='TEST-PSU', identity_key='test-key', public_rsa_key=self.pub_rsa_strs[0], owner=get_test_user())
+
+        # first load is a miss, second one a hit
+        key = public_key_cache.load(psu.id, psu.public_rsa_key)
+        self.failUnless(public_key_cache.load(psu.id, psu.public_rsa_key) is key, 'second load should return the cached key')
+        self.failUnlessEqual(public_key_cache.stats()['hits'], 1)
+        self.failUnlessEqual(public_key_cache.stats()['misses'], 1)
+
+        # saving without changing the key keeps the entry
+        psu.save()
+        self.failUnlessEqual(public_key_cache.stats()['size'], 1)
+
+        # changing the key removes the entry
+        psu.public_rsa_key = self.pub_rsa_strs[1]
+        psu.save()
+        self.failUnlessEqual(public_key_cache.stats()['size'], 0)
+
+        # deleting the PSU removes the entry
+        public_key_cache.load(psu.id, psu.public_rsa_key)
+        psu.delete()
+        self.failUnlessEqual(public_key_cache.stats()['size'], 0)
+
+
+    def test_registration_and_lru(self):
+        """
+        test handover of keys added without PSU and removal of the least recently used keys
+        """
+        cache = PublicKeyCache(2)
+
+        # key added during registration is handed over to the PSU
+        key = serialization.load_pem_public_key(bytes(self.pub_rsa_strs[0], 'utf-8'))
+        cache.add(None, self.pub_rsa_strs[0], key)
+        self.failUnless(cache.load(1, self.pub_rsa_strs[0]) is key, 'key of registration should be used')
+        self.failUnlessEqual(cache.stats()['hits'], 1)
+
+        # least recently used key is removed
+        cache.load(2, self.pub_rsa_strs[1])
+        cache.load(1, self.pub_rsa_strs[0])
+        cache.load(3, self.pub_rsa_strs[2])
+        self.failUnlessEqual(cache.stats()['size'], 2)
+        cache.load(1, self.pub_rsa_strs[0])
+        self.failUnlessEqual(cache.stats()['misses'], 2)
+        cache.load(2, self.pub_rsa_strs[1])
+        self.failUnlessEqual(cache.stats()['misses'], 3)
+
+
+class CommunicationLogWriterTestCase(TransactionTestCase):
+    """
+    TestCase to test writing log entries in the background
+    """
+
+    @override_settings(PSU_LOG_FLUSH_SIZE=3, PSU_LOG_FLUSH_INTERVAL=60)
+    def test_flush(self):
+        """
+        test flushing by size and when stopping the writer
+        """
+        writer = CommunicationLogWriter()
+        for i in range(4):
+            writer.add(CommunicationLogEntry(psu_identity_key='NONE', request=str(i), response='', level=CommunicationLogEntry.Level.MINOR_INFO, request_uri='/test'))
+
+        # first three entries are written as soon as the flush size is reached
+        for i in range(50):
+            if writer.stats()['written'] == 3:
+                break
+            sleep(0.1)
+        self.failUnlessEqual(CommunicationLogEntry.objects.count(), 3, 'first 3 entries should be written without waiting for the interval')
+
+        # remaining entry is written when stopping
+        writer.stop()
+        self.failUnlessEqual(CommunicationLogEntry.objects.count(), 4, 'all entries should be written after stopping')
+        self.failUnlessEqual(CommunicationLogEntry.objects.first().request, '3', 'entries should keep the time they were added')
+
+        # writer writes synchronously after stopping
+        writer.add(CommunicationLogEntry(psu_identity_key='NONE', request='5', response='', level=CommunicationLogEntry.Level.MAJOR_ERROR, request_uri='/test'))
+        self.failUnlessEqual(CommunicationLogEntry.objects.count(), 5, 'entries should be written directly after stopping')
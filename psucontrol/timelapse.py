@@ -0,0 +1,203 @@
+import os
+import shutil
+import struct
+import tempfile
+from datetime import datetime, time, timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from psucontrol.models import PSU, PSUImage
+
+
+# Time-lapses of the PSUImages of a PSU
+# the frames of every day are encoded once and cached as segment in SECURE_MEDIA_STORAGE under
+# timelapse/<psu id>/<format>/<date>_<number of images>_<id of last image><extension>
+# so a time-lapse only needs to encode the days with new images and to concatenate the segments
+#   mjpeg: segments are concatenated JPEG frames
+#   webp:  segments are concatenated ANMF chunks which are put into one animated WebP container
+# segments of days without images are removed by delete_segments (called by the command cleanimages)
+
+FORMATS = {
+    'webp': {'extension': '.anmf', 'content_type': 'image/webp', 'file_extension': '.webp'},
+    'mjpeg': {'extension': '.mjpeg', 'content_type': 'video/x-motion-jpeg', 'file_extension': '.mjpeg'},
+}
+
+
+def webp_chunk(fourcc, payload):
+    """
+    returns: RIFF chunk with the payload (padded to an even size)
+    """
+    chunk = fourcc + struct.pack('<I', len(payload)) + payload
+    return chunk + b'\0' if len(payload) % 2 else chunk
+
+
+def encode_webp_frame(img):
+    """
+    encodes an image as frame (ANMF chunk) of an animated WebP
+    returns: bytes
+    """
+    buf = BytesIO()
+    img.save(buf, 'WEBP', quality=settings.PSU_TIMELAPSE_QUALITY)
+    data = buf.getvalue()
+
+    # take the image data chunks of the still image (first 12 bytes are the RIFF header)
+    frame_data = b''
+    pos = 12
+    while pos < len(data):
+        fourcc = data[pos:pos + 4]
+        size = struct.unpack('<I', data[pos + 4:pos + 8])[0]
+        if fourcc in (b'ALPH', b'VP8 ', b'VP8L'):
+            frame_data += webp_chunk(fourcc, data[pos + 8:pos + 8 + size])
+        pos += 8 + size + size % 2
+
+    # position 0/0, size, duration and no blending
+    width, height = img.size
+    header = struct.pack('<I', 0)[:3] * 2 + struct.pack('<I', width - 1)[:3] + struct.pack('<I', height - 1)[:3] + \
+        struct.pack('<I', settings.PSU_TIMELAPSE_FRAME_DURATION)[:3] + bytes([0b10])
+    return webp_chunk(b'ANMF', header + frame_data)
+
+
+def webp_container(frames):
+    """
+    puts ANMF chunks into an animated WebP container with the canvas size PSU_TIMELAPSE_SIZE
+    returns: bytes
+    """
+    width, height = settings.PSU_TIMELAPSE_SIZE
+    # animation flag and canvas size
+    vp8x = bytes([0b10, 0, 0, 0]) + struct.pack('<I', width - 1)[:3] + struct.pack('<I', height - 1)[:3]
+    # black background and infinite loop
+    anim = struct.pack('<IH', 0xff000000, 0)
+    chunks = webp_chunk(b'VP8X', vp8x) + webp_chunk(b'ANIM', anim) + frames
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WEBP' + chunks
+
+
+def load_frame(image):
+    """
+    returns: PSUImage as RGB image with the size PSU_TIMELAPSE_SIZE
+    """
+    with Image.open(settings.SECURE_MEDIA_STORAGE.path(image.image.name)) as img:
+        # let the decoder downscale (e.g. JPEG) before the image is converted and resized
+        img.draft('RGB', settings.PSU_TIMELAPSE_SIZE)
+        return ImageOps.pad(img.convert('RGB'), settings.PSU_TIMELAPSE_SIZE)
+
+
+def encode_frame(img, fmt):
+    """
+    returns: image encoded as frame of the format fmt (key of FORMATS)
+    """
+    if fmt == 'webp':
+        return encode_webp_frame(img)
+
+    buf = BytesIO()
+    img.save(buf, 'JPEG', quality=settings.PSU_TIMELAPSE_QUALITY)
+    return buf.getvalue()
+
+
+def day_range(day):
+    """
+    returns: tuple of the timezone aware start of day and of the following day
+    """
+    return timezone.make_aware(datetime.combine(day, time.min)), timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+
+def encode_segment(psu, day, fmt):
+    """
+    encodes the PSUImages of a psu taken on day (at most PSU_TIMELAPSE_MAX_FRAMES_PER_DAY evenly distributed ones)
+    returns: bytes
+    """
+    start, end = day_range(day)
+    images = list(PSUImage.objects.filter(psu=psu, timestamp__gte=start, timestamp__lt=end).order_by('timestamp'))
+    if len(images) > settings.PSU_TIMELAPSE_MAX_FRAMES_PER_DAY:
+        images = [images[i * len(images) // settings.PSU_TIMELAPSE_MAX_FRAMES_PER_DAY] for i in range(settings.PSU_TIMELAPSE_MAX_FRAMES_PER_DAY)]
+
+    data = bytearray()
+    for image in images:
+        try:
+            data += encode_frame(load_frame(image), fmt)
+        except Exception as e:
+            # skip missing or broken images
+            print('Failed to add {} to time-lapse: {}'.format(image.image.name, e))
+    return bytes(data)
+
+
+def get_segment(psu, day, count, last, fmt):
+    """
+    returns: cached segment of the psu, day and fmt or a newly encoded one if the images of the day changed
+    """
+    directory = settings.SECURE_MEDIA_STORAGE.path('timelapse/{}/{}'.format(psu.id, fmt))
+    name = '{}_{}_{}{}'.format(day.isoformat(), count, last, FORMATS[fmt]['extension'])
+    path = os.path.join(directory, name)
+
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    data = encode_segment(psu, day, fmt)
+
+    # replace old segments of this day
+    os.makedirs(directory, exist_ok=True)
+    for old in os.listdir(directory):
+        if old.startswith(day.isoformat() + '_'):
+            os.remove(os.path.join(directory, old))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+    return data
+
+
+def build_timelapse(psu, start, end, fmt):
+    """
+    builds the time-lapse of the PSUImages of a psu taken from date start to date end (both inclusive)
+    returns: bytes of the time-lapse in the format fmt (key of FORMATS) or None if there are no images
+    """
+    days = PSUImage.objects.filter(psu=psu, timestamp__gte=day_range(start)[0], timestamp__lt=day_range(end)[1]) \
+        .annotate(day=TruncDate('timestamp', tzinfo=timezone.get_current_timezone())).order_by('day') \
+        .values('day').annotate(count=Count('id'), last=Max('id'))
+
+    data = b''.join(get_segment(psu, d['day'], d['count'], d['last'], fmt) for d in days)
+    if len(data) == 0:
+        return None
+
+    if fmt == 'webp':
+        return webp_container(data)
+    return data
+
+
+def delete_segments(before, psu_id=None):
+    """
+    function to delete the cached segments of the days before the date before (of all PSUs or of psu_id)
+    and the segments of deleted PSUs
+    returns: number of deleted segments
+    """
+    root = settings.SECURE_MEDIA_STORAGE.path('timelapse')
+    if not os.path.isdir(root):
+        return 0
+
+    existing = set(str(i) for i in PSU.objects.values_list('id', flat=True))
+    deleted = 0
+    for psu_dir in os.listdir(root) if psu_id is None else [str(psu_id)]:
+        path = os.path.join(root, psu_dir)
+        if not os.path.isdir(path):
+            continue
+        if psu_dir not in existing:
+            deleted += sum(len(files) for _, _, files in os.walk(path))
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+
+        for fmt in FORMATS:
+            directory = os.path.join(path, fmt)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                # segments start with the date of their day
+                if name.endswith(FORMATS[fmt]['extension']) and name[:10] < before.isoformat():
+                    os.remove(os.path.join(directory, name))
+                    deleted += 1
+    return deleted
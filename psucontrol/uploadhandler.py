@@ -0,0 +1,49 @@
+import os
+import tempfile
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile, TemporaryUploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+
+
+# number of bytes kept for the detection of the file type (imghdr needs 32 bytes)
+HEADER_SIZE = 32
+
+
+class HashedUploadedFile(TemporaryUploadedFile):
+    """
+    uploaded file which is stored in PSU_IMAGE_UPLOAD_DIR and knows its SHA-256 and its first bytes
+    PSU_IMAGE_UPLOAD_DIR is on the same file system as SECURE_MEDIA_ROOT, so the storage
+    only has to rename the file instead of copying it
+    """
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        os.makedirs(settings.PSU_IMAGE_UPLOAD_DIR, exist_ok=True)
+        _, ext = os.path.splitext(name)
+        file = tempfile.NamedTemporaryFile(suffix='.upload' + ext, dir=settings.PSU_IMAGE_UPLOAD_DIR)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+        self.header = b''
+        self.sha256 = ''
+
+
+class HashingFileUploadHandler(TemporaryFileUploadHandler):
+    """
+    upload handler writing the uploaded files directly to disk while computing their SHA-256
+    has to be set before request.POST or request.FILES is accessed
+    """
+
+    def new_file(self, *args, **kwargs):
+        super(TemporaryFileUploadHandler, self).new_file(*args, **kwargs)
+        self.file = HashedUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+        self.hash = sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        if len(self.file.header) < HEADER_SIZE:
+            self.file.header += raw_data[:HEADER_SIZE - len(self.file.header)]
+        self.hash.update(raw_data)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.sha256 = self.hash.hexdigest()
+        return super().file_complete(file_size)
@@ -1,5 +1,6 @@
 from django.urls import path
 
+import psucontrol.async_views as av
 import psucontrol.views as v
 
 app_name = 'psucontrol'
@@ -7,8 +8,19 @@ app_name = 'psucontrol'
 urlpatterns = [
     path(r'register_new_psu', v.register_new_psu, name="register_new_psu"),
     path(r'get_challenge', v.get_challenge, name="get_challenge"),
+    path(r'get_session_token', v.get_session_token, name="get_session_token"),
     path(r'add_data_measurement', v.add_data_measurement, name="add_data_measurement"),
+    path(r'add_data_measurements', v.add_data_measurements, name="add_data_measurements"),
     path(r'add_image', v.add_image, name="add_image"),
     path(r'get_watering_task', v.get_watering_task, name="get_watering_task"),
     path(r'mark_watering_task_executed', v.mark_watering_task_executed, name="mark_watering_task_executed"),
+    # async versions of the views for deployments with website.asgi
+    path(r'async/register_new_psu', av.register_new_psu, name="async_register_new_psu"),
+    path(r'async/get_challenge', av.get_challenge, name="async_get_challenge"),
+    path(r'async/add_data_measurement', av.add_data_measurement, name="async_add_data_measurement"),
+    path(r'async/add_data_measurements', av.add_data_measurements, name="async_add_data_measurements"),
+    path(r'async/add_image', av.add_image, name="async_add_image"),
+    path(r'async/get_watering_task', av.get_watering_task, name="async_get_watering_task"),
+    path(r'async/wait_for_watering_task', av.wait_for_watering_task, name="async_wait_for_watering_task"),
+    path(r'async/mark_watering_task_executed', av.mark_watering_task_executed, name="async_mark_watering_task_executed"),
 ]
@@ -1,5 +1,7 @@
 import base64
+import json
 from datetime import timedelta, datetime
+from functools import lru_cache, wraps
 from pytz.exceptions import NonExistentTimeError
 from secrets import token_urlsafe, token_hex
 import imghdr
@@ -9,15 +11,23 @@ from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from django.db.utils import IntegrityError
 from django.conf import settings
-from django.http import JsonResponse
+from django.core import signing
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
 from django.utils import timezone, translation
 from django.utils.translation import gettext as _, gettext_noop
 from django.utils.timezone import make_aware
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
-from psucontrol.models import PendingPSU, PSU, DataMeasurement, PSUImage, WateringTask, CommunicationLogEntry
-from psucontrol.watering import CalculateWatering
+from psucontrol import metrics
+from psucontrol.keycache import public_key_cache
+from psucontrol.logwriter import communication_log_writer
+from psucontrol.uploadhandler import HashingFileUploadHandler
+from psucontrol.perceptualhash import dhash, hamming_distance
+from psucontrol.measurementformat import MeasurementFormatError, encoded_size, decode_measurements
+from psucontrol.models import insert_data_measurements, psu_cache_key, PendingPSU, PSU, UsedChallenge, DataMeasurement, PSUImage, WateringTask, CommunicationLogEntry
+from psucontrol.watering import schedule_watering_calculation
 
 
 # Create your views here.
@@ -27,6 +37,8 @@ ERROR_CODES = {
     '0xA1': gettext_noop('Failed to identify PSU'),
     '0xA2': gettext_noop('Failed to authenticate PSU'),
     '0xA3': gettext_noop('Failed to deserialize public key'),
+    '0xA4': gettext_noop('Session token is invalid, expired or revoked'),
+    '0xA5': gettext_noop('Session mode is disabled for this PSU'),
     # B - Bad request
     '0xB1': gettext_noop('Bad request'),
     # D - Database
@@ -35,6 +47,8 @@ ERROR_CODES = {
     '0xD3': gettext_noop('Problems with timestamp or making timestamp timezone aware.'),
     '0xD4': gettext_noop('The timestamp already exists for this PSU'),
     '0xD5': gettext_noop('Failed to upload new image.'),
+    # R - Rate limiting
+    '0xR1': gettext_noop('Too many requests, retry after the given number of seconds.'),
     # W - Watering
     '0xW1': gettext_noop('No watering task available.'),
     '0xW2': gettext_noop('Failed to mark watering task as done.'),
@@ -50,63 +64,272 @@ def remove_old_pending_psus():
             p.delete()
 
 
+# value cached for identity keys without PSU
+UNKNOWN_PSU = 'unknown'
+
+
 def identify_psu(identity_key):
     """
     function to identify a PSU
+    uses cached snapshots of the PSUs which are removed when a PSU is saved or deleted
+    unknown identity keys are cached as well to keep floods of them away from the database
     returns: corresponding PSU or None
     """
-    try:
-        return PSU.objects.get(identity_key=identity_key)
-    except PSU.DoesNotExist:
+    key = psu_cache_key(identity_key)
+    psu = cache.get(key)
+
+    if psu is None:
+        try:
+            psu = PSU.objects.get(identity_key=identity_key)
+        except PSU.DoesNotExist:
+            cache.set(key, UNKNOWN_PSU, settings.PSU_IDENTITY_CACHE_NEGATIVE_TIMEOUT)
+            return None
+        cache.set(key, psu, settings.PSU_IDENTITY_CACHE_TIMEOUT)
+
+    elif not isinstance(psu, PSU):
+        # known to be unknown
         return None
 
+    return psu
+
+
+def verify_signature(psu, challenge, message):
+    """
+    function to verify that message is the challenge signed with the private key of the psu
+    returns: bool about validity
+    """
+    try:
+        public_key = public_key_cache.load(psu.id, psu.public_rsa_key)
+        with metrics.timer('psucontrol_rsa_verify_duration_seconds'):
+            public_key.verify(base64.urlsafe_b64decode(message), bytes(challenge, 'utf-8'),
+                              padding.PSS(
+                                  mgf=padding.MGF1(hashes.SHA256()),
+                                  salt_length=padding.PSS.MAX_LENGTH),
+                              hashes.SHA256())
+        return True
+    except Exception:
+        return False
+
+
+def create_challenge(psu):
+    """
+    function to create a new challenge and store it (without saving the whole PSU)
+    returns: challenge as string
+    """
+    challenge = token_urlsafe(96)
+    PSU.objects.filter(id=psu.id).update(current_challenge=challenge)
+    return challenge
+
+
+def read_challenge(psu):
+    """
+    function to read the current challenge of a psu from the database because psu might be a cached snapshot
+    returns: challenge or empty string
+    """
+    return PSU.objects.filter(id=psu.id).values_list('current_challenge', flat=True).first() or ''
+
+
+def consume_challenge(psu, challenge):
+    """
+    function to remove the current challenge of a psu
+    returns: bool whether the challenge was still stored (only one request can use it)
+    """
+    return PSU.objects.filter(id=psu.id, current_challenge=challenge).update(current_challenge='') == 1
+
 
 def authenticate_psu(psu, message):
     """
     function to authenticate a psu
     returns: bool about access
     """
+    challenge = read_challenge(psu)
 
-    if psu.current_challenge == '':
+    if challenge == '':
         # no current challenge available
         return False
 
+    # verify message
+    valid = verify_signature(psu, challenge, message)
+
+    # remove challenge
+    return consume_challenge(psu, challenge) and valid
+
+
+def create_stateless_challenge(psu):
+    """
+    function to create a challenge which does not need to be stored
+    the challenge is signed with the SECRET_KEY and carries the id of the psu, a nonce and a timestamp
+    returns: challenge as string
+    """
+    return signing.TimestampSigner(salt='psucontrol.challenge').sign('{}:{}'.format(psu.id, token_urlsafe(32)))
+
+
+def unsign_stateless_challenge(psu, challenge):
+    """
+    function to check the signature, the age and the psu of a stateless challenge
+    returns: nonce of the challenge or None if the challenge is not valid
+    """
     try:
-        # verify message
-        public_key = serialization.load_pem_public_key(bytes(psu.public_rsa_key, 'utf-8'))
-        public_key.verify(base64.urlsafe_b64decode(message), bytes(psu.current_challenge, 'utf-8'),
-                          padding.PSS(
-                              mgf=padding.MGF1(hashes.SHA256()),
-                              salt_length=padding.PSS.MAX_LENGTH),
-                          hashes.SHA256())
-        # remove challenge
-        psu.current_challenge = ""
-        psu.save()
-        return True
-    except Exception:
-        # remove challenge
-        psu.current_challenge = ""
-        psu.save()
+        value = signing.TimestampSigner(salt='psucontrol.challenge').unsign(challenge, max_age=settings.PSU_CHALLENGE_LIFETIME)
+        psu_id, nonce = value.split(':')
+    except (signing.BadSignature, ValueError):
+        # covers expired challenges as well
+        return None
+
+    if psu_id != str(psu.id):
+        return None
+    return nonce
+
+
+def mark_challenge_used(psu, nonce):
+    """
+    function to mark a stateless challenge as used
+    returns: bool whether the challenge was not used before
+    """
+    try:
+        UsedChallenge.objects.create(psu=psu, nonce=nonce, expiry=timezone.now() + timedelta(seconds=settings.PSU_CHALLENGE_LIFETIME))
+    except IntegrityError:
+        # challenge was already used
         return False
+    return True
+
+
+def authenticate_stateless(psu, challenge, message):
+    """
+    function to authenticate a psu with a stateless challenge
+    every challenge can only be used once until it expires
+    returns: bool about access
+    """
+    nonce = unsign_stateless_challenge(psu, challenge)
+
+    if nonce is None or not verify_signature(psu, challenge, message):
+        return False
+
+    return mark_challenge_used(psu, nonce)
+
+
+def authenticate_challenge(request, psu):
+    """
+    function to authenticate a psu by its signed challenge
+    the challenge itself is only sent back for stateless challenges
+    raises KeyError if no signed challenge is given
+    returns: bool about access
+    """
+    if 'challenge' in request.POST:
+        return authenticate_stateless(psu, request.POST['challenge'], request.POST['signed_challenge'])
+    return authenticate_psu(psu, request.POST['signed_challenge'])
+
+
+def create_session_token(psu):
+    """
+    function to create a session token for a psu
+    the token is signed with the SECRET_KEY and bound to the current session_token_version of the psu
+    returns: session token as string
+    """
+    return signing.TimestampSigner(salt='psucontrol.session').sign('{}:{}'.format(psu.id, psu.session_token_version))
+
+
+def validate_session_token(psu, token):
+    """
+    function to validate a session token of a psu without touching the database
+    returns: bool about access
+    """
+    if psu.session_token_lifetime == 0:
+        # session mode disabled
+        return False
+
+    try:
+        value = signing.TimestampSigner(salt='psucontrol.session').unsign(token, max_age=psu.session_token_lifetime)
+    except signing.BadSignature:
+        # covers expired tokens as well
+        return False
+
+    # token has to belong to this psu and must not be revoked
+    return value == '{}:{}'.format(psu.id, psu.session_token_version)
+
+
+def authenticate_request(request, psu):
+    """
+    function to authenticate a request of a psu
+    uses the session token if one is given and the signed challenge otherwise
+    raises KeyError if neither of them is given
+    returns: error code or None if access is granted
+    """
+    if 'session_token' in request.POST:
+        if not validate_session_token(psu, request.POST['session_token']):
+            return '0xA4'
+    elif not authenticate_challenge(request, psu):
+        return '0xA2'
+    return None
+
+
+# fields which must not be written to the communication log
+SENSITIVE_FIELDS = ['session_token']
+
+
+def hide_sensitive_fields(data):
+    """
+    returns: copy of the dict data where the values of SENSITIVE_FIELDS are hidden
+    """
+    data = dict(data)
+    for f in SENSITIVE_FIELDS:
+        if f in data:
+            data[f] = '***'
+    return data
 
 
 def respond_n_log(request, response, level, *, psu=None):
     """
     Adds a log entry and return JsonRepsonse
+    error responses are narrowed down to one language if the request holds an Accept-Language header
     returns: JsonResponse with the dict of response
     """
-    if psu is None:
-        CommunicationLogEntry.objects.create(psu_identity_key='NONE', request=str(request.POST.dict()), response=str(response), level=level, request_uri=request.path)
+    if isinstance(response, ErrorResponse) and 'HTTP_ACCEPT_LANGUAGE' in request.META:
+        response = build_error_response(response['error_code'], translation.get_language_from_request(request))
+
+    logged_request = str(hide_sensitive_fields(request.POST.dict()))
+    if isinstance(response, ErrorResponse):
+        logged_response = response.logged
     else:
-        CommunicationLogEntry.objects.create(psu=psu, psu_identity_key=psu.identity_key, request=str(request.POST.dict()), response=str(response), level=level, request_uri=request.path)
+        logged_response = str(hide_sensitive_fields(response))
 
+    if psu is None:
+        entry = CommunicationLogEntry(psu_identity_key='NONE', request=logged_request, response=logged_response, level=level, request_uri=request.path)
+    else:
+        entry = CommunicationLogEntry(psu=psu, psu_identity_key=psu.identity_key, request=logged_request, response=logged_response, level=level, request_uri=request.path)
+
+    with metrics.timer('psucontrol_log_write_duration_seconds'):
+        if settings.PSU_LOG_ASYNC:
+            # entry is written in the background
+            communication_log_writer.add(entry)
+        else:
+            entry.save()
+
+    if isinstance(response, ErrorResponse):
+        metrics.inc('psucontrol_errors_total', endpoint=metrics.endpoint_label(request), error_code=response['error_code'])
+        # send already serialized response
+        return HttpResponse(response.content, content_type='application/json')
     return JsonResponse(response)
 
 
-def json_error_response(error_code):
+class ErrorResponse(dict):
     """
-    queries ERROR_CODES to get error message
-    returns: JsonResponse with status failed and error information
+    dict holding an error response together with its serialized JSON and its log representation
+    instances are shared between requests, so they must not be changed
+    """
+
+    def __init__(self, context):
+        super().__init__(context)
+        self.content = bytes(json.dumps(context), 'utf-8')
+        self.logged = str(context)
+
+
+@lru_cache(maxsize=None)
+def build_error_response(error_code, language=None):
+    """
+    builds the error response for an error code once
+    the message is translated to the given language or to all LANGUAGES if language is None
+    returns: ErrorResponse
     """
     try:
         message = ERROR_CODES[error_code]
@@ -116,12 +339,56 @@ def json_error_response(error_code):
     context = {'status': 'failed', 'error_code': error_code, 'error_message': message}
 
     # translate messages
-    for l in settings.LANGUAGES:
-        translation.activate(l[0])
-        context[ 'error_message_' + l[0] ] = _(context['error_message'])
-        translation.deactivate()
+    languages = [l[0] for l in settings.LANGUAGES] if language is None else [language]
+    for l in languages:
+        with translation.override(l):
+            context[ 'error_message_' + l ] = _(message)
+
+    return ErrorResponse(context)
+
+
+def build_all_error_responses():
+    """
+    builds the error responses of all ERROR_CODES in all variants (called at startup)
+    """
+    for error_code in ERROR_CODES:
+        build_error_response(error_code)
+        for l in settings.LANGUAGES:
+            build_error_response(error_code, l[0])
+
+
+def json_error_response(error_code):
+    """
+    queries ERROR_CODES to get error message
+    returns: ErrorResponse with status failed and error information
+    """
+    return build_error_response(error_code)
+
+
+def create_pending_psu(public_rsa_key):
+    """
+    function to create a PendingPSU with new identity and pairing keys
+    raises IntegrityError if the public key is already used
+    returns: created PendingPSU
+    """
+    # generate keys/tokens
+    identity_key = token_urlsafe(96)
+    pairing_key = token_hex(3).upper()
+
+    # prevent non unique pairing Key
+    while PendingPSU.objects.filter(pairing_key=pairing_key).count() != 0:
+        pairing_key = token_hex(3).upper()
+    # prevent non unique identity key
+    while PendingPSU.objects.filter(identity_key=identity_key).count() != 0 or PSU.objects.filter(
+            identity_key=identity_key).count() != 0:
+        identity_key = token_urlsafe(96)
+
+    # prevent that another PSU has the same public_rsa_key
+    if PSU.objects.filter(public_rsa_key=public_rsa_key).count() != 0:
+        raise IntegrityError()
 
-    return context
+    # try adding PendingPSU
+    return PendingPSU.objects.create(identity_key=identity_key, pairing_key=pairing_key, public_rsa_key=public_rsa_key)
 
 
 @csrf_exempt
@@ -134,28 +401,13 @@ def register_new_psu(request):
 
     if request.POST:
         try:
-            # generate keys/tokens
-            identity_key = token_urlsafe(96)
-            pairing_key = token_hex(3).upper()
-
-            # prevent non unique pairing Key
-            while PendingPSU.objects.filter(pairing_key=pairing_key).count() != 0:
-                pairing_key = token_hex(3).upper
-            # prevent non unique identity key
-            while PendingPSU.objects.filter(identity_key=identity_key).count() != 0 or PSU.objects.filter(
-                    identity_key=identity_key).count() != 0:
-                identity_key = token_urlsafe(96)
-
-            # prevent that another PSU has the same public_rsa_key
-            if PSU.objects.filter(public_rsa_key=request.POST['public_rsa_key']).count() != 0:
-                raise IntegrityError()
-
             # try to deserialize public key
-            serialization.load_pem_public_key(bytes(request.POST['public_rsa_key'], 'utf-8'))
-                
-            # try adding PendingPSU
-            PendingPSU(identity_key=identity_key, pairing_key=pairing_key,
-                       public_rsa_key=request.POST['public_rsa_key']).save()
+            public_key = serialization.load_pem_public_key(bytes(request.POST['public_rsa_key'], 'utf-8'))
+
+            pending_psu = create_pending_psu(request.POST['public_rsa_key'])
+
+            # keep deserialized key for the first authentication of the PSU
+            public_key_cache.add(None, request.POST['public_rsa_key'], public_key)
         
         except KeyError:
             # return bad request
@@ -170,7 +422,7 @@ def register_new_psu(request):
             return respond_n_log(request, json_error_response('0xD1'), CommunicationLogEntry.Level.ERROR)
 
         # successful request -> return identity_key and pairing_key
-        return respond_n_log(request, {'status': 'ok', 'identity_key': identity_key, 'pairing_key': pairing_key}, CommunicationLogEntry.Level.MAJOR_INFO)
+        return respond_n_log(request, {'status': 'ok', 'identity_key': pending_psu.identity_key, 'pairing_key': pending_psu.pairing_key}, CommunicationLogEntry.Level.MAJOR_INFO)
     else:
         # return bad request error
         return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
@@ -182,6 +434,8 @@ def get_challenge(request):
     """
     view to handle the request of a new challenge
     expects the identity_key of the PSU
+    if stateless is given the challenge is not stored, so a PSU can use several challenges at once
+    in this case the challenge has to be sent back together with the signed_challenge
     """
 
     if request.POST:
@@ -194,10 +448,14 @@ def get_challenge(request):
                 # return identification error
                 return respond_n_log(request, json_error_response('0xA1'), CommunicationLogEntry.Level.ERROR)
 
+            if 'stateless' in request.POST:
+                # generate signed challenge without touching the PSU
+                challenge = create_stateless_challenge(psu)
+                return respond_n_log(request, {'status': 'ok', 'challenge': challenge, 'challenge_lifetime': settings.PSU_CHALLENGE_LIFETIME},
+                                     CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+
             # generate new challenge and store it
-            challenge = token_urlsafe(96)
-            psu.current_challenge = challenge
-            psu.save()
+            challenge = create_challenge(psu)
 
             return respond_n_log(request, {'status': 'ok', 'challenge': challenge}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
 
@@ -210,18 +468,13 @@ def get_challenge(request):
         return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
 
 
-def none_or_float(value):
-    try:
-        return float(value)
-    except ValueError:
-        return None
-
-
 @csrf_exempt
 @require_POST
-def add_data_measurement(request):
+def get_session_token(request):
     """
-    view to handle the process to add a new data entry
+    view to handle the request of a new session token
+    expects the identity_key and a signed_challenge of the PSU
+    the session token can be sent as session_token instead of a signed_challenge until it expires
     """
     if request.POST:
         try:
@@ -232,50 +485,52 @@ def add_data_measurement(request):
                 # return identification error
                 return respond_n_log(request, json_error_response('0xA1'), CommunicationLogEntry.Level.ERROR)
 
-            # authenticate PSU
-            if not authenticate_psu(psu, request.POST['signed_challenge']):
+            # authenticate PSU (session tokens are not accepted here)
+            if not authenticate_challenge(request, psu):
                 # return authentication error
                 return respond_n_log(request, json_error_response('0xA2'), CommunicationLogEntry.Level.ERROR, psu=psu)
 
-            # try to create new DataMeasurement
-            DataMeasurement(psu=psu,
-                            timestamp=make_aware(datetime.strptime(request.POST['timestamp'], '%Y-%m-%d_%H-%M-%S')),
-                            temperature=none_or_float(request.POST['temperature']),
-                            air_humidity=none_or_float(request.POST['air_humidity']),
-                            ground_humidity=none_or_float(request.POST['ground_humidity']),
-                            brightness=none_or_float(request.POST['brightness']),
-                            fill_level=none_or_float(request.POST['fill_level'])).save()
-
-        except (NonExistentTimeError, ValueError):
-            # return timezone error
-            return respond_n_log(request, json_error_response('0xD3'), CommunicationLogEntry.Level.MAJOR_ERROR, psu=psu)
-        except IntegrityError:
-            # return already exists error
-            return respond_n_log(request, json_error_response('0xD4'), CommunicationLogEntry.Level.MINOR_ERROR, psu=psu)
+            if psu.session_token_lifetime == 0:
+                # return session mode disabled error
+                return respond_n_log(request, json_error_response('0xA5'), CommunicationLogEntry.Level.MINOR_ERROR, psu=psu)
+
+            return respond_n_log(request, {'status': 'ok', 'session_token': create_session_token(psu),
+                                           'session_token_lifetime': psu.session_token_lifetime},
+                                 CommunicationLogEntry.Level.INFO, psu=psu)
+
         except KeyError:
             # return bad request
             return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
-        except Exception:
-            # return creation error
-            return respond_n_log(request, json_error_response('0xD2'), CommunicationLogEntry.Level.ERROR, psu=psu)
 
-        # start thread to calculate the need of water and return status ok
-        CalculateWatering(psu).start()
-        return respond_n_log(request, {'status': 'ok'}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
     else:
         # return bad request type
         return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
 
 
-@csrf_exempt
-@require_POST
-def add_image(request):
+def none_or_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_timestamp(value):
     """
-    view to handle the process to a new PSUImage
+    parses a timestamp in the format sent by the PSUs
+    returns: timezone aware datetime
     """
-    if request.POST and request.FILES:
-        try:
+    return make_aware(datetime.strptime(value, '%Y-%m-%d_%H-%M-%S'))
+
 
+def identify_n_authenticate(view_func):
+    """
+    decorator for the views of authenticated requests
+    identifies and authenticates the PSU of the request and calls view_func(request, psu) afterwards
+    the same functions are used by psucontrol.async_views after authenticating asynchronously
+    """
+    @wraps(view_func)
+    def wrapped_view(request):
+        try:
             # identification of the PSU
             psu = identify_psu(request.POST['identity_key'])
 
@@ -284,125 +539,357 @@ def add_image(request):
                 return respond_n_log(request, json_error_response('0xA1'), CommunicationLogEntry.Level.ERROR)
 
             # authenticate PSU
-            if not authenticate_psu(psu, request.POST['signed_challenge']):
+            error_code = authenticate_request(request, psu)
+            if error_code is not None:
                 # return authentication error
-                return respond_n_log(request, json_error_response('0xA2'), CommunicationLogEntry.Level.ERROR, psu=psu)
-
-            # test if file is image
-            if imghdr.what(request.FILES['image']) is None:
-                # return creation error
-                return respond_n_log(request, json_error_response('0xD5'), CommunicationLogEntry.Level.ERROR, psu=psu)
+                return respond_n_log(request, json_error_response(error_code), CommunicationLogEntry.Level.ERROR, psu=psu)
 
-            img = PSUImage(psu=psu, image=request.FILES['image'],
-                           timestamp=make_aware(datetime.strptime(request.POST['timestamp'], '%Y-%m-%d_%H-%M-%S')))
-            img.save()
-
-        except (NonExistentTimeError, ValueError):
-            # return timezone error
-            return respond_n_log(request, json_error_response('0xD3'), CommunicationLogEntry.Level.MAJOR_ERROR, psu=psu)
-        except IntegrityError:
-            # return already exists error
-            return respond_n_log(request, json_error_response('0xD4'), CommunicationLogEntry.Level.MINOR_ERROR, psu=psu)
         except KeyError:
             # return bad request
             return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
-        except Exception:
-            # return creation error
-            return respond_n_log(request, json_error_response('0xD5'), CommunicationLogEntry.Level.ERROR, psu=psu)
 
-        return respond_n_log(request, {'status': 'ok'}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+        return view_func(request, psu)
+
+    return wrapped_view
+
+
+def store_data_measurement(request, psu):
+    """
+    stores the DataMeasurement of an authenticated request to add_data_measurement
+    """
+    try:
+        if 'binary' in request.FILES:
+            # measurement in the compact binary format (see psucontrol.measurementformat)
+            measurements = decode_measurements(request.FILES['binary'].read())
+            if len(measurements) != 1:
+                raise MeasurementFormatError('exactly one measurement expected')
+            dm = DataMeasurement(psu=psu, **measurements[0])
+        else:
+            dm = DataMeasurement(psu=psu,
+                                 timestamp=parse_timestamp(request.POST['timestamp']),
+                                 temperature=none_or_float(request.POST['temperature']),
+                                 air_humidity=none_or_float(request.POST['air_humidity']),
+                                 ground_humidity=none_or_float(request.POST['ground_humidity']),
+                                 brightness=none_or_float(request.POST['brightness']),
+                                 fill_level=none_or_float(request.POST['fill_level']))
+        # try to create new DataMeasurement, a resent measurement is not inserted again
+        with metrics.timer('psucontrol_db_write_duration_seconds', operation='data_measurement'):
+            duplicate = len(insert_data_measurements([dm])) == 0
+
+    except MeasurementFormatError:
+        # return bad request
+        return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR, psu=psu)
+    except (NonExistentTimeError, ValueError):
+        # return timezone error
+        return respond_n_log(request, json_error_response('0xD3'), CommunicationLogEntry.Level.MAJOR_ERROR, psu=psu)
+    except KeyError:
+        # return bad request
+        return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
+    except Exception:
+        # return creation error
+        return respond_n_log(request, json_error_response('0xD2'), CommunicationLogEntry.Level.ERROR, psu=psu)
+
+    if not duplicate:
+        # calculate the need of water in the background
+        schedule_watering_calculation(psu)
+    # a resent measurement is an idempotent success
+    return respond_n_log(request, {'status': 'ok', 'duplicate': duplicate}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+
+
+@csrf_exempt
+@require_POST
+def add_data_measurement(request):
+    """
+    view to handle the process to add a new data entry
+    the measurement can be sent as form fields or as a file binary in the compact binary format
+    """
+    if request.POST:
+        return identify_n_authenticate(store_data_measurement)(request)
     else:
         # return bad request type
         return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
 
 
+def measurement_from_dict(psu, m):
+    """
+    creates a DataMeasurement from a measurement of a JSON list sent to add_data_measurements
+    returns: unsaved DataMeasurement or error code
+    """
+    try:
+        return DataMeasurement(psu=psu, timestamp=parse_timestamp(m['timestamp']),
+                               temperature=none_or_float(m.get('temperature')),
+                               air_humidity=none_or_float(m.get('air_humidity')),
+                               ground_humidity=none_or_float(m.get('ground_humidity')),
+                               brightness=none_or_float(m.get('brightness')),
+                               fill_level=none_or_float(m.get('fill_level')))
+    except (NonExistentTimeError, ValueError):
+        # timestamp could not be parsed or made timezone aware
+        return '0xD3'
+    except (KeyError, TypeError, AttributeError):
+        # measurement is not a dict or has no timestamp
+        return '0xB1'
+
+
+def store_data_measurements(request, psu):
+    """
+    stores the DataMeasurements of an authenticated request to add_data_measurements
+    """
+    try:
+        if 'binary' in request.FILES:
+            # measurements in the compact binary format (see psucontrol.measurementformat)
+            if request.FILES['binary'].size > encoded_size(settings.PSU_MEASUREMENT_BATCH_SIZE):
+                raise MeasurementFormatError('too many measurements')
+            dms = [DataMeasurement(psu=psu, **m) for m in decode_measurements(request.FILES['binary'].read())]
+        else:
+            measurements = json.loads(request.POST['measurements'])
+            if not isinstance(measurements, list) or len(measurements) > settings.PSU_MEASUREMENT_BATCH_SIZE:
+                raise ValueError('list of at most PSU_MEASUREMENT_BATCH_SIZE measurements expected')
+            dms = [measurement_from_dict(psu, m) for m in measurements]
+    except (KeyError, ValueError):
+        # return bad request
+        return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR, psu=psu)
+
+    # valid DataMeasurements and their indices in the results
+    valid = [(i, dm) for i, dm in enumerate(dms) if not isinstance(dm, str)]
+    # error codes of measurement_from_dict
+    results = [dm if isinstance(dm, str) else None for dm in dms]
+
+    try:
+        # store all new DataMeasurements with one query skipping the already stored ones
+        with metrics.timer('psucontrol_db_write_duration_seconds', operation='data_measurements'):
+            new_dms = insert_data_measurements([dm for i, dm in valid])
+    except Exception:
+        # return creation error
+        return respond_n_log(request, json_error_response('0xD2'), CommunicationLogEntry.Level.ERROR, psu=psu)
+
+    # measurements sent twice in this batch or already stored are idempotent successes
+    new_ids = {id(dm) for dm in new_dms}
+    for i, dm in valid:
+        results[i] = 'ok' if id(dm) in new_ids else 'duplicate'
+
+    if len(new_dms) != 0:
+        # calculate the need of water once for the whole batch
+        schedule_watering_calculation(psu)
+    return respond_n_log(request, {'status': 'ok', 'results': results, 'duplicates': results.count('duplicate')},
+                         CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+
+
 @csrf_exempt
 @require_POST
-def get_watering_task(request):
+def add_data_measurements(request):
     """
-    view to handle to ge the most recent watering task
-    ALL others will be set to canceled
+    view to handle the process to add multiple data entries with one request
+    expects a JSON list of measurements in the field measurements or a file binary in the compact binary format
+    every measurement gets its own result code ('ok', '0xD3' or '0xB1'), measurements which are already stored or
+    sent twice get 'duplicate' (an idempotent success) and are counted in duplicates
     """
     if request.POST:
-        try:
-            # identification of the PSU
-            psu = identify_psu(request.POST['identity_key'])
+        return identify_n_authenticate(store_data_measurements)(request)
+    else:
+        # return bad request type
+        return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
 
-            if psu is None:
-                # return identification error
-                return respond_n_log(request, json_error_response('0xA1'), CommunicationLogEntry.Level.ERROR)
 
-            # authenticate PSU
-            if not authenticate_psu(psu, request.POST['signed_challenge']):
-                # return authentication error
-                return respond_n_log(request, json_error_response('0xA2'), CommunicationLogEntry.Level.ERROR, psu=psu)
+def use_image_upload_handler(request):
+    """
+    streams uploaded images directly to disk while computing their SHA-256
+    has to be called before request.POST or request.FILES is accessed
+    """
+    # the handler might be set already by psucontrol.ratelimit.RateLimitMiddleware (prepare_request)
+    if not getattr(request, 'uses_image_upload_handler', False):
+        request.upload_handlers = [HashingFileUploadHandler(request)]
+        request.uses_image_upload_handler = True
 
-            # get all open watering tasks for this PSU
-            tasks = WateringTask.objects.filter(psu=psu, status__in=[5, 10])
 
-            if len(tasks) == 0:
-                # return no tasks available error
-                return respond_n_log(request, json_error_response('0xW1'), CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
-            
-            # save first watering task
-            task = tasks[0]
+def find_image_reference(psu, timestamp, phash):
+    """
+    function to find the image whose file can be used instead of storing a new image of the psu
+    the perceptual hash of the new image is compared with the one of the previously stored image
+    returns: PSUImage or None if the new image has to be stored (or the psu has no image_dedup_distance)
+    """
+    if psu.image_dedup_distance is None:
+        return None
 
-            # cancel all tasks
-            for t in tasks:
-                # chancel task
-                t.status = -10
-                t.save()
+    previous = PSUImage.objects.filter(psu=psu, timestamp__lt=timestamp).select_related('reference').first()
+    if previous is None:
+        return None
 
-            # set status of task to be send to transmitted
-            task.status = 10
-            task.save()
-            return respond_n_log(request, {'status': 'ok', 'watering_task_id': task.id, 'watering_task_amount': task.amount}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+    # compare with the image which is really stored to prevent slowly drifting images
+    stored = previous.reference or previous
+    if stored.phash == '' or hamming_distance(stored.phash, phash) > psu.image_dedup_distance:
+        return None
+    return stored
 
-        except KeyError:
-            # return bad request
-            return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
+
+def store_image(request, psu):
+    """
+    stores the PSUImage of an authenticated request to add_image
+    the image has to be uploaded with the upload handler set by use_image_upload_handler
+    """
+    try:
+        image = request.FILES['image']
+
+        # test if file is image (only the header is needed)
+        if imghdr.what(None, h=image.header) is None:
+            # return creation error
+            return respond_n_log(request, json_error_response('0xD5'), CommunicationLogEntry.Level.ERROR, psu=psu)
+
+        timestamp = parse_timestamp(request.POST['timestamp'])
+
+        stored = PSUImage.objects.filter(psu=psu, timestamp=timestamp).first()
+        if stored is not None:
+            if stored.sha256 == image.sha256:
+                # retry of an upload which is already stored
+                return respond_n_log(request, {'status': 'ok', 'duplicate': True}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+            # return already exists error
+            return respond_n_log(request, json_error_response('0xD4'), CommunicationLogEntry.Level.MINOR_ERROR, psu=psu)
+
+        img = PSUImage(psu=psu, timestamp=timestamp, sha256=image.sha256)
+
+        # do not write a second copy of the same image, only reference the stored file
+        identical = PSUImage.objects.filter(psu=psu, sha256=image.sha256).select_related('reference').first()
+        if identical is not None:
+            img.reference = identical.reference or identical
+            img.phash = img.reference.phash
+        else:
+            img.phash = dhash(image.temporary_file_path())
+            img.reference = find_image_reference(psu, timestamp, img.phash)
+
+        if img.reference is None:
+            img.image = image
+        else:
+            # only reference the file of the identical or nearly identical image
+            img.image = img.reference.image.name
+
+        try:
+            with metrics.timer('psucontrol_db_write_duration_seconds', operation='image'):
+                img.save()
+        except IntegrityError:
+            # remove the file stored by a concurrent upload of the same image
+            if img.reference is None:
+                img.image.delete(save=False)
+            if PSUImage.objects.filter(psu=psu, timestamp=timestamp, sha256=image.sha256).exists():
+                # concurrent retry of the same upload
+                return respond_n_log(request, {'status': 'ok', 'duplicate': True}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+            raise
+
+    except (NonExistentTimeError, ValueError):
+        # return timezone error
+        return respond_n_log(request, json_error_response('0xD3'), CommunicationLogEntry.Level.MAJOR_ERROR, psu=psu)
+    except IntegrityError:
+        # return already exists error
+        return respond_n_log(request, json_error_response('0xD4'), CommunicationLogEntry.Level.MINOR_ERROR, psu=psu)
+    except KeyError:
+        # return bad request
+        return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
+    except Exception:
+        # return creation error
+        return respond_n_log(request, json_error_response('0xD5'), CommunicationLogEntry.Level.ERROR, psu=psu)
+
+    return respond_n_log(request, {'status': 'ok', 'duplicate': False}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+
+
+@csrf_exempt
+@require_POST
+def add_image(request):
+    """
+    view to handle the process to a new PSUImage
+    a retry of an already stored upload (same timestamp and image) returns ok with duplicate
+    """
+    use_image_upload_handler(request)
+
+    if request.POST and request.FILES:
+        return identify_n_authenticate(store_image)(request)
     else:
         # return bad request type
         return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
 
 
+# the upload handler has to be set before middlewares access request.POST
+add_image.prepare_request = use_image_upload_handler
+
+
+def transmit_watering_task(request, psu):
+    """
+    returns the most recent watering task for an authenticated request to get_watering_task
+    """
+    # get all open watering tasks for this PSU
+    tasks = WateringTask.objects.filter(psu=psu, status__in=[5, 10])
+
+    if len(tasks) == 0:
+        # return no tasks available error
+        return respond_n_log(request, json_error_response('0xW1'), CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+    
+    # save first watering task
+    task = tasks[0]
+
+    with metrics.timer('psucontrol_db_write_duration_seconds', operation='watering_task'):
+        # cancel all tasks
+        for t in tasks:
+            # chancel task
+            t.status = -10
+            t.save()
+
+        # set status of task to be send to transmitted
+        task.status = 10
+        task.save()
+    return respond_n_log(request, {'status': 'ok', 'watering_task_id': task.id, 'watering_task_amount': task.amount}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+
+
+def has_new_watering_task(psu):
+    """
+    returns: bool whether a WateringTask with status 5 exists for the psu
+    """
+    return WateringTask.objects.filter(psu=psu, status=5).exists()
+
+
 @csrf_exempt
 @require_POST
-def mark_watering_task_executed(request):
+def get_watering_task(request):
     """
-    view to handle the information of a psu that the watering task was executed
+    view to handle to ge the most recent watering task
+    ALL others will be set to canceled
     """
     if request.POST:
-        try:
-            # identification of the PSU
-            psu = identify_psu(request.POST['identity_key'])
-
-            if psu is None:
-                # return identification error
-                return respond_n_log(request, json_error_response('0xA1'), CommunicationLogEntry.Level.ERROR)
+        return identify_n_authenticate(transmit_watering_task)(request)
+    else:
+        # return bad request type
+        return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
 
-            # authenticate PSU
-            if not authenticate_psu(psu, request.POST['signed_challenge']):
-                # return authentication error
-                return respond_n_log(request, json_error_response('0xA2'), CommunicationLogEntry.Level.ERROR, psu=psu)
 
-            task = WateringTask.objects.get(id=request.POST['watering_task_id'])
-            
-            if not task.psu == psu or task.status != 10:
-                # return failed to mark watering task as done error
-                return respond_n_log(request, json_error_response('0xW2'), CommunicationLogEntry.Level.ERROR, psu=psu)
+def mark_watering_task(request, psu):
+    """
+    marks the watering task of an authenticated request to mark_watering_task_executed as done
+    """
+    try:
+        task = WateringTask.objects.get(id=request.POST['watering_task_id'])
+        
+        if not task.psu == psu or task.status != 10:
+            # return failed to mark watering task as done error
+            return respond_n_log(request, json_error_response('0xW2'), CommunicationLogEntry.Level.ERROR, psu=psu)
 
-            task.status = 20
-            task.timestamp_execution = make_aware(datetime.now())
+        task.status = 20
+        task.timestamp_execution = make_aware(datetime.now())
+        with metrics.timer('psucontrol_db_write_duration_seconds', operation='watering_task'):
             task.save()
-            return respond_n_log(request, {'status': 'ok'}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
+        return respond_n_log(request, {'status': 'ok'}, CommunicationLogEntry.Level.MINOR_INFO, psu=psu)
 
-        except WateringTask.DoesNotExist:
-            # return failed to mark watering task as done error
-            return respond_n_log(request, json_error_response('0xW2'), CommunicationLogEntry.Level.ERROR, psu=psu)
-        except KeyError:
-            # return bad request
-            return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
+    except WateringTask.DoesNotExist:
+        # return failed to mark watering task as done error
+        return respond_n_log(request, json_error_response('0xW2'), CommunicationLogEntry.Level.ERROR, psu=psu)
+    except KeyError:
+        # return bad request
+        return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MAJOR_ERROR)
+
+
+@csrf_exempt
+@require_POST
+def mark_watering_task_executed(request):
+    """
+    view to handle the information of a psu that the watering task was executed
+    """
+    if request.POST:
+        return identify_n_authenticate(mark_watering_task)(request)
     else:
         # return bad request type
         return respond_n_log(request, json_error_response('0xB1'), CommunicationLogEntry.Level.MINOR_ERROR)
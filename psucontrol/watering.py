@@ -1,13 +1,19 @@
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread
 from datetime import timedelta
 
-from psucontrol.models import WateringTask, DataMeasurement, WateringDecision
+from django.conf import settings
+from django.db import close_old_connections
+
+from psucontrol import metrics
+from psucontrol.jobqueue import enqueue_watering_job
+from psucontrol.models import WateringTask, WateringParams, DataMeasurement, WateringDecision, PSUState
 
 class CalculateWatering(Thread):
     """
     class to handling the calculation for the amount which is needed to keep the plant alive
     the water amount is calculated in milliliters
-    these threads are always open after a PSU sent a new data measurement
+    after a PSU sent new data measurements the calculation is run by calculation_pool (see schedule_watering_calculation)
     """
 
     def __init__(self, psu):
@@ -38,18 +44,44 @@ class CalculateWatering(Thread):
 
         task.save()
 
-    def crunch_data(self):
+    def state(self, save=True):
+        """
+        returns: PSUState of the psu, built from the stored data if there is none yet (stored if save)
+        """
+        state = PSUState.objects.select_related('last_task').filter(psu=self.psu).first()
+        if state is None:
+            state = PSUState.rebuild(self.psu, save=save)
+        return state
+
+    def measurements(self, state):
+        """
+        returns: tuple of the current DataMeasurement and the ones right before and after the last execution
+        the DataMeasurements are built from the state (not saved), missing ones are replaced by the current one
+        """
+        if state.current_timestamp is None:
+            return None, None, None
+        current_dm = DataMeasurement(psu=self.psu, timestamp=state.current_timestamp,
+                                     ground_humidity=state.current_ground_humidity, brightness=state.current_brightness)
+
+        def around(timestamp, ground_humidity):
+            if timestamp is None or timestamp == current_dm.timestamp:
+                return current_dm
+            return DataMeasurement(psu=self.psu, timestamp=timestamp, ground_humidity=ground_humidity)
+
+        return (current_dm, around(state.prev_timestamp, state.prev_ground_humidity),
+                around(state.after_timestamp, state.after_ground_humidity))
+
+    def crunch_data(self, state=None):
         """
+        state: PSUState of the psu if already loaded
         returns: amount to be used 
         """
-        dms = DataMeasurement.objects.filter(psu=self.psu)
+        state = state or self.state()
+        if self.psu.watering_params.algorithm == WateringParams.Algorithm.PID:
+            return self.crunch_pid(state)
 
         # seatch for lastest ground_humidity information
-        current_dm = None
-        for dm in dms:
-            if not dm.ground_humidity is None:
-                current_dm = dm
-                break
+        current_dm, prev_dm, after_dm = self.measurements(state)
 
         if current_dm is None:
             # no data -> do not water plant
@@ -64,23 +96,12 @@ class CalculateWatering(Thread):
                                             info="Either plant happy or too dark.\nCurrent: {}".format(current_dm))
             return 0
 
-        last_task = WateringTask.objects.filter(psu=self.psu, status=20).first()
+        last_task = state.last_task
         if last_task is None:
             WateringDecision.objects.create(psu=self.psu, watering_params=self.psu.watering_params, amount=self.psu.watering_params.starting_amount,
                                             info="No Task found.\nCurrent: {}".format(current_dm))
             return self.psu.watering_params.starting_amount
 
-        after_dm = current_dm
-        prev_dm = current_dm
-        for dm in dms:
-            if (last_task.timestamp_execution - dm.timestamp) >= timedelta() and not dm.ground_humidity is None:
-                # current dm older than last watering
-                prev_dm = dm
-                break
-            elif not dm.ground_humidity is None:
-                # store the timestamp as candidate for after
-                after_dm = dm
-
         # got for a proportional approach for now
         delta_ghum_last = after_dm.ground_humidity - prev_dm.ground_humidity
         delta_ghum_now = self.psu.watering_params.ground_humidity_goal - current_dm.ground_humidity
@@ -113,6 +134,55 @@ class CalculateWatering(Thread):
                                             info="Not worth sending out.\nCurrent: {}\nPrev: {}\nAfter: {}\nLast: {}".format(current_dm, prev_dm, after_dm, last_task))
             return 0
 
+    def crunch_pid(self, state, dry=False):
+        """
+        function to calculate the amount with a PID controller on the newest ground humidity
+        every measurement is used for one step, the integral and the previous error are stored in the PSUState
+        dry: do not store the step and the WateringDecision
+        returns: amount to be used
+        """
+        params = self.psu.watering_params
+
+        if state.current_timestamp is None or state.current_timestamp == state.pid_timestamp:
+            # no measurement or already used for a step
+            info = "No new measurements with ground humidity."
+            amount = 0
+
+        elif state.current_brightness is not None and state.current_brightness <= params.light_level_limit:
+            # too dark to water the plant, the step is done with the next measurement
+            info = "Too dark.\nCurrent ground humidity {} at {}".format(state.current_ground_humidity, state.current_timestamp)
+            amount = 0
+
+        else:
+            # positive error -> ground too dry
+            error = params.ground_humidity_goal - state.current_ground_humidity
+            integral = state.pid_integral + error * params.dt
+            derivative = 0 if state.pid_previous_error is None or not params.dt else (error - state.pid_previous_error) / params.dt
+            output = params.kp * error + params.ki * integral + params.kd * derivative
+
+            if output > params.maximum_amount:
+                amount = params.maximum_amount
+            elif output < params.minimum_amount:
+                # not worth sending out
+                amount = 0
+            else:
+                amount = int(output)
+
+            # anti-windup: the integral does not grow while the output is clamped in the direction of the error
+            if (output > params.maximum_amount and error > 0) or (output < params.minimum_amount and error < 0):
+                integral = state.pid_integral
+
+            info = "PID step.\nError: {}\nIntegral: {}\nDerivative: {}\nOutput: {}".format(error, integral, derivative, output)
+            if not dry:
+                # only the fields of the controller to keep concurrent updates of the measurements
+                PSUState.objects.filter(psu=self.psu).update(pid_integral=integral, pid_previous_error=error,
+                                                             pid_timestamp=state.current_timestamp)
+                state.pid_integral, state.pid_previous_error, state.pid_timestamp = integral, error, state.current_timestamp
+
+        if not dry:
+            WateringDecision.objects.create(psu=self.psu, watering_params=params, amount=amount, info=info)
+        return amount
+
         
     def run(self):
         """
@@ -122,8 +192,10 @@ class CalculateWatering(Thread):
 
         params = self.psu.watering_params
 
-        if (WateringTask.objects.filter(psu=self.psu).count() > 0 and
-            (DataMeasurement.objects.filter(psu=self.psu).first().timestamp - WateringTask.objects.filter(psu=self.psu).first().timestamp) <= timedelta()):
+        # the freshness check and the calculation read the PSUState instead of the history
+        state = self.state()
+        if (state.latest_task_timestamp is not None and
+            (state.latest_timestamp is None or state.latest_timestamp - state.latest_task_timestamp <= timedelta())):
             # newest WateringTask created after DataMeasurement
             print("No new data for doing another calculation.")
 
@@ -135,9 +207,10 @@ class CalculateWatering(Thread):
             # run calculation
             print("Algrothim parameters to be used {}".format(str(params)))
             # Testing purposes create watering task without calculation
-            amount = self.crunch_data()
-            if amount > 0:
-                self.create_task(amount)
+            with metrics.timer('psucontrol_watering_calculation_duration_seconds'):
+                amount = self.crunch_data(state)
+                if amount > 0:
+                    self.create_task(amount)
         
         print("Exited {}".format(self.name))
 
@@ -147,14 +220,12 @@ class CalculateWatering(Thread):
         function which returns the amount but does not do anything in the database
         returns: amount to be used
         """
-        dms = DataMeasurement.objects.filter(psu=self.psu)
+        state = self.state(save=False)
+        if self.psu.watering_params.algorithm == WateringParams.Algorithm.PID:
+            return self.crunch_pid(state, dry=True)
 
         # seatch for lastest ground_humidity information
-        current_dm = None
-        for dm in dms:
-            if not dm.ground_humidity is None:
-                current_dm = dm
-                break
+        current_dm, prev_dm, after_dm = self.measurements(state)
 
         if current_dm is None:
             # no data -> do not water plant
@@ -165,21 +236,10 @@ class CalculateWatering(Thread):
             # no need to check watering because plant is happy now or too dark to water plant now
             return 0
 
-        last_task = WateringTask.objects.filter(psu=self.psu, status=20).first()
+        last_task = state.last_task
         if last_task is None:
             return self.psu.watering_params.starting_amount
 
-        after_dm = current_dm
-        prev_dm = current_dm
-        for dm in dms:
-            if (last_task.timestamp_execution - dm.timestamp) >= timedelta() and not dm.ground_humidity is None:
-                # current dm older than last watering
-                prev_dm = dm
-                break
-            elif not dm.ground_humidity is None:
-                # store the timestamp as candidate for after
-                after_dm = dm
-
         # got for a proportional approach for now
         delta_ghum_last = after_dm.ground_humidity - prev_dm.ground_humidity
         delta_ghum_now = self.psu.watering_params.ground_humidity_goal - current_dm.ground_humidity
@@ -201,3 +261,83 @@ class CalculateWatering(Thread):
             return self.psu.watering_params.maximum_amount
         else:
             return 0
+
+
+class WateringCalculationPool:
+    """
+    class running the watering calculations in PSU_WATERING_WORKERS threads instead of one thread per measurement
+    a calculation requested while another one of the same PSU is waiting is merged into the waiting one
+    and calculations of the same PSU never run at the same time
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # created on the first calculation to read the settings
+        self.executor = None
+        # psu id: newest PSU object of the waiting calculations
+        self.pending = dict()
+        # psu ids of the running calculations
+        self.running = set()
+
+    def submit(self, psu):
+        """
+        requests a watering calculation for the psu
+        returns: bool whether a new calculation was queued (False if it was merged into a waiting one)
+        """
+        with self.lock:
+            coalesced = psu.id in self.pending
+            self.pending[psu.id] = psu
+            depth = len(self.pending)
+            if not coalesced and psu.id not in self.running:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=settings.PSU_WATERING_WORKERS, thread_name_prefix='watering')
+                self.executor.submit(self.run, psu.id)
+
+        if coalesced:
+            metrics.inc('psucontrol_watering_coalesced_total')
+        metrics.set_gauge('psucontrol_watering_queue_depth', depth)
+        return not coalesced
+
+    def run(self, psu_id):
+        """
+        runs the waiting calculation of a PSU in a worker thread
+        """
+        with self.lock:
+            psu = self.pending.pop(psu_id)
+            self.running.add(psu_id)
+            depth = len(self.pending)
+        metrics.set_gauge('psucontrol_watering_queue_depth', depth)
+
+        # the workers keep their database connections, so only bad or expired ones are closed
+        close_old_connections()
+        try:
+            self.calculate(psu)
+        except Exception as e:
+            print('Failed to calculate watering for {}: {}'.format(psu, e))
+        finally:
+            close_old_connections()
+            with self.lock:
+                self.running.discard(psu_id)
+                # measurements arrived during the calculation
+                if psu_id in self.pending:
+                    self.executor.submit(self.run, psu_id)
+
+    def calculate(self, psu):
+        """
+        runs the calculation of CalculateWatering in the current thread
+        """
+        CalculateWatering(psu).run()
+
+
+calculation_pool = WateringCalculationPool()
+
+
+def schedule_watering_calculation(psu):
+    """
+    function to calculate the need of water of a psu after new data measurements in the background
+    with PSU_WATERING_JOB_QUEUE the calculation is stored as WateringJob for the command wateringworker
+    """
+    if settings.PSU_WATERING_JOB_QUEUE:
+        enqueue_watering_job(psu)
+    else:
+        calculation_pool.submit(psu)
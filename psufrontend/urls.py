@@ -20,4 +20,6 @@ urlpatterns = [
     path(r'chart/psu/<int:psu>/<str:time_range>', v.chart_view, name='chart'),
     path(r'chart/psu/<int:psu>', v.chart_view, name='chart'),
     path(r'chart', v.chart_view, name='chart'),
+    path(r'timelapse/psu/<int:psu>/<str:time_range>', v.timelapse_view, name='timelapse'),
+    path(r'timelapse/psu/<int:psu>', v.timelapse_view, name='timelapse'),
 ]
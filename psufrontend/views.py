@@ -1,4 +1,7 @@
+from django.conf import settings
+from django.http import HttpResponse, Http404
 from django.shortcuts import redirect, render
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from django.core.paginator import Paginator
 
@@ -11,6 +14,7 @@ from django.contrib import messages
 from psufrontend.forms import RegisterPSUForm, AddWateringTaskForm, WateringControlForm, AddUserPermissionsForm, RevokeUserPermissionsForm
 from psucontrol.models import CommunicationLogEntry, PSU, PSUImage, PendingPSU, DataMeasurement, WateringTask, WateringParams
 from psucontrol.utils import get_psus_with_permission, get_users_with_permission, get_timedelta
+from psucontrol.timelapse import FORMATS as TIMELAPSE_FORMATS, build_timelapse
 from psucontrol.watering import CalculateWatering
 from authentication.models import User
 
@@ -344,3 +348,48 @@ def chart_view(request, *, psu=0, time_range=""):
         context['measurements'] = measurements
 
     return render(request, 'psufrontend/chart.html', context=context)
+
+
+@login_required
+def timelapse_view(request, *, psu=0, time_range=""):
+    """
+    view returning the time-lapse of the images of a psu
+    the format can be chosen with the GET parameter format (webp or mjpeg)
+    """
+    # gather the psus of the user
+    psus = get_psus_with_permission(request.user, 1)
+    if len(psus) == 0:
+        # no psus -> redirect to the no_psu_view
+        return redirect('psufrontend:no_psu')
+
+    # Try finding the handed over PSU id in the list of psus
+    sel_psu = None
+    for p in psus:
+        if p.id == psu:
+            sel_psu = p
+            break
+    if sel_psu is None:
+        # id not found -> take first psu in list
+        sel_psu = psus[0]
+
+    # Try to parse range to timedalta
+    delta = get_timedelta(time_range)
+    if delta is None:
+        # go back to one week if there is no vaild range
+        delta = timedelta(days=7)
+
+    fmt = request.GET.get('format', 'webp')
+    if fmt not in TIMELAPSE_FORMATS:
+        raise Http404('TimelapseFormatNotFound')
+
+    # time-lapses consist of whole days, longer ranges are built by the command timelapse
+    days = min(max(delta.days, 1), settings.PSU_TIMELAPSE_MAX_DAYS)
+    end = timezone.localdate()
+    data = build_timelapse(sel_psu, end - timedelta(days=days - 1), end, fmt)
+    if data is None:
+        raise Http404('PSUImageNotFound')
+
+    res = HttpResponse(data, content_type=TIMELAPSE_FORMATS[fmt]['content_type'])
+    if fmt == 'mjpeg':
+        res['Content-Disposition'] = 'attachment; filename="timelapse_{}{}"'.format(sel_psu.id, TIMELAPSE_FORMATS[fmt]['file_extension'])
+    return res
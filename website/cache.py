@@ -0,0 +1,45 @@
+import base64
+import pickle
+
+from django.core.cache.backends import db
+from django.db import connections, router, transaction
+
+
+# Cache backend shared by all processes without additional services (see the cache ratelimit of CACHES in website.settings)
+# the table is created by: python manage.py createcachetable
+
+
+class DatabaseCache(db.DatabaseCache):
+    """
+    DatabaseCache whose incr is atomic (used by the counters of psucontrol.ratelimit)
+    the incr of django reads and writes the value without a lock, so concurrent increments get lost
+    """
+
+    def incr(self, key, delta=1, version=None):
+        """
+        increments the value of key while its row is locked
+        returns: new value
+        """
+        db_key = self.make_key(key, version=version)
+        self.validate_key(db_key)
+        alias = router.db_for_write(self.cache_model_class)
+        connection = connections[alias]
+        quote_name = connection.ops.quote_name
+        table = quote_name(self._table)
+
+        with transaction.atomic(using=alias), connection.cursor() as cursor:
+            # the update without changes locks the row (the database on SQLite) until the end of the transaction
+            cursor.execute('UPDATE %s SET %s = %s WHERE %s = %%s' % (
+                table, quote_name('cache_key'), quote_name('cache_key'), quote_name('cache_key')), [db_key])
+
+            # get handles expired entries
+            value = self.get(key, version=version)
+            if value is None:
+                raise ValueError("Key '%s' not found" % key)
+            value += delta
+
+            # keep the expiry of the entry
+            pickled = base64.b64encode(pickle.dumps(value, self.pickle_protocol)).decode('latin1')
+            cursor.execute('UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+                table, quote_name('value'), quote_name('cache_key')), [pickled, db_key])
+        return value
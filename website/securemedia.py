@@ -1,10 +1,17 @@
+import base64
+from hashlib import md5
+from time import time
+from urllib.parse import quote
+
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseGone, Http404
 from django.shortcuts import redirect
 from django.urls import path
+from django.utils.crypto import constant_time_compare
 
+from psucontrol.derivatives import derivative_name, create_derivative, derivatives_pool
 from psucontrol.models import PSUImage
 from psucontrol.utils import check_permissions
 
@@ -15,32 +22,123 @@ app_name = 'securemedia'
 def psufeed_handler(request, path):
     """
     view to handle the request of a psufeed image
+    a smaller version can be requested with the GET parameter size (key of PSU_IMAGE_DERIVATIVES)
     """
 
     # try matching path to PSUImage in database and getting the corresponding psu
-    try:
-        psu = PSUImage.objects.get(image='psufeed/' + path).psu
-    except PSUImage.DoesNotExist:
+    # the file might be used by several PSUImages of the same psu (see PSUImage.reference)
+    image = PSUImage.objects.filter(image='psufeed/' + path).select_related('psu').first()
+    if image is None:
         # no such image found
         raise Http404('PSUImageNotFound')
+    psu = image.psu
     
     if check_permissions(psu, request.user) > 0:
         # grant access to owner and permitted users
         # staff/superusers treated as owners
 
-        if settings.DEBUG:
-            # redirect when DEBUG = True (no X-Accel-Redirect support)
-            return redirect('/protectedmedia/psufeed/' + path)
-        else:
-            # create response with X-Accel-Redirect
-            res = HttpResponse()
-            res['Content-Type'] = ""
-            res['X-Accel-Redirect'] = '/protectedmedia/psufeed/' + path
-            return res
+        path = 'psufeed/' + path
+        size = request.GET.get('size')
+        if size is not None:
+            if size not in settings.PSU_IMAGE_DERIVATIVES:
+                raise Http404('PSUImageSizeNotFound')
+
+            # create missing derivatives on first request
+            if not settings.SECURE_MEDIA_STORAGE.exists(derivative_name(path, size)):
+                try:
+                    create_derivative(path, size)
+                except Exception:
+                    raise Http404('PSUImageNotFound')
+            path = derivative_name(path, size)
+
+        return serve_secure_media(path)
     else:
         raise PermissionDenied('PSUImagePermissionDenied')
 
 
+def serve_secure_media(path):
+    """
+    returns: response handing over the delivery of the file path in SECURE_MEDIA_STORAGE to the web server
+    """
+    if settings.DEBUG:
+        # redirect when DEBUG = True (no X-Accel-Redirect support)
+        return redirect('/protectedmedia/' + path)
+    else:
+        # create response with X-Accel-Redirect
+        res = HttpResponse()
+        res['Content-Type'] = ""
+        res['X-Accel-Redirect'] = '/protectedmedia/' + path
+        return res
+
+
+def sign_media_path(path, expires):
+    """
+    signs a path in SECURE_MEDIA_STORAGE in the format of the nginx secure_link module, so nginx can
+    deliver the file without asking django:
+        location /signedmedia/ {
+            secure_link $arg_md5,$arg_expires;
+            secure_link_md5 "$secure_link_expires$uri <SIGNED_MEDIA_SECRET>";
+            if ($secure_link = "") { return 403; }
+            if ($secure_link = "0") { return 410; }
+            alias <SECURE_MEDIA_ROOT>/;
+        }
+    returns: signature as url safe base64 string without padding
+    """
+    uri = settings.SIGNED_MEDIA_URL + path
+    digest = md5(bytes('{}{} {}'.format(expires, uri, settings.SIGNED_MEDIA_SECRET), 'utf-8')).digest()
+    return str(base64.urlsafe_b64encode(digest), 'utf-8').rstrip('=')
+
+
+def signed_media_url(path):
+    """
+    returns: signed url of a path in SECURE_MEDIA_STORAGE expiring after SIGNED_MEDIA_URL_LIFETIME to 2 * SIGNED_MEDIA_URL_LIFETIME seconds
+    """
+    # the expiry is rounded, so the url stays the same for a while and can be cached by browsers
+    lifetime = settings.SIGNED_MEDIA_URL_LIFETIME
+    expires = (int(time()) // lifetime + 2) * lifetime
+    return '{}{}?md5={}&expires={}'.format(settings.SIGNED_MEDIA_URL, quote(path), sign_media_path(path, expires), expires)
+
+
+def psuimage_url(image, size=None):
+    """
+    function to get the signed url of a PSUImage
+    the permissions of the user have to be checked before
+    derivatives are never created here (the function is used while rendering templates), a missing
+    derivative is queued in the derivatives_pool and the url of the original is returned instead
+    returns: signed url of the image or of its derivative in size (key of PSU_IMAGE_DERIVATIVES)
+    """
+    path = image.image.name
+    if size is not None:
+        name = derivative_name(path, size)
+        try:
+            exists = settings.SECURE_MEDIA_STORAGE.exists(name)
+        except OSError:
+            exists = False
+        if exists:
+            path = name
+        elif settings.PSU_IMAGE_DERIVATIVES_ASYNC:
+            derivatives_pool.submit(path)
+    return signed_media_url(path)
+
+
+def signedmedia_handler(request, path):
+    """
+    view to verify signed urls (see sign_media_path) for DEBUG and deployments without nginx secure_link
+    """
+    try:
+        expires = int(request.GET['expires'])
+        valid = constant_time_compare(request.GET['md5'], sign_media_path(path, expires))
+    except (KeyError, ValueError):
+        valid = False
+
+    if not valid:
+        raise PermissionDenied('SignedMediaLinkInvalid')
+    if expires < time():
+        return HttpResponseGone()
+
+    return serve_secure_media(path)
+
+
 # urls for securemedia
 urlpatterns = [
     path(r'psufeed/<path:path>', psufeed_handler, name='psufeed'),
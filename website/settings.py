@@ -14,6 +14,7 @@ from pathlib import Path
 import os
 import environ
 from django.utils.translation import gettext_lazy as _
+from django.core.exceptions import ImproperlyConfigured
 from django.core.files.storage import FileSystemStorage
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -31,6 +32,15 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # STATIC_ROOT - ONLY for production
 # MEDIA_ROOT - ONLY for production
 # SECURE_MEDIA_ROOT - ONLY for production
+# SIGNED_MEDIA_SECRET - secret shared with nginx to verify signed media urls, has to differ from SECRET_KEY (required in production)
+# PSU_METRICS_TOKEN - bearer token granting access to /metrics besides staff users, empty disables the token
+# PSU_METRICS_DIR - directory shared by all processes to aggregate the metrics
+# CACHE_BACKEND - backend of the default cache, defaults to the LocMemCache of every process
+#                 (e.g. django.core.cache.backends.memcached.PyMemcacheCache with pymemcache installed to share it)
+# CACHE_LOCATION - address of the cache server or name of the LocMemCache
+# RATELIMIT_CACHE_BACKEND - backend of the counters of the rate limits, defaults to website.cache.DatabaseCache
+#                           (e.g. django.core.cache.backends.memcached.PyMemcacheCache)
+# RATELIMIT_CACHE_LOCATION - table of the DatabaseCache or address of the cache server, defaults to psucontrol_ratelimit
 
 env = environ.Env()
 environ.Env.read_env("../.env")
@@ -152,6 +162,25 @@ else:
     SECURE_MEDIA_ROOT = os.path.join(BASE_DIR.parent, 'securemedia')
 
 
+# default cache holding e.g. the snapshots of the PSUs (see psucontrol.views.identify_psu)
+# a cache hit must not cost a database query, so it is kept in memory: the LocMemCache of every process
+# or a memcached server shared by all processes (CACHE_BACKEND)
+CACHES = {
+    'default': {
+        'BACKEND': env('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': env('CACHE_LOCATION', default='psucontrol'),
+    },
+    # counters of the rate limits (see psucontrol.ratelimit), they have to be shared by all processes and need an atomic incr
+    # the default database cache holds far more entries than the counters of all PSUs and client addresses,
+    # so counters are only removed after they expired and never culled early
+    'ratelimit': {
+        'BACKEND': env('RATELIMIT_CACHE_BACKEND', default='website.cache.DatabaseCache'),
+        'LOCATION': env('RATELIMIT_CACHE_LOCATION', default='psucontrol_ratelimit'),
+        'OPTIONS': {'MAX_ENTRIES': 1000000},
+    },
+}
+
+
 # settings for STATIC, MEDIA and SECURE_MEDIA
 STATIC_URL = '/static/'
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
@@ -160,6 +189,42 @@ MEDIA_URL = '/media/'
 # url to be called -> django handles user authentication
 SECURE_MEDIA_URL = '/securemedia/'
 SECURE_MEDIA_STORAGE = FileSystemStorage(location=SECURE_MEDIA_ROOT, base_url=SECURE_MEDIA_URL)
+# url of signed and expiring links to SECURE_MEDIA which can be verified by nginx (see website.securemedia.sign_media_path)
+SIGNED_MEDIA_URL = '/signedmedia/'
+# secret shared with nginx (secure_link_md5), SECRET_KEY must not be part of the web server configuration
+if DEBUG:
+    SIGNED_MEDIA_SECRET = env('SIGNED_MEDIA_SECRET', default='development-signed-media-secret')
+else:
+    # missing variable stops the start of the server
+    SIGNED_MEDIA_SECRET = env('SIGNED_MEDIA_SECRET')
+if SIGNED_MEDIA_SECRET == SECRET_KEY:
+    raise ImproperlyConfigured('SIGNED_MEDIA_SECRET has to differ from SECRET_KEY.')
+SIGNED_MEDIA_URL_LIFETIME = 3600
+# directory for images while they are uploaded by the PSUs
+# has to be on the same file system as SECURE_MEDIA_ROOT, so the images are moved instead of copied
+PSU_IMAGE_UPLOAD_DIR = os.path.join(SECURE_MEDIA_ROOT, 'incoming')
+# smaller versions of the PSUImages (requested with ?size=<key> from securemedia/psufeed/...)
+# size is the maximum width and height in pixels, format one of JPEG, PNG and WEBP
+PSU_IMAGE_DERIVATIVES = {
+    'thumbnail': {'size': 320, 'format': 'JPEG', 'quality': 75},
+    'medium': {'size': 1024, 'format': 'JPEG', 'quality': 80},
+    'webp': {'size': 1024, 'format': 'WEBP', 'quality': 75},
+}
+# create the derivatives in background threads when a PSUImage is saved, False creates them synchronously
+PSU_IMAGE_DERIVATIVES_ASYNC = True
+# threads creating the derivatives and maximum number of images waiting for them (see psucontrol.derivatives.DerivativesPool)
+# images arriving while the queue is full get their derivatives on request
+PSU_IMAGE_DERIVATIVES_WORKERS = 2
+PSU_IMAGE_DERIVATIVES_QUEUE_SIZE = 100
+# time-lapses of the PSUImages (see psucontrol.timelapse)
+# size of the frames in pixels, display time of every frame in milliseconds (webp only) and quality (0-100)
+PSU_TIMELAPSE_SIZE = (640, 480)
+PSU_TIMELAPSE_FRAME_DURATION = 200
+PSU_TIMELAPSE_QUALITY = 75
+# images of one day are evenly reduced to this number of frames
+PSU_TIMELAPSE_MAX_FRAMES_PER_DAY = 48
+# maximum number of days of a time-lapse built by the frontend (built within the request)
+PSU_TIMELAPSE_MAX_DAYS = 31
 
 # Application definition
 
@@ -177,9 +242,11 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'psucontrol.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'psucontrol.ratelimit.RateLimitMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -235,6 +302,73 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# settings for the communication with the PSUs
+# maximum number of measurements accepted by one request to add_data_measurements
+PSU_MEASUREMENT_BATCH_SIZE = 1000
+# number of deserialized public keys kept in memory by every process
+PSU_PUBLIC_KEY_CACHE_SIZE = 4096
+# seconds a PSU or an unknown identity key is cached by psucontrol.views.identify_psu
+# saving or deleting a PSU removes its snapshot from the cache of the saving process (from all processes with a
+# shared CACHE_BACKEND), with the default LocMemCache other processes use the old snapshot for at most these seconds
+PSU_IDENTITY_CACHE_TIMEOUT = 15
+PSU_IDENTITY_CACHE_NEGATIVE_TIMEOUT = 10
+# seconds a stateless challenge is valid (see get_challenge with stateless)
+PSU_CHALLENGE_LIFETIME = 300
+# threads verifying signatures for the async views (psucontrol/async/...)
+PSU_RSA_VERIFY_WORKERS = 4
+# maximum seconds a request to wait_for_watering_task is held open and seconds between two database checks
+# for new tasks (tasks saved by the same process wake up the request immediately, the checks find the tasks
+# saved by other processes, e.g. by the admin of another worker)
+PSU_LONG_POLL_TIMEOUT = 60
+PSU_LONG_POLL_INTERVAL = 5
+# limits of the requests to psucontrol.urls (see psucontrol.ratelimit)
+# keys are the names of the url patterns without async_ and default is used for all others
+# psu limits every known PSU and ip every client address to (rate in requests per second, burst in requests),
+# None disables a limit
+PSU_RATE_LIMITS = {
+    'default': {'psu': (1, 30), 'ip': (20, 600)},
+    'register_new_psu': {'psu': None, 'ip': (0.05, 10)},
+    'get_challenge': {'psu': (1, 30), 'ip': (20, 600)},
+    'add_data_measurement': {'psu': (1, 60), 'ip': (20, 600)},
+    'add_image': {'psu': (0.2, 10), 'ip': (5, 100)},
+    'wait_for_watering_task': {'psu': (0.1, 5), 'ip': (5, 100)},
+}
+# META key holding the client address, behind a reverse proxy e.g. HTTP_X_REAL_IP set by nginx or
+# HTTP_X_FORWARDED_FOR (of which the last address, added by the reverse proxy itself, is used)
+PSU_RATE_LIMIT_IP_HEADER = 'REMOTE_ADDR'
+# metrics of the device API exposed at /metrics (see psucontrol.metrics)
+# every process writes its values to PSU_METRICS_DIR at most every PSU_METRICS_FLUSH_INTERVAL seconds
+PSU_METRICS_DIR = env('PSU_METRICS_DIR', default=os.path.join(BASE_DIR.parent, 'metrics'))
+PSU_METRICS_FLUSH_INTERVAL = 5
+PSU_METRICS_TOKEN = env('PSU_METRICS_TOKEN', default='')
+# upper bounds of the buckets of the histograms in seconds
+PSU_METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# threads calculating the need of water after new measurements (see psucontrol.watering.WateringCalculationPool)
+PSU_WATERING_WORKERS = 4
+# True stores the calculations as WateringJobs which are processed by manage.py wateringworker (see psucontrol.jobqueue)
+# instead of the threads of the web processes, so they survive restarts
+PSU_WATERING_JOB_QUEUE = False
+# jobs claimed at once by a worker and seconds between two checks for new jobs
+PSU_WATERING_JOB_BATCH_SIZE = 10
+PSU_WATERING_JOB_POLL_INTERVAL = 1
+# seconds a claimed job is hidden from other workers, seconds of delay per attempt after a failure and attempts per job
+PSU_WATERING_JOB_VISIBILITY_TIMEOUT = 300
+PSU_WATERING_JOB_RETRY_DELAY = 30
+PSU_WATERING_JOB_MAX_ATTEMPTS = 5
+
+# settings for the communication log (see psucontrol.logwriter)
+# write log entries in a background thread with bulk inserts, False writes them synchronously (e.g. for tests)
+PSU_LOG_ASYNC = True
+# maximum number of entries waiting to be written
+PSU_LOG_QUEUE_SIZE = 10000
+# entries are written as soon as one of the following limits is reached
+PSU_LOG_FLUSH_SIZE = 500
+PSU_LOG_FLUSH_INTERVAL = 2
+# entries below this level are dropped if the queue is full
+# all others wait PSU_LOG_BLOCK_TIMEOUT seconds and are written synchronously if the queue is still full
+PSU_LOG_DROP_BELOW_LEVEL = 10
+PSU_LOG_BLOCK_TIMEOUT = 1
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.1/topics/i18n/
 
@@ -1,5 +1,6 @@
 from django import template
 
+from website.securemedia import psuimage_url
 from website.utils import get_i18n_tag
 
 register = template.Library()
@@ -41,3 +42,11 @@ def plain(value):
     template filter to get string representation
     """
     return str(value)
+
+
+@register.filter
+def signed_url(image, size=None):
+    """
+    template filter to get the signed url of a PSUImage or of one of its derivatives
+    """
+    return psuimage_url(image, size)
@@ -21,12 +21,15 @@ from django.contrib import admin
 from django.shortcuts import redirect
 from django.urls import path
 
-from website.securemedia import psufeed_handler
+from psucontrol.metrics import metrics_handler
+from website.securemedia import psufeed_handler, signedmedia_handler
 
 # URL Patterns without i18n tags
 urlpatterns = [
     path(r'psucontrol/', include('psucontrol.urls', namespace='psucontrol')),
     path(r'securemedia/', include('website.securemedia', namespace='securemedia')),
+    path(r'signedmedia/<path:path>', signedmedia_handler, name='signedmedia'),
+    path(r'metrics', metrics_handler, name='metrics'),
     path(r'error/', include('website.errorviews', namespace='error'))
 ]  + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) + static('protectedmedia', document_root=settings.SECURE_MEDIA_ROOT)
 